@@ -11,6 +11,10 @@ setup(
         "click>=7.0",
         # Add other dependencies here
     ],
+    extras_require={
+        # Enables .br output for `stackops assets build`
+        'brotli': ['brotli>=1.0'],
+    },
     entry_points={
         'console_scripts': [
             'stackops=stackops.cli:main',
@@ -1,4 +1,5 @@
 """Server Setup Package initialization"""
+import logging
 from importlib import metadata
 
 try:
@@ -6,4 +7,7 @@ try:
 except metadata.PackageNotFoundError:
     __version__ = "0.0.0"
 
+# Silent unless the application configures logging (see log_config)
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
 from .setup_manager import ServerSetup
\ No newline at end of file
@@ -0,0 +1,368 @@
+# src/stackops/agent.py
+import logging
+import os
+import select
+import shutil
+import struct
+import subprocess
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from stackops.settings import Settings
+from stackops.setup_manager import ServerSetup
+from stackops.state import (
+    MANAGED_FILES, MANAGED_SERVICES, baseline_copy, file_digest, load_state, save_baseline, save_state,
+    snapshot_files,
+)
+from stackops.utils import install_scripts
+
+logger = logging.getLogger(__name__)
+
+# Seconds between service probes (and full file checks without inotify)
+PROBE_INTERVAL = 60.0
+
+# Quiet period after a file event before checking, so multi-write edits settle
+SETTLE_DELAY = 1.0
+
+# Service that loads each managed file, by path prefix
+FILE_SERVICES = (
+    ('etc/nginx/', 'nginx'),
+    ('etc/fail2ban/', 'fail2ban'),
+    ('etc/systemd/system/', 'systemd'),
+)
+
+# Configuration test run before a service is reloaded with restored files
+CONFIG_TESTS = {
+    'nginx': ('nginx', '-t'),
+    'fail2ban': ('fail2ban-client', '-t'),
+}
+
+# systemctl arguments that make a service pick up restored files (cron rereads by itself)
+RELOADS = {
+    'nginx': ('reload', 'nginx'),
+    'fail2ban': ('reload', 'fail2ban'),
+    'systemd': ('daemon-reload',),
+}
+
+# inotify(7) constants
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_IGNORED = 0x00008000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ATTRIB
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify:
+    """Minimal ctypes binding for inotify(7); raises OSError where unsupported"""
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError("inotify is not available")
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._get_errno = ctypes.get_errno
+
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(self._get_errno(), "inotify_init1 failed")
+        self.watches: Dict[int, Path] = {}
+
+    def add_watch(self, directory: Path, mask: int = WATCH_MASK) -> int:
+        """Watch a directory; returns the watch descriptor"""
+        wd = self._add_watch(self.fd, os.fsencode(str(directory)), mask)
+        if wd < 0:
+            raise OSError(self._get_errno(), f"cannot watch {directory}")
+        self.watches[wd] = Path(directory)
+        return wd
+
+    def read(self, timeout: Optional[float]) -> List[Tuple[Path, str, int]]:
+        """
+        Wait up to timeout seconds for events
+
+        Returns:
+            (directory, file name, mask) for each event
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events, offset = [], 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, _cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+            offset += length
+            if mask & IN_IGNORED:
+                # Watched directory went away; re-added on the next probe
+                self.watches.pop(wd, None)
+                continue
+            if wd in self.watches:
+                events.append((self.watches[wd], name, mask))
+        return events
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def file_service(rel: str) -> Optional[str]:
+    """Service whose configuration a managed file belongs to, if any"""
+    for prefix, service in FILE_SERVICES:
+        if rel.startswith(prefix):
+            return service
+    return None
+
+
+class DriftAgent:
+    """Watch managed files and services and re-apply the steps that drifted"""
+
+    def __init__(self,
+                 setup: ServerSetup,
+                 probe_interval: float = PROBE_INTERVAL,
+                 settle_delay: float = SETTLE_DELAY,
+                 use_inotify: bool = True):
+        """
+        Args:
+            setup: ServerSetup with scripts installed, used to re-apply steps
+            probe_interval: Seconds between service probes
+            settle_delay: Seconds to wait after a file event before checking
+            use_inotify: Watch files with inotify (falls back to polling)
+        """
+        self.setup = setup
+        self.root = setup.root_dir
+        self.probe_interval = probe_interval
+        self.settle_delay = settle_delay
+        self.state = load_state(self.root)
+        if self.state is None:
+            raise RuntimeError(f"No provisioning state in {self.root}; run 'stackops setup' first")
+        if 'settings' in self.state:
+            # Repairs render the configuration the host was provisioned with
+            setup.settings = Settings(self.state['settings'])
+        else:
+            logger.warning("Provisioning state has no settings; re-applied steps use this environment's")
+
+        self.watcher: Optional[Inotify] = None
+        if use_inotify:
+            try:
+                self.watcher = Inotify()
+            except OSError as e:
+                logger.warning(f"inotify unavailable ({e}); checking files every {probe_interval:.0f}s")
+
+    @property
+    def managed_steps(self) -> Set[str]:
+        return set(self.state.get('steps', []))
+
+    def managed_files(self) -> Dict[str, str]:
+        return {rel: step for rel, step in MANAGED_FILES.items() if step in self.managed_steps}
+
+    def managed_services(self) -> Dict[str, str]:
+        return {unit: step for unit, step in MANAGED_SERVICES.items() if step in self.managed_steps}
+
+    def watch_files(self) -> None:
+        """(Re-)add inotify watches on the directories holding managed files"""
+        if self.watcher is None:
+            return
+        watched = set(self.watcher.watches.values())
+        for rel in self.managed_files():
+            directory = (self.root / rel).parent
+            if directory not in watched and directory.is_dir():
+                self.watcher.add_watch(directory)
+                watched.add(directory)
+
+    def detect_file_drift(self, paths: Optional[List[str]] = None) -> Dict[str, str]:
+        """
+        Compare managed files with the digests recorded at provisioning
+
+        Args:
+            paths: Relative paths to check (all managed files if omitted)
+
+        Returns:
+            Drifted relative path -> owning step
+        """
+        baseline = self.state.get('files', {})
+        drifted = {}
+        for rel, step in self.managed_files().items():
+            if paths is not None and rel not in paths:
+                continue
+            if rel in baseline and file_digest(self.root / rel) != baseline[rel]:
+                drifted[rel] = step
+        return drifted
+
+    def _command(self, *args: str) -> bool:
+        result = subprocess.run(list(args), env=self.setup.command_env(),
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return result.returncode == 0
+
+    def _systemctl(self, *args: str) -> bool:
+        return self._command('systemctl', *args)
+
+    def detect_service_drift(self) -> Dict[str, str]:
+        """Return inactive managed units -> owning step"""
+        return {unit: step for unit, step in self.managed_services().items()
+                if not self._systemctl('is-active', '--quiet', unit)}
+
+    def restore_files(self, drifted_files: Dict[str, str]) -> Tuple[Dict[str, str], bool]:
+        """
+        Put drifted files back from their provisioned copies
+
+        Files are restored per service; the service's configuration test
+        must pass before it is reloaded. If the test or the reload fails
+        the edited files are put back, so the drift stays reported.
+
+        Returns:
+            Files without a copy (relative path -> owning step), and whether
+            every restored file was loaded
+        """
+        missing = {}
+        by_service: Dict[Optional[str], List[str]] = {}
+        for rel, step in drifted_files.items():
+            if baseline_copy(self.root, rel) is None:
+                missing[rel] = step
+            else:
+                by_service.setdefault(file_service(rel), []).append(rel)
+
+        success = True
+        for service, rels in by_service.items():
+            edited = {}
+            for rel in rels:
+                path = self.root / rel
+                edited[rel] = path.read_bytes() if path.is_file() else None
+                path.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy2(baseline_copy(self.root, rel), path)
+
+            test = CONFIG_TESTS.get(service)
+            if test and not self._command(*test):
+                logger.error(f"'{' '.join(test)}' failed with restored {', '.join(rels)}; leaving the edits")
+            elif service in RELOADS and not self._systemctl(*RELOADS[service]):
+                logger.error(f"Could not reload {service} after restoring {', '.join(rels)}; leaving the edits")
+            else:
+                logger.info(f"Restored {', '.join(rels)}")
+                continue
+
+            success = False
+            for rel, content in edited.items():
+                if content is None:
+                    (self.root / rel).unlink()
+                else:
+                    (self.root / rel).write_bytes(content)
+        return missing, success
+
+    def reconcile(self, drifted_files: Dict[str, str], drifted_services: Dict[str, str]) -> bool:
+        """
+        Bring drifted pieces back with as little disruption as possible
+
+        Drifted files are restored one by one from their provisioned copies.
+        Stopped services are restarted. Only what neither fixes (a unit
+        that won't come back, a file with no copy) re-runs the owning step.
+        """
+        for rel in drifted_files:
+            logger.warning(f"Drift detected: {rel} changed since provisioning")
+
+        missing, restored = self.restore_files(drifted_files)
+        # Last resort: the whole step, for files provisioned before copies were kept
+        steps_to_apply = set(missing.values())
+        for unit, step in drifted_services.items():
+            logger.warning(f"Drift detected: {unit} is not active")
+            if self._systemctl('restart', unit) and self._systemctl('is-active', '--quiet', unit):
+                logger.info(f"Restarted {unit}")
+            else:
+                steps_to_apply.add(step)
+
+        if not steps_to_apply:
+            return restored
+
+        # The runner token is single-use and never stored, so that step can't be replayed
+        steps = [step for step in self.setup.build_steps(self.state['domain'], self.state['email'])
+                 if step.name in steps_to_apply]
+        for name in sorted(steps_to_apply - {step.name for step in steps}):
+            logger.error(f"Cannot re-apply step '{name}' automatically")
+
+        if not steps:
+            return False
+        # A 'stackops setup' run since the agent started may have removed the scripts
+        if not install_scripts(self.setup.scripts_dir):
+            logger.error("Cannot re-apply steps: failed to install scripts")
+            return False
+        logger.info(f"Re-applying step(s): {', '.join(step.name for step in steps)}")
+        success = self.setup.run_steps(steps) and len(steps) == len(steps_to_apply) and restored
+
+        # Whatever the successful steps rendered is the new baseline; files of
+        # failed or skipped steps keep the old digests so they are retried
+        succeeded = [name for name in self.setup.step_timings if self.setup.step_results.get(name)]
+        save_baseline(self.root, succeeded)
+        self.state['files'].update(snapshot_files(self.root, succeeded))
+        save_state(self.root, self.state)
+        return success
+
+    def run_once(self) -> bool:
+        """Check every managed file and service once and reconcile"""
+        return self.reconcile(self.detect_file_drift(), self.detect_service_drift())
+
+    def run(self, stop_event: Optional[threading.Event] = None) -> None:
+        """
+        Watch until stop_event is set
+
+        Sleeps in select() between events and probes, so an idle agent
+        costs no CPU.
+        """
+        stop_event = stop_event or threading.Event()
+        logger.info(f"Drift agent watching {len(self.managed_files())} file(s) "
+                    f"and {len(self.managed_services())} service(s)")
+        self.run_once()
+        self.watch_files()
+        next_probe = time.monotonic() + self.probe_interval
+
+        try:
+            while not stop_event.is_set():
+                timeout = max(0.0, next_probe - time.monotonic())
+                if self.watcher is None:
+                    stop_event.wait(timeout)
+                    events = []
+                else:
+                    # Wake at least once a second to notice stop_event
+                    events = self.watcher.read(min(timeout, 1.0))
+
+                if events:
+                    changed = self._collect_changes(events)
+                    drifted = self.detect_file_drift(changed)
+                    if drifted:
+                        self.reconcile(drifted, {})
+
+                if time.monotonic() >= next_probe:
+                    if self.watcher is None:
+                        self.run_once()
+                    else:
+                        self.reconcile({}, self.detect_service_drift())
+                        self.watch_files()
+                    next_probe = time.monotonic() + self.probe_interval
+        finally:
+            if self.watcher is not None:
+                self.watcher.close()
+
+    def _collect_changes(self, events: List[Tuple[Path, str, int]]) -> List[str]:
+        """Debounce events and return the managed paths they touched"""
+        changed = set()
+        while events:
+            for directory, name, _mask in events:
+                try:
+                    changed.add((directory / name).relative_to(self.root).as_posix())
+                except ValueError:
+                    continue
+            events = self.watcher.read(self.settle_delay)
+        return [rel for rel in changed if rel in MANAGED_FILES]
@@ -0,0 +1,247 @@
+# src/stackops/assets.py
+import gzip
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; .br files are skipped without it
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Default static root served by the application vhost
+DEFAULT_STATIC_ROOT = Path("/var/www/app/static")
+
+# Build state, kept next to the assets so rebuilds can skip unchanged files
+MANIFEST_NAME = ".stackops-assets.json"
+
+# Only text-like formats benefit from compression
+COMPRESSIBLE_EXTENSIONS = {
+    '.html', '.htm', '.css', '.js', '.mjs', '.json', '.map', '.svg',
+    '.xml', '.txt', '.csv', '.ico', '.wasm', '.webmanifest', '.ttf', '.otf',
+}
+
+# Files smaller than this fit in a single packet anyway
+MIN_SIZE = 256
+
+ENCODING_SUFFIXES = {'gzip': '.gz', 'br': '.br'}
+
+
+def available_encodings(use_brotli: bool = True) -> List[str]:
+    """Return the encodings that can be produced in this environment"""
+    encodings = ['gzip']
+    if use_brotli and brotli is not None:
+        encodings.append('br')
+    return encodings
+
+
+def _file_digest(path: Path) -> str:
+    """Return the sha256 hex digest of a file"""
+    digest = hashlib.sha256()
+    with path.open('rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _compress(data: bytes, encoding: str) -> bytes:
+    if encoding == 'gzip':
+        # mtime=0 keeps output byte-identical across rebuilds
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    return brotli.compress(data, quality=11)
+
+
+def _write_atomic(target: Path, data: bytes, mtime_ns: int) -> None:
+    """Write data next to target and move it into place in one step"""
+    tmp_path = target.with_name(f".{target.name}.tmp")
+    tmp_path.write_bytes(data)
+    # Match the source mtime so nginx and the next build see them as paired
+    os.utime(tmp_path, ns=(mtime_ns, mtime_ns))
+    os.replace(tmp_path, target)
+
+
+def compress_file(path: str, encodings: List[str], previous: Optional[Dict] = None) -> Dict:
+    """
+    Precompress a single file (runs in a worker process)
+
+    Args:
+        path: Absolute path of the source file
+        encodings: Encodings to produce ('gzip', 'br')
+        previous: Manifest entry from the last build, if any
+
+    Returns:
+        New manifest entry with an extra 'status' key
+        ('compressed', 'unchanged' or 'failed')
+    """
+    source = Path(path)
+    try:
+        stat = source.stat()
+        digest = _file_digest(source)
+        entry = {
+            'sha256': digest,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'encodings': list(encodings),
+            'outputs': [],
+        }
+
+        # Content unchanged (e.g. re-copied by a deploy): just re-pair mtimes
+        if (previous and previous.get('sha256') == digest
+                and set(encodings) <= set(previous.get('encodings', []))
+                and all(Path(path + ENCODING_SUFFIXES[e]).exists()
+                        for e in previous.get('outputs', []))):
+            for enc in previous.get('outputs', []):
+                os.utime(path + ENCODING_SUFFIXES[enc], ns=(stat.st_mtime_ns, stat.st_mtime_ns))
+            entry['outputs'] = list(previous.get('outputs', []))
+            entry['status'] = 'unchanged'
+            return entry
+
+        data = source.read_bytes()
+        for enc in encodings:
+            target = Path(path + ENCODING_SUFFIXES[enc])
+            compressed = _compress(data, enc)
+            if len(compressed) < len(data):
+                _write_atomic(target, compressed, stat.st_mtime_ns)
+                entry['outputs'].append(enc)
+            elif target.exists():
+                # A larger "compressed" copy would only slow responses down
+                target.unlink()
+
+        entry['status'] = 'compressed'
+        return entry
+
+    except Exception as e:
+        return {'status': 'failed', 'error': str(e)}
+
+
+def iter_assets(static_root: Path) -> Iterator[Path]:
+    """Yield files under static_root that are worth precompressing"""
+    for dirpath, dirnames, filenames in os.walk(static_root):
+        # Skip hidden directories such as .git
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        for name in filenames:
+            path = Path(dirpath) / name
+            if name.startswith('.') or path.suffix.lower() not in COMPRESSIBLE_EXTENSIONS:
+                continue
+            try:
+                if path.is_symlink() or path.stat().st_size < MIN_SIZE:
+                    continue
+            except OSError:
+                continue
+            yield path
+
+
+def load_manifest(static_root: Path) -> Dict[str, Dict]:
+    """Load the build manifest, returning an empty one if missing or corrupt"""
+    manifest_path = static_root / MANIFEST_NAME
+    try:
+        return json.loads(manifest_path.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(static_root: Path, manifest: Dict[str, Dict]) -> None:
+    """Persist the build manifest atomically"""
+    manifest_path = static_root / MANIFEST_NAME
+    tmp_path = manifest_path.with_name(manifest_path.name + '.tmp')
+    tmp_path.write_text(json.dumps(manifest, indent=1, sort_keys=True))
+    os.replace(tmp_path, manifest_path)
+
+
+def _is_fresh(path: Path, entry: Optional[Dict], encodings: List[str]) -> bool:
+    """Cheap stat-only check that a file was already compressed as requested"""
+    if not entry:
+        return False
+    try:
+        stat = path.stat()
+    except OSError:
+        return False
+    if stat.st_mtime_ns != entry.get('mtime_ns') or stat.st_size != entry.get('size'):
+        return False
+    if not set(encodings) <= set(entry.get('encodings', [])):
+        return False
+    return all(Path(str(path) + ENCODING_SUFFIXES[e]).exists() for e in entry.get('outputs', []))
+
+
+def build_assets(static_root: Path,
+                 workers: Optional[int] = None,
+                 use_brotli: bool = True) -> Dict[str, int]:
+    """
+    Precompress changed static assets to .gz and .br for nginx *_static
+
+    Args:
+        static_root: Directory to walk
+        workers: Number of worker processes (defaults to CPU count)
+        use_brotli: Produce .br files when the brotli module is installed
+
+    Returns:
+        Counters for compressed, unchanged, skipped, removed and failed files
+    """
+    static_root = Path(static_root)
+    encodings = available_encodings(use_brotli)
+    if use_brotli and 'br' not in encodings:
+        logger.warning("brotli module not installed - only .gz files will be built")
+
+    manifest = load_manifest(static_root)
+    stats = {'compressed': 0, 'unchanged': 0, 'skipped': 0, 'removed': 0, 'failed': 0}
+
+    pending: Dict[str, Path] = {}
+    seen = set()
+    for path in iter_assets(static_root):
+        rel = path.relative_to(static_root).as_posix()
+        seen.add(rel)
+        if _is_fresh(path, manifest.get(rel), encodings):
+            stats['skipped'] += 1
+        else:
+            pending[rel] = path
+
+    # Drop outputs whose source file has gone away
+    for rel in set(manifest) - seen:
+        for enc in manifest[rel].get('outputs', []):
+            stale = static_root / (rel + ENCODING_SUFFIXES[enc])
+            if stale.exists():
+                stale.unlink()
+        del manifest[rel]
+        stats['removed'] += 1
+
+    if pending:
+        logger.info(f"Precompressing {len(pending)} file(s) in {static_root}")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            try:
+                for rel, path in pending.items():
+                    futures[rel] = executor.submit(compress_file, str(path), encodings, manifest.get(rel))
+            except BrokenProcessPool:
+                pass  # the files not submitted are reported as failed below
+            for rel in pending:
+                try:
+                    entry = futures[rel].result()
+                except (KeyError, BrokenProcessPool):
+                    # A worker died (e.g. OOM-killed); the file is retried on the next build
+                    entry = {'status': 'failed', 'error': 'worker process terminated abruptly'}
+                status = entry.pop('status')
+                stats[status] += 1
+                if status == 'failed':
+                    logger.error(f"Failed to compress {rel}: {entry['error']}")
+                    manifest.pop(rel, None)
+                    # Outputs of the previous content would keep being served for the new source
+                    for suffix in ENCODING_SUFFIXES.values():
+                        stale = static_root / (rel + suffix)
+                        if stale.exists():
+                            stale.unlink()
+                else:
+                    manifest[rel] = entry
+
+    save_manifest(static_root, manifest)
+    logger.info(
+        f"Assets: {stats['compressed']} compressed, {stats['unchanged']} unchanged, "
+        f"{stats['skipped']} up to date, {stats['removed']} removed, {stats['failed']} failed"
+    )
+    return stats
@@ -0,0 +1,406 @@
+# src/stackops/bundle.py
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import socket
+import subprocess
+import tarfile
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import unquote
+
+from stackops.settings import Settings
+from stackops.setup_manager import ServerSetup
+from stackops.state import MANAGED_SERVICES, load_state
+
+logger = logging.getLogger(__name__)
+
+BUNDLE_FORMAT = 1
+MANIFEST_NAME = "manifest.json"
+
+# Packages the provisioning scripts install
+BUNDLE_PACKAGES = (
+    'nginx', 'ufw', 'fail2ban', 'nftables', 'python3-systemd', 'libnginx-mod-http-brotli-static',
+    'ca-certificates', 'curl', 'gnupg', 'software-properties-common',
+    'docker-ce', 'docker-ce-cli', 'containerd.io', 'docker-buildx-plugin', 'docker-compose-plugin',
+    'certbot', 'python3-certbot-nginx',
+)
+
+# Rendered configuration captured from the source host (relative to the root).
+# The vhost, renewal cron and certificate are host-specific and are produced
+# by re-running the nginx_ssl step on the target instead.
+BUNDLE_FILES = (
+    'etc/nginx/nginx.conf',
+    'etc/nginx/sites-available/default',
+    'etc/nginx/conf.d/brotli-static.conf',
+    'etc/fail2ban/jail.local',
+    'etc/fail2ban/filter.d/stackops-nginx-4xx.conf',
+    'etc/ufw/ufw.conf',
+    'etc/ufw/user.rules',
+    'etc/ufw/user6.rules',
+    'etc/apt/keyrings/docker.gpg',
+    'etc/apt/sources.list.d/docker.list',
+    'var/www/html/index.html',
+)
+
+# Package, version, status and whether every Ubuntu image already has it
+DPKG_QUERY_FORMAT = '${Package}\\t${Version}\\t${db:Status-Abbrev}\\t${Essential}\\t${Priority}\\n'
+
+DEB_CACHE = "var/cache/apt/archives"
+# Large downloads (e.g. the runner tarball) the scripts can reuse
+DOWNLOAD_CACHE = "var/cache/stackops"
+
+# Non-file state the steps leave behind, replayed on apply
+STEP_COMMANDS = {
+    'docker': [['usermod', '-a', '-G', 'docker', 'ubuntu']],
+}
+
+# Steps whose results a bundle carries
+BUNDLED_STEPS = ('initial', 'docker')
+
+
+class BundleError(Exception):
+    """Raised when a bundle cannot be exported or applied"""
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open('rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def template_out(data: bytes, variables: Dict[str, str]) -> Optional[bytes]:
+    """Replace per-host values with {{NAME}} placeholders; None if nothing matched or binary"""
+    try:
+        text = data.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+    templated = text
+    # Longest values first so an email containing the domain is replaced whole
+    for name, value in sorted(variables.items(), key=lambda item: -len(item[1])):
+        if value:
+            templated = templated.replace(value, '{{' + name + '}}')
+    return templated.encode('utf-8') if templated != text else None
+
+
+def render_template(data: bytes, variables: Dict[str, str]) -> bytes:
+    """Fill {{NAME}} placeholders with this host's values"""
+    text = data.decode('utf-8')
+    for name, value in variables.items():
+        text = text.replace('{{' + name + '}}', value)
+    return text.encode('utf-8')
+
+
+def parse_dpkg_query(output: str) -> Dict[str, Tuple[str, bool]]:
+    """
+    Parse dpkg-query -W output in DPKG_QUERY_FORMAT
+
+    Returns:
+        Installed package -> (version, part of the base system)
+    """
+    packages = {}
+    for line in output.splitlines():
+        fields = line.split('\t')
+        if len(fields) < 5 or not fields[1] or not fields[2].startswith('ii'):
+            continue
+        packages[fields[0]] = (fields[1], fields[3] == 'yes' or fields[4] == 'required')
+    return packages
+
+
+def parse_deb_name(filename: str) -> Optional[tuple]:
+    """Split name_version_arch.deb into (name, version)"""
+    match = re.match(r'^([^_]+)_([^_]+)_[^_]+\.deb$', filename)
+    if not match:
+        return None
+    return match.group(1), unquote(match.group(2))
+
+
+class BundleBuilder:
+    """Capture a provisioned host into a single checksummed archive"""
+
+    def __init__(self, setup: ServerSetup):
+        self.setup = setup
+        self.root = setup.root_dir
+
+    def _run(self, args: List[str], **kwargs) -> subprocess.CompletedProcess:
+        return subprocess.run(args, env=self.setup.command_env(), text=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+
+    def dependency_closure(self) -> List[str]:
+        """The managed packages plus every installed package they depend on"""
+        result = self._run(['apt-cache', 'depends', '--recurse', '--installed', '--no-recommends',
+                            '--no-suggests', '--no-conflicts', '--no-breaks', '--no-replaces',
+                            '--no-enhances', *BUNDLE_PACKAGES])
+        if result.returncode != 0:
+            raise BundleError(f"Cannot resolve package dependencies: {result.stderr.strip()}")
+        # Each package reached is printed unindented; <name> lines are virtual packages
+        closure = dict.fromkeys(BUNDLE_PACKAGES)
+        for line in result.stdout.splitlines():
+            if line and not line[0].isspace() and not line.startswith('<'):
+                closure[line.strip()] = None
+        return list(closure)
+
+    def package_versions(self) -> Dict[str, str]:
+        """
+        Installed versions of the managed packages and their dependencies
+
+        Essential and required packages are left out: every Ubuntu image
+        ships them.
+        """
+        result = self._run(['dpkg-query', f"--showformat={DPKG_QUERY_FORMAT}", '-W', *self.dependency_closure()])
+        return {name: version for name, (version, base) in parse_dpkg_query(result.stdout).items() if not base}
+
+    def collect_debs(self, versions: Dict[str, str], download_dir: Path) -> List[Path]:
+        """
+        .deb files for exactly the installed versions, from the apt cache or downloaded
+
+        Raises:
+            BundleError: If a package can't be found, as the bundle could not be installed offline
+        """
+        cache = self.root / DEB_CACHE
+        available = sorted(cache.glob('*.deb')) if cache.is_dir() else []
+        debs = {parse_deb_name(deb.name): deb for deb in available}
+        wanted = set(versions.items())
+
+        missing = [f"{name}={version}" for name, version in versions.items() if (name, version) not in debs]
+        if missing:
+            logger.info(f"Downloading {len(missing)} package(s) missing from the apt cache")
+            result = self._run(['apt-get', 'download', *missing], cwd=str(download_dir))
+            if result.returncode != 0:
+                logger.warning(f"Some packages could not be downloaded: {result.stderr.strip()}")
+            debs.update({parse_deb_name(deb.name): deb for deb in sorted(download_dir.glob('*.deb'))})
+
+        unavailable = sorted(f"{name}={version}" for name, version in wanted if (name, version) not in debs)
+        if unavailable:
+            raise BundleError(f"No .deb available for {', '.join(unavailable)}")
+        return [debs[key] for key in sorted(wanted)]
+
+    def enabled_units(self, steps: List[str]) -> List[str]:
+        units = [unit for unit, step in MANAGED_SERVICES.items() if step in steps and step in BUNDLED_STEPS]
+        if (self.root / 'etc/ufw/ufw.conf').exists():
+            units.append('ufw')
+        return [unit for unit in units if self._run(['systemctl', 'is-enabled', '--quiet', unit]).returncode == 0]
+
+    def export(self, output: Path) -> Path:
+        """
+        Write the bundle and its .sha256 sidecar
+
+        Args:
+            output: Path of the .tar.gz to create
+
+        Returns:
+            Path of the written bundle
+        """
+        state = load_state(self.root)
+        if state is None:
+            raise BundleError(f"No provisioning state in {self.root}; run 'stackops setup' first")
+
+        variables = {'DOMAIN': state['domain'], 'EMAIL': state['email']}
+        steps = [step for step in state['steps'] if step in BUNDLED_STEPS]
+        versions = self.package_versions()
+        checksums: Dict[str, str] = {}
+        manifest = {
+            'format': BUNDLE_FORMAT,
+            'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'source_host': socket.gethostname(),
+            'steps': steps,
+            # The bundled configs were rendered with these; the target renders the rest with them too
+            'settings': state.get('settings'),
+            'packages': versions,
+            'debs': [],
+            'files': [],
+            'cache': [],
+            'units': self.enabled_units(steps),
+            'commands': [command for step in steps for command in STEP_COMMANDS.get(step, [])],
+            'checksums': checksums,
+        }
+
+        output = Path(output)
+        output.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory() as download_dir:
+            # Resolve every package before writing, so a failure leaves no partial bundle
+            debs = self.collect_debs(versions, Path(download_dir))
+            with tarfile.open(output, 'w:gz', compresslevel=6) as tar:
+
+                def add_path(source: Path, arcname: str) -> None:
+                    checksums[arcname] = _file_sha256(source)
+                    tar.add(str(source), arcname=arcname, recursive=False)
+
+                def add_bytes(data: bytes, arcname: str, mode: int = 0o644) -> None:
+                    checksums[arcname] = _sha256(data)
+                    info = tarfile.TarInfo(arcname)
+                    info.size = len(data)
+                    info.mode = mode
+                    info.mtime = int(time.time())
+                    tar.addfile(info, io.BytesIO(data))
+
+                for deb in debs:
+                    arcname = f"debs/{deb.name}"
+                    if arcname not in checksums:
+                        add_path(deb, arcname)
+                        manifest['debs'].append(arcname)
+
+                for rel in BUNDLE_FILES:
+                    source = self.root / rel
+                    if not source.is_file():
+                        continue
+                    mode = source.stat().st_mode & 0o7777
+                    data = source.read_bytes()
+                    templated = template_out(data, variables)
+                    add_bytes(templated if templated is not None else data, f"files/{rel}", mode)
+                    manifest['files'].append({'path': rel, 'mode': mode, 'template': templated is not None})
+
+                download_cache = self.root / DOWNLOAD_CACHE
+                if download_cache.is_dir():
+                    for cached in sorted(download_cache.iterdir()):
+                        if cached.is_file():
+                            rel = f"{DOWNLOAD_CACHE}/{cached.name}"
+                            add_path(cached, f"files/{rel}")
+                            manifest['cache'].append(rel)
+
+                add_bytes(json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'), MANIFEST_NAME)
+
+        digest = _file_sha256(output)
+        Path(str(output) + '.sha256').write_text(f"{digest}  {output.name}\n")
+        logger.info(f"Bundle written to {output} ({len(manifest['debs'])} packages, "
+                    f"{len(manifest['files'])} files, sha256 {digest[:12]})")
+        return output
+
+
+class BundleApplier:
+    """Restore a bundle onto a fresh host using local installs only"""
+
+    def __init__(self, setup: ServerSetup):
+        self.setup = setup
+        self.root = setup.root_dir
+
+    def _run(self, args: List[str], check: bool = True) -> subprocess.CompletedProcess:
+        env = self.setup.command_env({'DEBIAN_FRONTEND': 'noninteractive'})
+        result = subprocess.run(args, env=env, text=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if check and result.returncode != 0:
+            raise BundleError(f"{' '.join(args)} failed: {result.stdout.strip()}")
+        return result
+
+    @staticmethod
+    def verify_archive(bundle: Path) -> None:
+        """Check the archive against its .sha256 sidecar, if present"""
+        sidecar = Path(str(bundle) + '.sha256')
+        if not sidecar.exists():
+            logger.warning(f"No checksum file next to {bundle}; relying on member checksums only")
+            return
+        expected = sidecar.read_text().split()[0]
+        if _file_sha256(bundle) != expected:
+            raise BundleError(f"{bundle} does not match {sidecar.name}")
+
+    @staticmethod
+    def extract(bundle: Path, destination: Path) -> Dict:
+        """Extract the bundle, verifying every member against the manifest"""
+        with tarfile.open(bundle, 'r:gz') as tar:
+            try:
+                manifest = json.loads(tar.extractfile(MANIFEST_NAME).read())
+            except (KeyError, ValueError) as e:
+                raise BundleError(f"{bundle} has no valid manifest: {e}")
+            if manifest.get('format') != BUNDLE_FORMAT:
+                raise BundleError(f"Unsupported bundle format {manifest.get('format')}")
+
+            for member in tar.getmembers():
+                if member.name == MANIFEST_NAME:
+                    continue
+                target = (destination / member.name).resolve()
+                if not member.isfile() or destination.resolve() not in target.parents:
+                    raise BundleError(f"Refusing to extract {member.name}")
+                data = tar.extractfile(member).read()
+                if _sha256(data) != manifest['checksums'].get(member.name):
+                    raise BundleError(f"Checksum mismatch for {member.name}")
+                target.parent.mkdir(parents=True, exist_ok=True)
+                target.write_bytes(data)
+        return manifest
+
+    def install_packages(self, staging: Path, manifest: Dict) -> int:
+        """
+        Install the bundled packages that aren't already installed at that version
+
+        apt-get orders and resolves them; --no-download makes a dependency
+        missing from the bundle an error instead of a fetch.
+        """
+        debs = [staging / name for name in manifest['debs']]
+        parsed = {deb: parse_deb_name(deb.name) for deb in debs}
+        names = sorted({item[0] for item in parsed.values() if item})
+
+        installed = {}
+        if names:
+            result = self._run(['dpkg-query', f"--showformat={DPKG_QUERY_FORMAT}", '-W', *names], check=False)
+            installed = {name: version for name, (version, _base) in parse_dpkg_query(result.stdout).items()}
+
+        needed = [str(deb) for deb, item in parsed.items() if not item or installed.get(item[0]) != item[1]]
+        if needed:
+            logger.info(f"Installing {len(needed)} package(s) from the bundle")
+            self._run(['apt-get', 'install', '-y', '--no-download',
+                       '-o', 'Dpkg::Options::=--force-confold', *needed])
+        return len(needed)
+
+    def restore_files(self, staging: Path, manifest: Dict, variables: Dict[str, str]) -> None:
+        for entry in manifest['files']:
+            data = (staging / 'files' / entry['path']).read_bytes()
+            if entry['template']:
+                data = render_template(data, variables)
+            target = self.root / entry['path']
+            target.parent.mkdir(parents=True, exist_ok=True)
+            target.write_bytes(data)
+            os.chmod(target, entry['mode'])
+
+        for rel in manifest['cache']:
+            target = self.root / rel
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(staging / 'files' / rel, target)
+
+    def apply(self, bundle: Path, domain: str, email: str) -> bool:
+        """
+        Restore the bundle, then run the host-specific nginx/SSL step
+
+        Args:
+            bundle: Path to the bundle .tar.gz
+            domain: Domain name for this host
+            email: Email for SSL certificate
+        """
+        started = time.perf_counter()
+        bundle = Path(bundle)
+        self.verify_archive(bundle)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            staging = Path(tmp)
+            manifest = self.extract(bundle, staging)
+            if manifest.get('settings'):
+                self.setup.settings = Settings(manifest['settings'])
+            self.install_packages(staging, manifest)
+            self.restore_files(staging, manifest, {'DOMAIN': domain, 'EMAIL': email})
+
+        for command in manifest['commands']:
+            self._run(command)
+        self._run(['systemctl', 'daemon-reload'])
+        for unit in manifest['units']:
+            self._run(['systemctl', 'enable', unit])
+            self._run(['systemctl', 'restart', unit])
+
+        # Certificates and the vhost are per host; this is the only step that needs the network
+        steps = [step for step in self.setup.build_steps(domain, email)
+                 if step.name not in manifest['steps']]
+        if not self.setup.run_steps(steps):
+            return False
+
+        self.setup.record_state(domain, email, manifest['steps'] + [step.name for step in steps])
+        logger.info(f"Bundle applied in {time.perf_counter() - started:.1f}s")
+        return True
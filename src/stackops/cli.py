@@ -1,6 +1,8 @@
 # src/server_setup/cli.py
 import click
+import signal
 import sys
+import threading
 from pathlib import Path
 
 # Add src to Python path
@@ -10,6 +12,11 @@ if src_path not in sys.path:
 
 from stackops.setup_manager import ServerSetup
 from stackops.utils import install_scripts
+from stackops.assets import DEFAULT_STATIC_ROOT, available_encodings, build_assets
+from stackops.preflight import CheckResult, default_checks, run_preflight
+from stackops.agent import PROBE_INTERVAL, DriftAgent
+from stackops.bundle import BundleApplier, BundleBuilder, BundleError
+from stackops.deploy import Deployer
 
 def clear_screen():
     """Clear the terminal screen"""
@@ -31,6 +38,15 @@ def print_welcome_message():
     • GitHub Actions Runner (optional)
     """, fg='bright_black'))
 
+def print_preflight_report(report):
+    """Print preflight results, one colored line per check"""
+    colors = {CheckResult.PASS: 'green', CheckResult.WARN: 'yellow', CheckResult.FAIL: 'red'}
+    lines = report.format().splitlines()
+    click.echo()
+    for result, line in zip(report.results, lines):
+        click.echo(click.style(line, fg=colors[result.status]))
+    click.echo(click.style(lines[-1], fg='green' if report.ok else 'red'))
+
 
 @click.group()
 def cli():
@@ -38,7 +54,10 @@ def cli():
     pass
 
 @cli.command()
-def setup():
+@click.option('--jobs', '-j', type=int, default=1, show_default=True,
+              help='Run up to N independent setup steps at once')
+@click.option('--skip-preflight', is_flag=True, help='Do not run preflight checks')
+def setup(jobs, skip_preflight):
     """Interactive server setup process"""
     try:
         # Clear screen and show welcome message
@@ -51,7 +70,7 @@ def setup():
             default=True
         ):
             # Create setup manager instance (this will clean up previous setup)
-            setup_manager = ServerSetup()
+            setup_manager = ServerSetup(max_workers=jobs, clean_scripts=True)
             
             # Install required scripts
             if not install_scripts(setup_manager.scripts_dir):
@@ -75,6 +94,14 @@ def setup():
                 type=str
             )
             
+            # Fail fast before any heavy work
+            if not skip_preflight:
+                report = setup_manager.preflight(domain)
+                print_preflight_report(report)
+                if not report.ok:
+                    click.echo(click.style("Fix the problems above or rerun with --skip-preflight.", fg='red'))
+                    return
+            
             # Ask about GitHub runner
             if click.confirm(
                 click.style("\n🤖 Do you want to set up GitHub Actions Runner?", fg='bright_blue'),
@@ -103,7 +130,8 @@ def setup():
                     success = setup_manager.run_setup(
                         domain=domain,
                         email=email,
-                        github_token=github_token
+                        github_token=github_token,
+                        preflight_checks=[]  # already ran above
                     )
                     bar.update(4)
                 
@@ -121,5 +149,147 @@ def setup():
     except Exception as e:
         click.echo(click.style(f"\nError: {str(e)}", fg='red'))
 
+@cli.command()
+@click.argument('domain')
+@click.option('--timeout', type=float, default=5.0, show_default=True, help='Seconds allowed per check')
+def preflight(domain, timeout):
+    """Check that this host is ready to be set up for DOMAIN"""
+    report = run_preflight(default_checks(domain, timeout=timeout))
+    print_preflight_report(report)
+    if not report.ok:
+        sys.exit(1)
+
+@cli.command()
+@click.option('--interval', type=float, default=PROBE_INTERVAL, show_default=True,
+              help='Seconds between service probes')
+@click.option('--once', is_flag=True, help='Check and reconcile once, then exit')
+def agent(interval, once):
+    """Watch provisioned files and services and repair drift"""
+    setup_manager = ServerSetup()
+    if not install_scripts(setup_manager.scripts_dir):
+        click.echo(click.style("Failed to install required scripts.", fg='red'))
+        sys.exit(1)
+    
+    try:
+        drift_agent = DriftAgent(setup_manager, probe_interval=interval)
+    except RuntimeError as e:
+        click.echo(click.style(str(e), fg='red'))
+        sys.exit(1)
+    
+    if once:
+        sys.exit(0 if drift_agent.run_once() else 1)
+    
+    # Stop cleanly under systemd
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    try:
+        drift_agent.run(stop_event)
+    except KeyboardInterrupt:
+        pass
+
+@cli.group()
+def assets():
+    """Static asset tools"""
+    pass
+
+@assets.command('build')
+@click.argument('static_root', type=click.Path(exists=True, file_okay=False),
+                default=str(DEFAULT_STATIC_ROOT))
+@click.option('--workers', type=int, default=None, help='Worker processes (default: CPU count)')
+@click.option('--no-brotli', is_flag=True, help='Only build .gz files')
+def assets_build(static_root, workers, no_brotli):
+    """Precompress changed static files to .gz/.br for nginx"""
+    if not no_brotli and 'br' not in available_encodings():
+        click.echo(click.style("brotli module not installed - building .gz files only", fg='yellow'))
+    stats = build_assets(Path(static_root), workers=workers, use_brotli=not no_brotli)
+    click.echo(click.style(
+        f"Compressed {stats['compressed']}, up to date {stats['skipped'] + stats['unchanged']}, "
+        f"removed {stats['removed']}, failed {stats['failed']}",
+        fg='red' if stats['failed'] else 'green'
+    ))
+    if stats['failed']:
+        sys.exit(1)
+
+@cli.group()
+def bundle():
+    """Export a provisioned host and apply it to new ones"""
+    pass
+
+@bundle.command('export')
+@click.argument('output', type=click.Path(dir_okay=False))
+def bundle_export(output):
+    """Write packages, configs and caches of this host to OUTPUT (.tar.gz)"""
+    try:
+        path = BundleBuilder(ServerSetup()).export(Path(output))
+    except BundleError as e:
+        click.echo(click.style(str(e), fg='red'))
+        sys.exit(1)
+    click.echo(click.style(f"Bundle written to {path}", fg='green'))
+
+@bundle.command('apply')
+@click.argument('bundle_path', metavar='BUNDLE', type=click.Path(exists=True, dir_okay=False))
+@click.option('--domain', required=True, help='Domain name for this host')
+@click.option('--email', required=True, help='Email for SSL certificate')
+@click.option('--skip-preflight', is_flag=True, help='Do not run preflight checks')
+def bundle_apply(bundle_path, domain, email, skip_preflight):
+    """Provision this host from BUNDLE without re-downloading packages"""
+    setup_manager = ServerSetup()
+    if not skip_preflight:
+        # The bundle carries the packages, so an offline target is fine
+        report = setup_manager.preflight(domain, default_checks(domain, offline=True))
+        print_preflight_report(report)
+        if not report.ok:
+            sys.exit(1)
+    
+    if not install_scripts(setup_manager.scripts_dir):
+        click.echo(click.style("Failed to install required scripts.", fg='red'))
+        sys.exit(1)
+    
+    try:
+        success = BundleApplier(setup_manager).apply(Path(bundle_path), domain, email)
+    except BundleError as e:
+        click.echo(click.style(str(e), fg='red'))
+        sys.exit(1)
+    
+    if not success:
+        click.echo(click.style("Bundle apply failed. Check the logs for details.", fg='red'))
+        sys.exit(1)
+    click.echo(click.style(f"Host provisioned from {bundle_path}", fg='green'))
+
+@cli.command()
+@click.option('--image', help='Docker image to run for the new release')
+@click.option('--command', 'app_command', help='Shell command starting the app on $PORT (run under systemd)')
+@click.option('--instances', '-n', type=int, default=1, show_default=True, help='Instances to run')
+@click.option('--container-port', type=int, default=3000, show_default=True,
+              help='Port the app listens on inside the container')
+@click.option('--release', help='Release name (default: UTC timestamp)')
+@click.option('--health-timeout', type=float, default=None,
+              help='Seconds each instance has to pass /api/health')
+@click.option('--drain-timeout', type=float, default=None,
+              help='Seconds old instances get to finish requests')
+def deploy(image, app_command, instances, container_port, release, health_timeout, drain_timeout):
+    """Roll out a new release behind nginx without downtime"""
+    if bool(image) == bool(app_command):
+        click.echo(click.style("Pass exactly one of --image or --command", fg='red'))
+        sys.exit(1)
+    
+    deployer = Deployer(ServerSetup())
+    try:
+        success = deployer.deploy(command=app_command, image=image, instances=instances,
+                                  container_port=container_port, release=release,
+                                  health_timeout=health_timeout, drain_timeout=drain_timeout)
+    except (RuntimeError, ValueError) as e:
+        click.echo(click.style(str(e), fg='red'))
+        sys.exit(1)
+    
+    if not success:
+        click.echo(click.style("Deploy aborted; the previous release is still serving.", fg='red'))
+        sys.exit(1)
+    click.echo(click.style("Deploy completed successfully!", fg='green'))
+
+def main():
+    """Console script entry point"""
+    cli()
+
 if __name__ == '__main__':
-    cli()
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -0,0 +1,402 @@
+# src/stackops/deploy.py
+import logging
+import os
+import re
+import socket
+import subprocess
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set
+
+from stackops.setup_manager import ServerSetup
+from stackops.state import load_state, save_state
+
+logger = logging.getLogger(__name__)
+
+# Instances of the current release
+DEPLOY_STATE_PATH = "var/lib/stackops/deploy.json"
+
+# Upstream the vhost proxies to (written by setup.sh, rewritten on every deploy)
+UPSTREAM_NAME = "stackops_app"
+UPSTREAM_PATH = "etc/nginx/conf.d/stackops-upstream.conf"
+
+# Where the app reports readiness
+HEALTH_PATH = "/api/health"
+
+# Where process-mode instances write their output
+APP_LOG_DIR = "var/www/app/logs"
+
+# Process-mode instances run as stackops-app@<release>-<port> from this
+# template, so systemd restarts them after a crash and starts them at boot
+APP_UNIT_PATH = "etc/systemd/system/stackops-app@.service"
+APP_ENV_DIR = "etc/stackops/app"
+
+# Release names end up in unit, container and file names
+RELEASE_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.-]*$')
+
+# Seconds between health probes while warming up
+HEALTH_INTERVAL = 0.25
+
+# Seconds after the reload before old instances may be considered idle, so
+# requests the old nginx workers already accepted reach their backend
+DRAIN_SETTLE = 1.0
+
+# Legacy single backend from before deploys were managed
+LEGACY_PORT = 3002
+
+_TCP_ESTABLISHED = '01'
+
+# Health probes go straight to loopback, never through an http_proxy
+_direct = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+
+class Instance:
+    """One running copy of the application"""
+
+    def __init__(self,
+                 kind: str,
+                 port: int,
+                 release: str,
+                 unit: Optional[str] = None,
+                 container: Optional[str] = None):
+        """
+        Args:
+            kind: 'process' or 'docker'
+            port: Loopback port the instance serves on
+            release: Release the instance belongs to
+            unit: systemd unit name (process instances)
+            container: Container name (docker instances)
+        """
+        self.kind = kind
+        self.port = port
+        self.release = release
+        self.unit = unit
+        self.container = container
+
+    def to_dict(self) -> Dict:
+        return {'kind': self.kind, 'port': self.port, 'release': self.release,
+                'unit': self.unit, 'container': self.container}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'Instance':
+        return cls(data['kind'], data['port'], data['release'], data.get('unit'), data.get('container'))
+
+    def __repr__(self) -> str:
+        return f"Instance({self.kind!r}, port={self.port}, release={self.release!r})"
+
+
+def render_upstream(instances: List[Instance], release: str) -> str:
+    """Render the nginx upstream block for a set of instances"""
+    servers = ''.join(f"    server 127.0.0.1:{instance.port};\n" for instance in instances)
+    return (f"# Managed by stackops deploy - release {release}\n"
+            f"upstream {UPSTREAM_NAME} {{\n{servers}}}\n")
+
+
+def render_app_unit(stop_grace: int) -> str:
+    """Render the template unit process-mode instances run under"""
+    return f"""# Managed by stackops deploy
+[Unit]
+Description=stackops app instance %i
+After=network.target
+
+[Service]
+EnvironmentFile=/etc/stackops/app/%i.env
+ExecStart=/bin/sh -c ${{STACKOPS_APP_COMMAND}}
+User=ubuntu
+WorkingDirectory=/var/www/app
+StandardOutput=append:/var/www/app/logs/app-%i.log
+StandardError=inherit
+Restart=always
+RestartSec=2
+TimeoutStopSec={stop_grace}
+
+[Install]
+WantedBy=multi-user.target
+"""
+
+
+def render_env_file(env: Dict[str, str]) -> str:
+    """Render an EnvironmentFile; the quoting is read the same way by systemd and sh"""
+    lines = []
+    for name, value in env.items():
+        escaped = re.sub(r'(["\\`$])', r'\\\1', value)
+        lines.append(f'{name}="{escaped}"\n')
+    return ''.join(lines)
+
+
+def port_is_free(port: int) -> bool:
+    with socket.socket() as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            s.bind(('127.0.0.1', port))
+        except OSError:
+            return False
+    return True
+
+
+def established_connections(ports: Iterable[int], proc_net: str = '/proc/net') -> int:
+    """Count established TCP connections served on the given local ports"""
+    ports = set(ports)
+    count = 0
+    for name in ('tcp', 'tcp6'):
+        try:
+            lines = Path(proc_net, name).read_text().splitlines()[1:]
+        except OSError:
+            continue
+        for line in lines:
+            fields = line.split()
+            if len(fields) > 3 and fields[3] == _TCP_ESTABLISHED and \
+                    int(fields[1].rsplit(':', 1)[1], 16) in ports:
+                count += 1
+    return count
+
+
+class Deployer:
+    """Roll the application over to a new release without dropping requests"""
+
+    def __init__(self, setup: ServerSetup):
+        """
+        Args:
+            setup: ServerSetup for the host (root, environment and settings)
+        """
+        self.setup = setup
+        self.root = setup.root_dir
+        self.settings = setup.settings
+
+    def _run(self, args: List[str]) -> subprocess.CompletedProcess:
+        return subprocess.run(args, env=self.setup.command_env(), text=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    def current_instances(self) -> List[Instance]:
+        state = load_state(self.root, DEPLOY_STATE_PATH) or {}
+        return [Instance.from_dict(data) for data in state.get('instances', [])]
+
+    def spare_ports(self, count: int, exclude: Set[int]) -> List[int]:
+        """Pick free ports from the deploy range, skipping those in use by the live release"""
+        ports = []
+        for port in range(self.settings.DEPLOY_PORT_MIN, self.settings.DEPLOY_PORT_MAX + 1):
+            if port not in exclude and port_is_free(port):
+                ports.append(port)
+                if len(ports) == count:
+                    return ports
+        raise RuntimeError(f"Not enough free ports in {self.settings.DEPLOY_PORT_MIN}-"
+                           f"{self.settings.DEPLOY_PORT_MAX} for {count} instance(s)")
+
+    def install_app_unit(self) -> None:
+        """Write the instance template unit, reloading systemd when it changed"""
+        path = self.root / APP_UNIT_PATH
+        content = render_app_unit(self.settings.DEPLOY_STOP_GRACE)
+        if path.exists() and path.read_text() == content:
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+        result = self._run(['systemctl', 'daemon-reload'])
+        if result.returncode != 0:
+            raise RuntimeError(f"systemctl daemon-reload failed: {result.stdout.strip()}")
+
+    def start_process(self, command: str, port: int, release: str) -> Instance:
+        """Start the app command as an enabled systemd instance with PORT set"""
+        self.install_app_unit()
+        (self.root / APP_LOG_DIR).mkdir(parents=True, exist_ok=True)
+        name = f"{release}-{port}"
+        env_file = self.root / APP_ENV_DIR / f"{name}.env"
+        env_file.parent.mkdir(parents=True, exist_ok=True)
+        # The command and its environment may hold secrets
+        env_file.touch(mode=0o600)
+        env_file.write_text(render_env_file({
+            'PATH': self.setup.command_env()['PATH'],
+            'PORT': str(port),
+            'STACKOPS_RELEASE': release,
+            'STACKOPS_APP_COMMAND': command,
+        }))
+
+        unit = f"stackops-app@{name}.service"
+        result = self._run(['systemctl', 'enable', '--now', unit])
+        if result.returncode != 0:
+            env_file.unlink()
+            raise RuntimeError(f"Starting {unit} failed: {result.stdout.strip()}")
+        return Instance('process', port, release, unit=unit)
+
+    def start_container(self, image: str, port: int, release: str, container_port: int) -> Instance:
+        """Start the image as a new container published on a loopback port"""
+        name = f"stackops-app-{release}-{port}"
+        result = self._run(['docker', 'run', '-d', '--name', name, '--restart', 'unless-stopped',
+                            '-p', f"127.0.0.1:{port}:{container_port}",
+                            '-e', f"PORT={container_port}", '-e', f"STACKOPS_RELEASE={release}",
+                            image])
+        if result.returncode != 0:
+            raise RuntimeError(f"docker run failed for {name}: {result.stdout.strip()}")
+        return Instance('docker', port, release, container=name)
+
+    def is_running(self, instance: Instance) -> bool:
+        if instance.kind == 'process':
+            # A unit crashing during startup sits in auto-restart, not active
+            return self._run(['systemctl', 'is-active', '--quiet', instance.unit]).returncode == 0
+        result = self._run(['docker', 'inspect', '-f', '{{.State.Running}}', instance.container])
+        return result.returncode == 0 and result.stdout.strip() == 'true'
+
+    def is_healthy(self, instance: Instance) -> bool:
+        url = f"http://127.0.0.1:{instance.port}{HEALTH_PATH}"
+        try:
+            with _direct.open(url, timeout=2) as response:
+                return 200 <= response.status < 300
+        except (urllib.error.URLError, OSError):
+            return False
+
+    def wait_healthy(self, instances: List[Instance], timeout: float) -> bool:
+        """Poll every instance's health endpoint until all pass or the timeout expires"""
+        pending = list(instances)
+        deadline = time.monotonic() + timeout
+        while pending:
+            for instance in list(pending):
+                if self.is_healthy(instance):
+                    logger.info(f"Instance on port {instance.port} is healthy")
+                    pending.remove(instance)
+                elif not self.is_running(instance):
+                    logger.error(f"Instance on port {instance.port} exited during startup")
+                    return False
+            if pending and time.monotonic() >= deadline:
+                logger.error(f"Instance(s) on port(s) {', '.join(str(i.port) for i in pending)} "
+                             f"not healthy after {timeout:.0f}s")
+                return False
+            if pending:
+                time.sleep(HEALTH_INTERVAL)
+        return True
+
+    def reload_nginx(self) -> bool:
+        """Validate the configuration and reload gracefully (old workers finish their requests)"""
+        for args in (['nginx', '-t'], ['systemctl', 'reload', 'nginx']):
+            result = self._run(args)
+            if result.returncode != 0:
+                logger.error(f"{' '.join(args)} failed: {result.stdout.strip()}")
+                return False
+        return True
+
+    def switch_upstream(self, instances: List[Instance], release: str) -> bool:
+        """Point the upstream at the given instances; restores the old file if nginx rejects it"""
+        path = self.root / UPSTREAM_PATH
+        previous = path.read_text() if path.exists() else None
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + '.tmp')
+        tmp_path.write_text(render_upstream(instances, release))
+        os.replace(tmp_path, path)
+        if self.reload_nginx():
+            return True
+
+        if previous is None:
+            path.unlink()
+        else:
+            path.write_text(previous)
+        self.reload_nginx()
+        return False
+
+    def drain(self, instances: List[Instance], timeout: float) -> None:
+        """Wait for connections to old instances to finish, up to timeout seconds"""
+        ports = [instance.port for instance in instances]
+        time.sleep(min(DRAIN_SETTLE, timeout))
+        deadline = time.monotonic() + max(0.0, timeout - DRAIN_SETTLE)
+        while True:
+            active = established_connections(ports)
+            if active == 0:
+                return
+            if time.monotonic() >= deadline:
+                logger.warning(f"Stopping old instances with {active} connection(s) still open")
+                return
+            time.sleep(0.2)
+
+    def stop(self, instance: Instance, grace: float) -> None:
+        """
+        SIGTERM the instance and remove it so it is not restarted
+
+        Process instances are killed by systemd after the unit's
+        TimeoutStopSec (DEPLOY_STOP_GRACE); a grace of 0 kills at once.
+        """
+        logger.info(f"Stopping {instance.kind} instance on port {instance.port} (release {instance.release})")
+        if instance.kind == 'docker':
+            self._run(['docker', 'stop', '--time', str(int(grace)), instance.container])
+            self._run(['docker', 'rm', '-f', instance.container])
+            return
+
+        if grace <= 0:
+            self._run(['systemctl', 'kill', '--signal=SIGKILL', instance.unit])
+        result = self._run(['systemctl', 'disable', '--now', instance.unit])
+        if result.returncode != 0:
+            logger.warning(f"Stopping {instance.unit} failed: {result.stdout.strip()}")
+        env_file = self.root / APP_ENV_DIR / f"{instance.release}-{instance.port}.env"
+        if env_file.exists():
+            env_file.unlink()
+
+    def deploy(self,
+               command: Optional[str] = None,
+               image: Optional[str] = None,
+               instances: int = 1,
+               container_port: int = 3000,
+               release: Optional[str] = None,
+               health_timeout: Optional[float] = None,
+               drain_timeout: Optional[float] = None) -> bool:
+        """
+        Start a release next to the live one and move traffic over
+
+        New instances must pass the health check before nginx is switched;
+        on any failure they are removed and the live release keeps serving.
+
+        Args:
+            command: Shell command starting the app on $PORT (process mode)
+            image: Docker image to run (docker mode)
+            instances: Number of instances to start
+            container_port: Port the app listens on inside the container
+            release: Release name (defaults to a UTC timestamp)
+            health_timeout: Seconds each instance has to become healthy
+            drain_timeout: Seconds old instances get to finish requests
+        """
+        if bool(command) == bool(image):
+            raise ValueError("Exactly one of command or image is required")
+        release = release or datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')
+        if not RELEASE_PATTERN.match(release):
+            raise ValueError(f"Release name {release!r} may only contain letters, digits, '.', '_' and '-'")
+        health_timeout = self.settings.DEPLOY_HEALTH_TIMEOUT if health_timeout is None else health_timeout
+        drain_timeout = self.settings.DEPLOY_DRAIN_TIMEOUT if drain_timeout is None else drain_timeout
+        started = time.perf_counter()
+
+        old = self.current_instances()
+        ports = self.spare_ports(instances, {instance.port for instance in old})
+        logger.info(f"Deploying release {release} on port(s) {', '.join(map(str, ports))}")
+
+        new: List[Instance] = []
+        try:
+            for port in ports:
+                if image:
+                    new.append(self.start_container(image, port, release, container_port))
+                else:
+                    new.append(self.start_process(command, port, release))
+        except (OSError, RuntimeError) as e:
+            logger.error(f"Failed to start release {release}: {e}")
+            ready = False
+        else:
+            ready = self.wait_healthy(new, health_timeout) and self.switch_upstream(new, release)
+
+        if not ready:
+            logger.error(f"Release {release} aborted; traffic stays on the current release")
+            for instance in new:
+                self.stop(instance, 0)
+            return False
+
+        save_state(self.root, {
+            'release': release,
+            'instances': [instance.to_dict() for instance in new],
+            'deployed_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        }, DEPLOY_STATE_PATH)
+
+        if old:
+            self.drain(old, drain_timeout)
+            for instance in old:
+                self.stop(instance, self.settings.DEPLOY_STOP_GRACE)
+        else:
+            logger.info(f"First managed release: localhost:{LEGACY_PORT} no longer receives traffic "
+                        f"and can be stopped")
+
+        logger.info(f"Release {release} live in {time.perf_counter() - started:.1f}s")
+        return True
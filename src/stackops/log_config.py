@@ -0,0 +1,148 @@
+# src/stackops/log_config.py
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import socket
+import sys
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from pathlib import Path
+from typing import Iterator, Optional
+
+# All stackops modules log below this logger
+PACKAGE_LOGGER = "stackops"
+
+LOG_FILE_NAME = "setup.log"
+MAX_LOG_BYTES = 5 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+
+CONSOLE_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Name of the step currently running in this thread/context
+current_step: contextvars.ContextVar = contextvars.ContextVar('stackops_step', default=None)
+
+_listener: Optional[QueueListener] = None
+_queue_handler: Optional[QueueHandler] = None
+
+
+def new_run_id() -> str:
+    """Return a short random identifier for one provisioning run"""
+    return uuid.uuid4().hex[:12]
+
+
+@contextmanager
+def log_step(name: str) -> Iterator[None]:
+    """Tag every record logged inside the block with the given step name"""
+    token = current_step.set(name)
+    try:
+        yield
+    finally:
+        current_step.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """Attach run_id, host and step to records in the calling thread"""
+
+    def __init__(self, run_id: str, host: Optional[str] = None):
+        super().__init__()
+        self.run_id = run_id
+        self.host = host or socket.gethostname()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.run_id = self.run_id
+        record.host = self.host
+        record.step = current_step.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as single-line JSON objects"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'run_id': getattr(record, 'run_id', None),
+            'host': getattr(record, 'host', None),
+            'step': getattr(record, 'step', None),
+            'msg': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def configure_logging(logs_dir: Path,
+                      run_id: Optional[str] = None,
+                      level: int = logging.INFO,
+                      console: bool = True,
+                      max_bytes: int = MAX_LOG_BYTES,
+                      backup_count: int = LOG_BACKUP_COUNT) -> QueueListener:
+    """
+    Route stackops logging through a background thread
+
+    Callers only pay for putting a record on a queue; a QueueListener
+    writes JSON lines to a size-rotated file and human-readable lines to
+    stdout. Calling this again replaces the previous configuration.
+
+    Args:
+        logs_dir: Directory for the rotated log files
+        run_id: Identifier stamped on every record (generated if omitted)
+        level: Minimum level for the package logger
+        console: Also echo records to stdout (level from STACKOPS_LOG_LEVEL)
+        max_bytes: Rotate the log file once it reaches this size
+        backup_count: Number of rotated files to keep
+    """
+    global _listener, _queue_handler
+
+    shutdown_logging()
+    logs_dir.mkdir(parents=True, exist_ok=True)
+
+    file_handler = RotatingFileHandler(
+        logs_dir / LOG_FILE_NAME, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8'
+    )
+    file_handler.setFormatter(JsonFormatter())
+    handlers = [file_handler]
+
+    if console:
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+        console_handler.setLevel(os.getenv('STACKOPS_LOG_LEVEL', 'INFO').upper())
+        handlers.append(console_handler)
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    _queue_handler = QueueHandler(log_queue)
+    _queue_handler.addFilter(ContextFilter(run_id or new_run_id()))
+
+    logger = logging.getLogger(PACKAGE_LOGGER)
+    logger.setLevel(level)
+    logger.addHandler(_queue_handler)
+    # Our handlers are complete; don't duplicate records through root
+    logger.propagate = False
+
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def shutdown_logging() -> None:
+    """Flush queued records and detach the handlers installed by configure_logging"""
+    global _listener, _queue_handler
+
+    if _queue_handler is not None:
+        logging.getLogger(PACKAGE_LOGGER).removeHandler(_queue_handler)
+        _queue_handler = None
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+atexit.register(shutdown_logging)
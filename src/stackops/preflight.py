@@ -0,0 +1,441 @@
+# src/stackops/preflight.py
+import errno
+import logging
+import os
+import re
+import shutil
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional, Set, Tuple
+from urllib.parse import urlparse
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Per-check time budget (seconds)
+DEFAULT_TIMEOUT = 5.0
+
+# Thresholds for a t2.micro-class host
+MIN_FREE_DISK_MB = 2048
+MIN_AVAILABLE_MEMORY_MB = 256
+MAX_CLOCK_SKEW = 60.0
+
+DPKG_LOCKS = ('/var/lib/dpkg/lock-frontend', '/var/lib/dpkg/lock')
+APT_SOURCES = ('/etc/apt/sources.list', '/etc/apt/sources.list.d')
+PUBLIC_IP_URL = "https://checkip.amazonaws.com"
+CLOCK_REFERENCE_URL = "http://archive.ubuntu.com"
+NGINX_PID_FILE = '/run/nginx.pid'
+
+
+class CheckResult:
+    """Outcome of a single preflight check"""
+
+    PASS = 'pass'
+    WARN = 'warn'
+    FAIL = 'fail'
+
+    def __init__(self, name: str, status: str, message: str, duration: float = 0.0):
+        self.name = name
+        self.status = status
+        self.message = message
+        self.duration = duration
+
+    @property
+    def failed(self) -> bool:
+        return self.status == self.FAIL
+
+    def __repr__(self) -> str:
+        return f"CheckResult({self.name!r}, {self.status!r}, {self.message!r})"
+
+
+class PreflightCheck:
+    """Base class for checks; subclasses implement run()"""
+
+    name = 'check'
+
+    def __init__(self, timeout: float = DEFAULT_TIMEOUT):
+        self.timeout = timeout
+
+    def run(self) -> CheckResult:
+        raise NotImplementedError
+
+    def ok(self, message: str) -> CheckResult:
+        return CheckResult(self.name, CheckResult.PASS, message)
+
+    def warn(self, message: str) -> CheckResult:
+        return CheckResult(self.name, CheckResult.WARN, message)
+
+    def fail(self, message: str) -> CheckResult:
+        return CheckResult(self.name, CheckResult.FAIL, message)
+
+
+def resolve_host(domain: str) -> Set[str]:
+    """Return the addresses a name resolves to"""
+    return {info[4][0] for info in socket.getaddrinfo(domain, None, proto=socket.IPPROTO_TCP)}
+
+
+def discover_host_ips(timeout: float = DEFAULT_TIMEOUT) -> Set[str]:
+    """Best-effort set of this host's addresses, including the public one behind NAT"""
+    addresses = set()
+    try:
+        # Connecting a UDP socket sends nothing but picks the outbound interface
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(('192.0.2.1', 80))
+            addresses.add(s.getsockname()[0])
+    except OSError:
+        pass
+    try:
+        with urllib.request.urlopen(PUBLIC_IP_URL, timeout=timeout) as response:
+            addresses.add(response.read().decode().strip())
+    except Exception:
+        pass
+    return addresses
+
+
+class DnsCheck(PreflightCheck):
+    """The domain must resolve to this host, or certbot fails at the very end"""
+
+    name = 'dns'
+
+    def __init__(self,
+                 domain: str,
+                 host_ips: Optional[Iterable[str]] = None,
+                 resolver: Callable[[str], Set[str]] = resolve_host,
+                 timeout: float = DEFAULT_TIMEOUT):
+        super().__init__(timeout)
+        self.domain = domain
+        self.host_ips = set(host_ips) if host_ips is not None else None
+        self.resolver = resolver
+
+    def run(self) -> CheckResult:
+        try:
+            resolved = set(self.resolver(self.domain))
+        except OSError as e:
+            return self.fail(f"{self.domain} does not resolve: {e}")
+        if not resolved:
+            return self.fail(f"{self.domain} has no address records")
+
+        host_ips = self.host_ips if self.host_ips is not None else discover_host_ips(self.timeout / 2)
+        if not host_ips:
+            return self.warn(f"{self.domain} resolves to {', '.join(sorted(resolved))}; "
+                             f"could not determine this host's address")
+        if resolved & host_ips:
+            return self.ok(f"{self.domain} resolves to this host ({', '.join(sorted(resolved & host_ips))})")
+        return self.fail(f"{self.domain} resolves to {', '.join(sorted(resolved))}, "
+                         f"but this host is {', '.join(sorted(host_ips))}")
+
+
+class PortCheck(PreflightCheck):
+    """Nginx must be able to bind the HTTP(S) ports"""
+
+    name = 'ports'
+
+    def __init__(self,
+                 ports: Tuple[int, ...] = (80, 443),
+                 host: str = '',
+                 nginx_pid_file: str = NGINX_PID_FILE,
+                 timeout: float = DEFAULT_TIMEOUT):
+        super().__init__(timeout)
+        self.ports = ports
+        self.host = host
+        self.nginx_pid_file = Path(nginx_pid_file)
+
+    def run(self) -> CheckResult:
+        in_use, denied = [], []
+        for port in self.ports:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                try:
+                    s.bind((self.host, port))
+                except OSError as e:
+                    if e.errno == errno.EADDRINUSE:
+                        in_use.append(port)
+                    elif e.errno == errno.EACCES:
+                        denied.append(port)
+                    else:
+                        raise
+
+        ports = ', '.join(str(p) for p in self.ports)
+        if in_use:
+            busy = ', '.join(str(p) for p in in_use)
+            if self.nginx_pid_file.exists():
+                return self.warn(f"port(s) {busy} already served by nginx")
+            return self.fail(f"port(s) {busy} are held by another process")
+        if denied:
+            return self.warn(f"cannot test port(s) {', '.join(str(p) for p in denied)} without root")
+        return self.ok(f"port(s) {ports} are free")
+
+
+class DiskCheck(PreflightCheck):
+    """Packages, Docker images and the runner need free disk space"""
+
+    name = 'disk'
+
+    def __init__(self, path: str = '/', min_free_mb: int = MIN_FREE_DISK_MB, timeout: float = DEFAULT_TIMEOUT):
+        super().__init__(timeout)
+        self.path = path
+        self.min_free_mb = min_free_mb
+
+    def run(self) -> CheckResult:
+        free_mb = shutil.disk_usage(self.path).free // (1024 * 1024)
+        if free_mb < self.min_free_mb:
+            return self.fail(f"{free_mb} MB free on {self.path}, need {self.min_free_mb} MB")
+        return self.ok(f"{free_mb} MB free on {self.path}")
+
+
+class MemoryCheck(PreflightCheck):
+    """apt and dpkg get OOM-killed on hosts that are already out of memory"""
+
+    name = 'memory'
+
+    def __init__(self,
+                 min_available_mb: int = MIN_AVAILABLE_MEMORY_MB,
+                 meminfo_path: str = '/proc/meminfo',
+                 timeout: float = DEFAULT_TIMEOUT):
+        super().__init__(timeout)
+        self.min_available_mb = min_available_mb
+        self.meminfo_path = Path(meminfo_path)
+
+    def run(self) -> CheckResult:
+        if not self.meminfo_path.exists():
+            return self.warn(f"{self.meminfo_path} not available")
+        meminfo = {}
+        for line in self.meminfo_path.read_text().splitlines():
+            key, _, value = line.partition(':')
+            meminfo[key] = int(value.split()[0]) if value.split() else 0
+
+        # MemAvailable plus free swap is what a burst of dpkg can actually use
+        available_mb = (meminfo.get('MemAvailable', meminfo.get('MemFree', 0))
+                        + meminfo.get('SwapFree', 0)) // 1024
+        if available_mb < self.min_available_mb:
+            return self.fail(f"{available_mb} MB memory available, need {self.min_available_mb} MB")
+        return self.ok(f"{available_mb} MB memory available")
+
+
+class AptLockCheck(PreflightCheck):
+    """Another apt/dpkg (often unattended-upgrades) must not hold the lock"""
+
+    name = 'apt_lock'
+
+    def __init__(self, lock_paths: Tuple[str, ...] = DPKG_LOCKS, timeout: float = DEFAULT_TIMEOUT):
+        super().__init__(timeout)
+        self.lock_paths = lock_paths
+
+    def run(self) -> CheckResult:
+        if fcntl is None:
+            return self.warn("dpkg lock check not supported on this platform")
+
+        for lock_path in self.lock_paths:
+            if not os.path.exists(lock_path):
+                continue
+            try:
+                fd = os.open(lock_path, os.O_RDWR)
+            except PermissionError:
+                return self.warn(f"cannot open {lock_path} without root")
+            try:
+                # dpkg uses fcntl record locks, which lockf maps to on Linux
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                fcntl.lockf(fd, fcntl.LOCK_UN)
+            except OSError:
+                return self.fail(f"{lock_path} is held by another process")
+            finally:
+                os.close(fd)
+        return self.ok("dpkg lock is free")
+
+
+class AptMirrorCheck(PreflightCheck):
+    """Every configured apt mirror must be reachable"""
+
+    name = 'apt_mirror'
+
+    URI_PATTERN = re.compile(r'(?:^deb(?:-src)?\s+(?:\[[^\]]*\]\s+)?|^URIs:\s*)(\S+)', re.MULTILINE)
+
+    def __init__(self, sources: Tuple[str, ...] = APT_SOURCES, timeout: float = DEFAULT_TIMEOUT):
+        super().__init__(timeout)
+        self.sources = sources
+
+    def mirrors(self) -> List[Tuple[str, int]]:
+        """Unique (host, port) pairs from sources.list style files"""
+        files = []
+        for source in self.sources:
+            path = Path(source)
+            if path.is_dir():
+                files.extend(sorted(p for p in path.iterdir() if p.suffix in ('.list', '.sources')))
+            elif path.exists():
+                files.append(path)
+
+        mirrors = []
+        for path in files:
+            for uri in self.URI_PATTERN.findall(path.read_text()):
+                parsed = urlparse(uri)
+                if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+                    continue
+                port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+                if (parsed.hostname, port) not in mirrors:
+                    mirrors.append((parsed.hostname, port))
+        return mirrors
+
+    def run(self) -> CheckResult:
+        mirrors = self.mirrors()
+        if not mirrors:
+            return self.warn("no apt mirrors configured")
+
+        # Probe all mirrors at once so one slow host doesn't use up the budget
+        def probe(mirror: Tuple[str, int]) -> Optional[str]:
+            try:
+                socket.create_connection(mirror, timeout=self.timeout).close()
+                return None
+            except OSError as e:
+                return f"{mirror[0]}:{mirror[1]} ({e})"
+
+        with ThreadPoolExecutor(max_workers=len(mirrors)) as executor:
+            unreachable = [error for error in executor.map(probe, mirrors) if error]
+        if unreachable:
+            return self.fail(f"unreachable: {', '.join(unreachable)}")
+        return self.ok(f"{len(mirrors)} mirror(s) reachable")
+
+
+class ClockSkewCheck(PreflightCheck):
+    """A skewed clock breaks apt signature checks and ACME requests"""
+
+    name = 'clock'
+
+    def __init__(self,
+                 reference_url: str = CLOCK_REFERENCE_URL,
+                 max_skew: float = MAX_CLOCK_SKEW,
+                 timeout: float = DEFAULT_TIMEOUT):
+        super().__init__(timeout)
+        self.reference_url = reference_url
+        self.max_skew = max_skew
+
+    def run(self) -> CheckResult:
+        request = urllib.request.Request(self.reference_url, method='HEAD')
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                date_header = response.headers.get('Date')
+        except urllib.error.HTTPError as e:
+            date_header = e.headers.get('Date')
+        except OSError as e:
+            return self.warn(f"could not reach {self.reference_url}: {e}")
+        if not date_header:
+            return self.warn(f"{self.reference_url} sent no Date header")
+
+        skew = (datetime.now(timezone.utc) - parsedate_to_datetime(date_header)).total_seconds()
+        if abs(skew) > self.max_skew:
+            return self.fail(f"clock is off by {skew:+.0f}s (max {self.max_skew:.0f}s)")
+        return self.ok(f"clock within {abs(skew):.0f}s of {urlparse(self.reference_url).hostname}")
+
+
+class PreflightReport:
+    """Consolidated results of a preflight run"""
+
+    def __init__(self, results: List[CheckResult], duration: float):
+        self.results = results
+        self.duration = duration
+
+    @property
+    def ok(self) -> bool:
+        return not any(result.failed for result in self.results)
+
+    @property
+    def failures(self) -> List[CheckResult]:
+        return [result for result in self.results if result.failed]
+
+    def format(self) -> str:
+        """One line per check followed by a summary line"""
+        labels = {CheckResult.PASS: 'PASS', CheckResult.WARN: 'WARN', CheckResult.FAIL: 'FAIL'}
+        lines = [f"[{labels[r.status]}] {r.name:<11} {r.message}" for r in self.results]
+        verdict = "passed" if self.ok else f"failed ({len(self.failures)} problem(s))"
+        lines.append(f"Preflight {verdict} in {self.duration:.1f}s")
+        return '\n'.join(lines)
+
+
+def _run_check(check: PreflightCheck) -> CheckResult:
+    started = time.perf_counter()
+    try:
+        result = check.run()
+    except Exception as e:
+        result = check.fail(f"check crashed: {e}")
+    result.duration = time.perf_counter() - started
+    return result
+
+
+def run_preflight(checks: List[PreflightCheck]) -> PreflightReport:
+    """
+    Run checks concurrently, each bounded by its own timeout
+
+    Each check runs in a daemon thread, so one that hangs past its budget
+    (e.g. getaddrinfo on a broken resolver) is abandoned and can't hold up
+    interpreter exit.
+
+    Args:
+        checks: Checks to run
+
+    Returns:
+        Report with one result per check, in the order given
+    """
+    started = time.monotonic()
+    finished = {}
+
+    def worker(index: int, check: PreflightCheck) -> None:
+        finished[index] = _run_check(check)
+
+    threads = [threading.Thread(target=worker, args=(index, check), daemon=True,
+                                name=f"preflight-{check.name}")
+               for index, check in enumerate(checks)]
+    for thread in threads:
+        thread.start()
+
+    results = []
+    for index, (check, thread) in enumerate(zip(checks, threads)):
+        thread.join(max(0.0, started + check.timeout - time.monotonic()))
+        if index in finished:
+            results.append(finished[index])
+        else:
+            results.append(CheckResult(check.name, CheckResult.FAIL,
+                                       f"timed out after {check.timeout:.0f}s", check.timeout))
+
+    report = PreflightReport(results, time.monotonic() - started)
+
+    for result in results:
+        if result.failed:
+            logger.error(f"Preflight {result.name}: {result.message}")
+        elif result.status == CheckResult.WARN:
+            logger.warning(f"Preflight {result.name}: {result.message}")
+        else:
+            logger.info(f"Preflight {result.name}: {result.message}")
+    return report
+
+
+def default_checks(domain: str, timeout: float = DEFAULT_TIMEOUT, offline: bool = False) -> List[PreflightCheck]:
+    """
+    The standard checks run before provisioning a host for domain
+
+    Args:
+        domain: Domain name for the server
+        timeout: Per-check time budget (seconds)
+        offline: Packages come from a bundle, so the apt mirrors need not be reachable
+    """
+    checks = [
+        DnsCheck(domain, timeout=timeout),
+        PortCheck(timeout=timeout),
+        DiskCheck(timeout=timeout),
+        MemoryCheck(timeout=timeout),
+        AptLockCheck(timeout=timeout),
+        AptMirrorCheck(timeout=timeout),
+        ClockSkewCheck(timeout=timeout),
+    ]
+    if offline:
+        checks = [check for check in checks if not isinstance(check, AptMirrorCheck)]
+    return checks
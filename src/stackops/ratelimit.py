@@ -0,0 +1,112 @@
+# src/stackops/ratelimit.py
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from stackops.settings import Settings
+
+# Files setup.sh writes the profile to (relative to the root)
+LIMITS_CONF = "etc/nginx/conf.d/stackops-limits.conf"
+APP_SNIPPET = "etc/nginx/snippets/stackops-limits-app.conf"
+API_SNIPPET = "etc/nginx/snippets/stackops-limits-api.conf"
+
+# Always exempt: health checks and anything proxied from the host itself
+LOOPBACK = ('127.0.0.1/32', '::1/128')
+
+# Shared memory for limit state: 1 MB holds ~16k client addresses. Budget
+# 1/256 of RAM for it, within these bounds (MB).
+MIN_ZONE_MB = 1
+MAX_ZONE_MB = 64
+
+# Used when /proc/meminfo can't be read
+DEFAULT_MEMORY_MB = 1024
+
+
+def host_memory_mb(meminfo_path: str = '/proc/meminfo') -> int:
+    """Total RAM of this host in MB"""
+    try:
+        for line in Path(meminfo_path).read_text().splitlines():
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1]) // 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return DEFAULT_MEMORY_MB
+
+
+def zone_sizes(memory_mb: int) -> Tuple[int, int, int]:
+    """
+    Size the shared-memory zones for a host
+
+    Returns:
+        (page request zone, /api/ request zone, connection zone) in MB
+    """
+    budget = max(MIN_ZONE_MB, min(MAX_ZONE_MB, memory_mb // 256))
+    half = max(MIN_ZONE_MB, budget // 2)
+    return budget, half, half
+
+
+def render_limits_conf(settings: Settings, memory_mb: int) -> str:
+    """
+    Render the http-level zones (conf.d/stackops-limits.conf)
+
+    Allowlisted clients get an empty key, which nginx does not count.
+
+    Args:
+        settings: Rates and allowlist
+        memory_mb: Host RAM used to size the zones
+    """
+    app_mb, api_mb, conn_mb = zone_sizes(memory_mb)
+    exempt = ''.join(f"    {network} 1;\n" for network in (*LOOPBACK, *settings.NGINX_LIMIT_ALLOWLIST))
+    return f"""# Managed by stackops - request and connection limits for the app vhost
+# Zones sized for {memory_mb} MB RAM (1 MB holds ~16k clients)
+geo $stackops_limit_exempt {{
+    default 0;
+{exempt}}}
+
+map $stackops_limit_exempt $stackops_limit_key {{
+    0 $binary_remote_addr;
+    1 "";
+}}
+
+limit_req_zone $stackops_limit_key zone=stackops_app:{app_mb}m rate={settings.NGINX_RATE}r/s;
+limit_req_zone $stackops_limit_key zone=stackops_api:{api_mb}m rate={settings.NGINX_API_RATE}r/s;
+limit_conn_zone $stackops_limit_key zone=stackops_conn:{conn_mb}m;
+
+limit_req_status 429;
+limit_conn_status 429;
+limit_req_log_level warn;
+limit_conn_log_level warn;
+"""
+
+
+def render_location_limits(settings: Settings, route: str) -> str:
+    """
+    Render the limits included by a vhost location
+
+    Bursts are served without delay (nodelay) up to the burst size; beyond
+    that clients get 429 straight away instead of queueing in nginx.
+
+    Args:
+        settings: Rates, bursts and body sizes
+        route: 'app' for pages, 'api' for /api/
+    """
+    if route == 'api':
+        zone, burst, max_body = 'stackops_api', settings.NGINX_API_BURST, settings.NGINX_API_MAX_BODY
+    elif route == 'app':
+        zone, burst, max_body = 'stackops_app', settings.NGINX_BURST, settings.NGINX_MAX_BODY
+    else:
+        raise ValueError(f"Unknown route {route!r}")
+    return f"""# Managed by stackops
+limit_req zone={zone} burst={burst} nodelay;
+limit_conn stackops_conn {settings.NGINX_CONN_LIMIT};
+client_max_body_size {max_body};
+"""
+
+
+def ratelimit_env(settings: Settings, memory_mb: Optional[int] = None) -> Dict[str, str]:
+    """Environment passing the rendered profile to setup.sh"""
+    memory_mb = host_memory_mb() if memory_mb is None else memory_mb
+    return {
+        'NGINX_LIMITS_CONF': render_limits_conf(settings, memory_mb),
+        'NGINX_LIMITS_APP': render_location_limits(settings, 'app'),
+        'NGINX_LIMITS_API': render_location_limits(settings, 'api'),
+    }
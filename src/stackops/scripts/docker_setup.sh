@@ -3,6 +3,16 @@
 # setup.sh - Run this once when setting up the EC2 instance
 set -e
 
+# Target root filesystem (empty on a real host)
+ROOT="${STACKOPS_ROOT:-}"
+
+# Steps may run in parallel but dpkg takes one client at a time: hold the
+# shared apt lock for the whole install
+APT_LOCK="$ROOT/var/lib/stackops/apt.lock"
+sudo mkdir -p $ROOT/var/lib/stackops
+exec 9>"$APT_LOCK"
+flock 9
+
 # Update system
 sudo apt update && sudo apt upgrade -y
 
@@ -16,16 +26,16 @@ sudo apt install -y ca-certificates curl gnupg software-properties-common
 
 # Add Docker's official GPG key
 echo "Adding Docker's GPG key..."
-sudo install -m 0755 -d /etc/apt/keyrings
-curl -fsSL https://download.docker.com/linux/ubuntu/gpg | sudo gpg --dearmor -o /etc/apt/keyrings/docker.gpg
-sudo chmod a+r /etc/apt/keyrings/docker.gpg
+sudo install -m 0755 -d $ROOT/etc/apt/keyrings
+curl -fsSL https://download.docker.com/linux/ubuntu/gpg | sudo gpg --dearmor -o $ROOT/etc/apt/keyrings/docker.gpg
+sudo chmod a+r $ROOT/etc/apt/keyrings/docker.gpg
 
 # Add Docker repository
 echo "Adding Docker repository..."
 echo \
   "deb [arch="$(dpkg --print-architecture)" signed-by=/etc/apt/keyrings/docker.gpg] https://download.docker.com/linux/ubuntu \
-  "$(. /etc/os-release && echo "$VERSION_CODENAME")" stable" | \
-  sudo tee /etc/apt/sources.list.d/docker.list > /dev/null
+  "$(. $ROOT/etc/os-release && echo "$VERSION_CODENAME")" stable" | \
+  sudo tee $ROOT/etc/apt/sources.list.d/docker.list > /dev/null
 
 # Update apt after adding Docker repository
 sudo apt update
@@ -3,6 +3,9 @@
 # Exit on any error
 set -e
 
+# Target root filesystem (empty on a real host)
+ROOT="${STACKOPS_ROOT:-}"
+
 # Colors for output
 GREEN='\033[0;32m'
 RED='\033[0;31m'
@@ -18,7 +21,7 @@ error() {
 }
 
 # Check if running as root
-if [ "$EUID" -ne 0 ]; then 
+if [ "$EUID" -ne 0 ] && [ -z "$ROOT" ]; then
     error "Please run as root or with sudo"
     exit 1
 fi
@@ -32,7 +35,13 @@ apt upgrade -y --only-upgrade
 log "Installing essential packages..."
 apt install -y nginx \
     ufw \
-    fail2ban
+    fail2ban \
+    nftables \
+    python3-systemd
+
+# Brotli static module (not packaged on every release, so optional)
+apt install -y libnginx-mod-http-brotli-static 2>/dev/null || \
+    log "Brotli static module not available - serving .gz assets only"
 
 # Remove unnecessary services and packages
 log "Removing unnecessary services..."
@@ -49,28 +58,28 @@ ufw allow ssh
 ufw allow 'Nginx HTTP'
 echo "y" | ufw enable
 
-# Basic fail2ban configuration (minimal)
+# fail2ban reads the journal and bans into nftables sets; the jails are
+# rendered by stackops from its settings and passed in the environment
 log "Configuring fail2ban..."
-cat > /etc/fail2ban/jail.local <<EOF
-[sshd]
-enabled = true
-port = ssh
-filter = sshd
-logpath = /var/log/auth.log
-maxretry = 3
-bantime = 3600
-findtime = 3600
-EOF
+if [ -z "$F2B_JAIL_LOCAL" ] || [ -z "$F2B_NGINX_FILTER" ]; then
+    error "fail2ban configuration missing - run this script through stackops"
+    exit 1
+fi
+mkdir -p $ROOT/etc/fail2ban/filter.d
+printf '%s' "$F2B_JAIL_LOCAL" > $ROOT/etc/fail2ban/jail.local
+printf '%s' "$F2B_NGINX_FILTER" > $ROOT/etc/fail2ban/filter.d/${F2B_NGINX_FILTER_NAME}.conf
+fail2ban-client -t
 
 systemctl enable fail2ban
 systemctl restart fail2ban
 
 # Optimize Nginx for t2.micro
 log "Configuring Nginx with minimal resource usage..."
-cat > /etc/nginx/nginx.conf <<EOF
+cat > $ROOT/etc/nginx/nginx.conf <<EOF
 user www-data;
 worker_processes 1;
 pid /run/nginx.pid;
+include /etc/nginx/modules-enabled/*.conf;
 
 events {
     worker_connections 512;
@@ -101,7 +110,16 @@ http {
     error_log /var/log/nginx/error.log crit;
 
     # Gzip Settings
-    gzip off;  # Disable gzip to save CPU
+    gzip off;  # Disable on-the-fly gzip to save CPU
+    gzip_static on;  # Serve .gz files built by 'stackops assets build'
+    gzip_vary on;
+
+    # Cache file descriptors and stat() results for static files
+    open_file_cache max=1000 inactive=60s;
+    open_file_cache_valid 60s;
+    open_file_cache_min_uses 2;
+    # Not caching lookup errors: .gz/.br siblings from a fresh assets build
+    # are served straight away rather than after open_file_cache_valid
 
     # Include virtual host configs
     include /etc/nginx/conf.d/*.conf;
@@ -109,8 +127,15 @@ http {
 }
 EOF
 
+# Serve precompressed .br files when the brotli module is loaded
+if ls $ROOT/etc/nginx/modules-enabled/ 2>/dev/null | grep -q brotli; then
+    echo "brotli_static on;" > $ROOT/etc/nginx/conf.d/brotli-static.conf
+else
+    rm -f $ROOT/etc/nginx/conf.d/brotli-static.conf
+fi
+
 # Create minimal server block
-cat > /etc/nginx/sites-available/default <<EOF
+cat > $ROOT/etc/nginx/sites-available/default <<EOF
 server {
     listen 80 default_server;
     listen [::]:80 default_server;
@@ -139,7 +164,7 @@ server {
 EOF
 
 # Create a simple index page
-cat > /var/www/html/index.html <<EOF
+cat > $ROOT/var/www/html/index.html <<EOF
 <!DOCTYPE html>
 <html>
 <head>
@@ -153,8 +178,8 @@ EOF
 
 # Set proper permissions
 log "Setting proper permissions..."
-chown -R www-data:www-data /var/www/html
-chmod -R 755 /var/www/html
+chown -R www-data:www-data $ROOT/var/www/html
+chmod -R 755 $ROOT/var/www/html
 
 # Enable and restart services
 log "Starting services..."
@@ -176,7 +201,7 @@ top -bn1 | head -n 5
 
 log "Important notes:"
 echo "1. Access logs are disabled to reduce disk I/O"
-echo "2. Gzip is disabled to save CPU"
+echo "2. On-the-fly gzip is disabled; precompress assets with: stackops assets build"
 echo "3. Worker processes set to 1 for t2.micro"
 echo "4. Monitor resource usage with: htop or top"
 echo "5. Check error logs at: /var/log/nginx/error.log"
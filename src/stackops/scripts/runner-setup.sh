@@ -2,39 +2,56 @@
 
 # Variables will be set from Python
 GITHUB_TOKEN="${GITHUB_TOKEN}"
+ROOT="${STACKOPS_ROOT:-}"  # Target root filesystem (empty on a real host)
+RUNNER_VERSION="2.314.1"
+RUNNER_TARBALL="actions-runner-linux-x64-${RUNNER_VERSION}.tar.gz"
+RUNNER_CACHE="$ROOT/var/cache/stackops"
+APT_LOCK="$ROOT/var/lib/stackops/apt.lock"  # Shared with other steps using apt
 
 # Stop the service
 sudo systemctl stop actions-runner || true
 
 # Remove the service
 sudo systemctl disable actions-runner || true
-sudo rm -f /etc/systemd/system/actions-runner.service
+sudo rm -f $ROOT/etc/systemd/system/actions-runner.service
 
-# Clean up old runner
-cd /home/ubuntu/actions-runner || exit
-sudo ./svc.sh uninstall || true
-cd /home/ubuntu
+# Clean up old runner (if any)
+if [ -d $ROOT/home/ubuntu/actions-runner ]; then
+    cd $ROOT/home/ubuntu/actions-runner
+    sudo ./svc.sh uninstall || true
+fi
+cd $ROOT/home/ubuntu
 sudo rm -rf actions-runner
 
 # Create new runner directory
-mkdir -p /home/ubuntu/actions-runner
-cd /home/ubuntu/actions-runner
+mkdir -p $ROOT/home/ubuntu/actions-runner
+cd $ROOT/home/ubuntu/actions-runner
 
-# Download latest runner
-curl -o actions-runner-linux-x64.tar.gz -L \
-    https://github.com/actions/runner/releases/download/v2.314.1/actions-runner-linux-x64-2.314.1.tar.gz
+# Download runner (reusing a cached copy, e.g. restored from a bundle)
+if [ -f $RUNNER_CACHE/$RUNNER_TARBALL ]; then
+    cp $RUNNER_CACHE/$RUNNER_TARBALL actions-runner-linux-x64.tar.gz
+else
+    curl -o actions-runner-linux-x64.tar.gz -L \
+        https://github.com/actions/runner/releases/download/v${RUNNER_VERSION}/${RUNNER_TARBALL}
+    sudo mkdir -p $RUNNER_CACHE
+    sudo cp actions-runner-linux-x64.tar.gz $RUNNER_CACHE/$RUNNER_TARBALL
+fi
 
 # Extract runner
 tar xzf ./actions-runner-linux-x64.tar.gz
 
-# Install dependencies
-./bin/installdependencies.sh
+# Install dependencies (apt-get, so wait for other steps to finish with dpkg)
+sudo mkdir -p $ROOT/var/lib/stackops
+if ! sudo flock "$APT_LOCK" ./bin/installdependencies.sh; then
+    echo "Installing runner dependencies failed"
+    exit 1
+fi
 
 # Configure runner with token
 ./config.sh --url https://github.com/your-repo --token ${GITHUB_TOKEN} --unattended
 
 # Create service file
-sudo tee /etc/systemd/system/actions-runner.service << 'EOF'
+sudo tee $ROOT/etc/systemd/system/actions-runner.service << 'EOF'
 [Unit]
 Description=GitHub Actions Runner
 After=network.target
@@ -54,8 +71,8 @@ WantedBy=multi-user.target
 EOF
 
 # Set permissions
-sudo chown -R ubuntu:ubuntu /home/ubuntu/actions-runner
-sudo chmod +x /home/ubuntu/actions-runner/run.sh
+sudo chown -R ubuntu:ubuntu $ROOT/home/ubuntu/actions-runner
+sudo chmod +x $ROOT/home/ubuntu/actions-runner/run.sh
 
 # Configure systemd
 sudo systemctl daemon-reload
@@ -1,48 +1,94 @@
 #!/bin/bash
 
+# Exit on any error, so a failed nginx test or certbot run fails the step
+set -e
+
 # Variables from environment
 DOMAIN="${DOMAIN}"    # Will be set from Python
 EMAIL="${EMAIL}"      # Will be set from Python
+ROOT="${STACKOPS_ROOT:-}"  # Target root filesystem (empty on a real host)
+APT_LOCK="$ROOT/var/lib/stackops/apt.lock"  # Shared with other steps using apt
 
 echo "Starting setup..."
 
 # Install Certbot and Nginx plugin
 echo "Installing Certbot..."
-sudo apt install -y certbot python3-certbot-nginx
+sudo mkdir -p $ROOT/var/lib/stackops
+sudo flock "$APT_LOCK" apt install -y certbot python3-certbot-nginx
 
 # Create application directory structure
 echo "Creating application directories..."
 
-sudo mkdir -p /var/www/app/scripts
-sudo mkdir -p /var/www/app/logs
-sudo mkdir -p /tmp/ffmpeg
+sudo mkdir -p $ROOT/var/www/app/scripts
+sudo mkdir -p $ROOT/var/www/app/logs
+sudo mkdir -p $ROOT/var/www/app/static
+sudo mkdir -p $ROOT/tmp/ffmpeg
 
 # Set proper permissions
 echo "Setting up permissions..."
-sudo chmod 1777 /tmp/ffmpeg
-sudo chown -R ubuntu:ubuntu /var/www/app
-sudo chmod -R 755 /var/www/app
+sudo chmod 1777 $ROOT/tmp/ffmpeg
+sudo chown -R ubuntu:ubuntu $ROOT/var/www/app
+sudo chmod -R 755 $ROOT/var/www/app
+
+# App backends; 'stackops deploy' rewrites this file, so keep it if present
+if [ ! -f $ROOT/etc/nginx/conf.d/stackops-upstream.conf ]; then
+    sudo tee $ROOT/etc/nginx/conf.d/stackops-upstream.conf << EOL
+upstream stackops_app {
+    server 127.0.0.1:3002;
+}
+EOL
+fi
+
+# Rate and connection limits, rendered by stackops from its settings
+echo "Setting up request limits..."
+if [ -z "$NGINX_LIMITS_CONF" ] || [ -z "$NGINX_LIMITS_APP" ] || [ -z "$NGINX_LIMITS_API" ]; then
+    echo "Request limit profile missing - run this script through stackops"
+    exit 1
+fi
+sudo mkdir -p $ROOT/etc/nginx/snippets
+
+# Security headers, included wherever a location sets its own add_header
+# (add_header in a location drops those inherited from the server block)
+sudo tee $ROOT/etc/nginx/snippets/stackops-security-headers.conf > /dev/null << 'EOL'
+# Managed by stackops
+add_header X-Frame-Options "SAMEORIGIN";
+add_header X-Content-Type-Options "nosniff";
+add_header X-XSS-Protection "1; mode=block";
+add_header Strict-Transport-Security "max-age=31536000; includeSubDomains" always;
+EOL
+printf '%s' "$NGINX_LIMITS_CONF" | sudo tee $ROOT/etc/nginx/conf.d/stackops-limits.conf > /dev/null
+printf '%s' "$NGINX_LIMITS_APP" | sudo tee $ROOT/etc/nginx/snippets/stackops-limits-app.conf > /dev/null
+printf '%s' "$NGINX_LIMITS_API" | sudo tee $ROOT/etc/nginx/snippets/stackops-limits-api.conf > /dev/null
 
 # Create Nginx configuration for the application
 echo "Setting up Nginx configuration..."
-sudo tee /etc/nginx/sites-available/nextjs-app << EOL
+sudo tee $ROOT/etc/nginx/sites-available/nextjs-app << EOL
+# Client errors are also sent to the journal for fail2ban's nginx-4xx jail.
+# 429s from the rate limits are left out: going over a burst is already
+# answered by limit_req and must not escalate to a firewall ban.
+map \$status \$stackops_4xx {
+    ~^429   0;
+    ~^4     1;
+    default 0;
+}
+log_format stackops_4xx '\$remote_addr \$status \$request_method "\$uri"';
+
 server {
     listen 80;
     server_name ${DOMAIN};
 
     # Access and error logs
     access_log /var/log/nginx/nextjs-access.log;
+    access_log syslog:server=unix:/dev/log,tag=nginx_4xx,nohostname stackops_4xx if=\$stackops_4xx;
     error_log /var/log/nginx/nextjs-error.log;
 
     # Security headers
-    add_header X-Frame-Options "SAMEORIGIN";
-    add_header X-Content-Type-Options "nosniff";
-    add_header X-XSS-Protection "1; mode=block";
-    add_header Strict-Transport-Security "max-age=31536000; includeSubDomains" always;
+    include /etc/nginx/snippets/stackops-security-headers.conf;
 
     # Proxy settings
     location / {
-        proxy_pass http://localhost:3002;
+        include /etc/nginx/snippets/stackops-limits-app.conf;
+        proxy_pass http://stackops_app;
         proxy_http_version 1.1;
         proxy_set_header Upgrade \$http_upgrade;
         proxy_set_header Connection 'upgrade';
@@ -52,39 +98,69 @@ server {
         proxy_set_header X-Forwarded-Proto \$scheme;
           proxy_buffering off;
         proxy_read_timeout 86400;
-        
-        # Large client_max_body_size for file uploads
-        client_max_body_size 50M;
+    }
+
+    # API routes: stricter rate, larger bodies for uploads
+    location /api/ {
+        include /etc/nginx/snippets/stackops-limits-api.conf;
+        proxy_pass http://stackops_app;
+        proxy_http_version 1.1;
+        proxy_set_header Upgrade \$http_upgrade;
+        proxy_set_header Connection 'upgrade';
+        proxy_set_header Host \$host;
+        proxy_set_header X-Real-IP \$remote_addr;
+        proxy_set_header X-Forwarded-For \$proxy_add_x_forwarded_for;
+        proxy_set_header X-Forwarded-Proto \$scheme;
+        proxy_buffering off;
+        proxy_read_timeout 86400;
     }
 
     # Health check endpoint
     location /api/health {
-        proxy_pass http://localhost:3002;
+        include /etc/nginx/snippets/stackops-limits-app.conf;
+        proxy_pass http://stackops_app;
         proxy_http_version 1.1;
         proxy_set_header Host \$host;
         proxy_cache_bypass \$http_upgrade;
     }
 
-    # Static files caching
+    # Precompressed static assets (stackops assets build /var/www/app/static); not rate limited
+    location /static/ {
+        root /var/www/app;
+        gzip_static on;
+        expires 1y;
+        include /etc/nginx/snippets/stackops-security-headers.conf;
+        add_header Cache-Control "public, no-transform";
+        access_log off;
+
+        # Keep build state and other dotfiles private
+        location ~ /\. {
+            deny all;
+        }
+    }
+
+    # Static files caching; not rate limited
     location /_next/static {
-        proxy_pass http://localhost:3002;
+        proxy_pass http://stackops_app;
         proxy_cache_bypass \$http_upgrade;
         proxy_set_header Host \$host;
         proxy_cache_use_stale error timeout http_500 http_502 http_503 http_504;
         proxy_cache_valid 200 60m;
         expires 1y;
+        include /etc/nginx/snippets/stackops-security-headers.conf;
         add_header Cache-Control "public, no-transform";
     }
 }
 EOL
 
 # Enable the site
-sudo ln -sf /etc/nginx/sites-available/nextjs-app /etc/nginx/sites-enabled/
-sudo rm -f /etc/nginx/sites-enabled/default
+sudo ln -sf /etc/nginx/sites-available/nextjs-app $ROOT/etc/nginx/sites-enabled/
+sudo rm -f $ROOT/etc/nginx/sites-enabled/default
 
 # Test Nginx configuration
 echo "Testing Nginx configuration..."
-sudo nginx -t && sudo systemctl restart nginx
+sudo nginx -t
+sudo systemctl restart nginx
 
 # Obtain SSL certificate
 echo "Obtaining SSL certificate..."
@@ -97,17 +173,17 @@ sudo certbot --nginx \
 
 # Set up automatic renewal
 echo "Setting up automatic SSL renewal..."
-sudo tee /etc/cron.d/certbot-renewal << EOL
+sudo tee $ROOT/etc/cron.d/certbot-renewal << EOL
 0 */12 * * * root certbot renew --quiet --deploy-hook "systemctl reload nginx"
 EOL
 
 # Create SSL renewal test script
 echo "Creating SSL renewal test script..."
-sudo tee /var/www/app/scripts/test-ssl-renewal.sh << EOL
+sudo tee $ROOT/var/www/app/scripts/test-ssl-renewal.sh << EOL
 #!/bin/bash
 sudo certbot renew --dry-run
 EOL
-sudo chmod +x /var/www/app/scripts/test-ssl-renewal.sh
+sudo chmod +x $ROOT/var/www/app/scripts/test-ssl-renewal.sh
 
 echo "Setup completed successfully!"
 echo "SSL certificate has been installed for ${DOMAIN}"
@@ -116,4 +192,4 @@ echo ""
 echo "Next steps:"
 echo "1. Verify HTTPS is working: https://${DOMAIN}"
 echo "2. Test SSL renewal: ./test-ssl-renewal.sh"
-echo "3. Deploy your application using the deploy script"
+echo "3. Deploy your application: stackops deploy --image <image> (or --command <cmd>)"
@@ -0,0 +1,99 @@
+# src/stackops/settings.py
+import os
+import re
+from typing import Dict, List, Mapping, Optional
+
+
+def _env_int(env: Mapping[str, str], name: str, default: int) -> int:
+    value = env.get(name)
+    if value in (None, ''):
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer, got {value!r}")
+
+
+def _env_size(env: Mapping[str, str], name: str, default: str) -> str:
+    """An nginx size such as 512k or 50m"""
+    value = env.get(name) or default
+    if not re.match(r'^\d+[kKmMgG]?$', value):
+        raise ValueError(f"{name} must be an nginx size like 1m, got {value!r}")
+    return value.lower()
+
+
+def _env_list(env: Mapping[str, str], name: str, default: List[str]) -> List[str]:
+    value = env.get(name)
+    if value in (None, ''):
+        return list(default)
+    return [item for item in value.replace(',', ' ').split() if item]
+
+
+class Settings:
+    """Tunables for the provisioned host, overridable via STACKOPS_* variables"""
+
+    def __init__(self, env: Optional[Mapping[str, str]] = None):
+        """
+        Args:
+            env: Variables to read (defaults to os.environ)
+        """
+        env = os.environ if env is None else env
+
+        # fail2ban: addresses that are never banned
+        self.F2B_IGNORE_IP = _env_list(env, 'STACKOPS_F2B_IGNORE_IP', ['127.0.0.1/8', '::1'])
+
+        # SSH brute force
+        self.F2B_SSH_MAXRETRY = _env_int(env, 'STACKOPS_F2B_SSH_MAXRETRY', 3)
+        self.F2B_SSH_FINDTIME = _env_int(env, 'STACKOPS_F2B_SSH_FINDTIME', 3600)
+        self.F2B_SSH_BANTIME = _env_int(env, 'STACKOPS_F2B_SSH_BANTIME', 3600)
+
+        # 4xx floods against the application vhost
+        self.F2B_NGINX_MAXRETRY = _env_int(env, 'STACKOPS_F2B_NGINX_MAXRETRY', 60)
+        self.F2B_NGINX_FINDTIME = _env_int(env, 'STACKOPS_F2B_NGINX_FINDTIME', 60)
+        self.F2B_NGINX_BANTIME = _env_int(env, 'STACKOPS_F2B_NGINX_BANTIME', 600)
+
+        # Repeat offenders get exponentially longer bans, capped here
+        self.F2B_BANTIME_MAX = _env_int(env, 'STACKOPS_F2B_BANTIME_MAX', 7 * 24 * 3600)
+
+        # deploy: ports new app instances are started on, behind the nginx upstream
+        self.DEPLOY_PORT_MIN = _env_int(env, 'STACKOPS_DEPLOY_PORT_MIN', 3100)
+        self.DEPLOY_PORT_MAX = _env_int(env, 'STACKOPS_DEPLOY_PORT_MAX', 3199)
+
+        # Seconds a new instance has to pass /api/health
+        self.DEPLOY_HEALTH_TIMEOUT = _env_int(env, 'STACKOPS_DEPLOY_HEALTH_TIMEOUT', 60)
+
+        # Seconds old instances get to finish in-flight requests, then to exit on SIGTERM
+        self.DEPLOY_DRAIN_TIMEOUT = _env_int(env, 'STACKOPS_DEPLOY_DRAIN_TIMEOUT', 30)
+        self.DEPLOY_STOP_GRACE = _env_int(env, 'STACKOPS_DEPLOY_STOP_GRACE', 10)
+
+        # nginx: per-client request rates (r/s) and bursts for pages and /api/
+        self.NGINX_RATE = _env_int(env, 'STACKOPS_NGINX_RATE', 20)
+        self.NGINX_BURST = _env_int(env, 'STACKOPS_NGINX_BURST', 40)
+        self.NGINX_API_RATE = _env_int(env, 'STACKOPS_NGINX_API_RATE', 5)
+        self.NGINX_API_BURST = _env_int(env, 'STACKOPS_NGINX_API_BURST', 10)
+
+        # Concurrent connections per client
+        self.NGINX_CONN_LIMIT = _env_int(env, 'STACKOPS_NGINX_CONN_LIMIT', 20)
+
+        # Clients exempt from the limits (loopback always is)
+        self.NGINX_LIMIT_ALLOWLIST = _env_list(env, 'STACKOPS_NGINX_LIMIT_ALLOWLIST', [])
+
+        # Request body limits: pages stay small, uploads go through /api/
+        self.NGINX_MAX_BODY = _env_size(env, 'STACKOPS_NGINX_MAX_BODY', '1m')
+        self.NGINX_API_MAX_BODY = _env_size(env, 'STACKOPS_NGINX_API_MAX_BODY', '50m')
+
+        for name in ('F2B_SSH_MAXRETRY', 'F2B_SSH_FINDTIME', 'F2B_SSH_BANTIME',
+                     'F2B_NGINX_MAXRETRY', 'F2B_NGINX_FINDTIME', 'F2B_NGINX_BANTIME', 'F2B_BANTIME_MAX',
+                     'DEPLOY_PORT_MIN', 'DEPLOY_HEALTH_TIMEOUT', 'DEPLOY_DRAIN_TIMEOUT', 'DEPLOY_STOP_GRACE',
+                     'NGINX_RATE', 'NGINX_BURST', 'NGINX_API_RATE', 'NGINX_API_BURST', 'NGINX_CONN_LIMIT'):
+            if getattr(self, name) <= 0:
+                raise ValueError(f"STACKOPS_{name} must be positive")
+        if not self.DEPLOY_PORT_MIN <= self.DEPLOY_PORT_MAX <= 65535:
+            raise ValueError("STACKOPS_DEPLOY_PORT_MIN..STACKOPS_DEPLOY_PORT_MAX is not a valid port range")
+
+    def to_env(self) -> Dict[str, str]:
+        """STACKOPS_* variables that reproduce these settings (stored in the provisioning state)"""
+        env = {}
+        for name, value in sorted(vars(self).items()):
+            env[f"STACKOPS_{name}"] = ' '.join(value) if isinstance(value, list) else str(value)
+        return env
@@ -1,24 +1,94 @@
 # src/server_setup/setup_manager.py
 import logging
 import subprocess
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import Optional, Dict
+from typing import Optional, Dict, List, Tuple
 import os
 import sys
 import shutil
+import time
+
+from stackops.fail2ban import fail2ban_env
+from stackops.log_config import configure_logging, log_step, new_run_id
+from stackops.preflight import PreflightCheck, PreflightReport, default_checks, run_preflight
+from stackops.ratelimit import ratelimit_env
+from stackops.settings import Settings
+from stackops.state import save_baseline, save_state, snapshot_files
+
+# Lines of script output kept for the error message when a script fails
+FAILURE_TAIL_LINES = 50
+
+class SetupStep:
+    """A single provisioning step backed by one of the installed scripts"""
+
+    def __init__(self,
+                 name: str,
+                 script: str,
+                 description: str,
+                 env_vars: Optional[Dict[str, str]] = None,
+                 depends_on: Tuple[str, ...] = ()):
+        """
+        Args:
+            name: Unique step name
+            script: Script to run from the scripts directory
+            description: Message logged when the step starts
+            env_vars: Extra environment variables for the script
+            depends_on: Names of steps that must succeed first
+        """
+        self.name = name
+        self.script = script
+        self.description = description
+        self.env_vars = env_vars or {}
+        self.depends_on = tuple(depends_on)
+
+    def __repr__(self) -> str:
+        return f"SetupStep({self.name!r}, script={self.script!r})"
 
 class ServerSetup:
     """Main class for server setup operations"""
     
-    def __init__(self):
-        """Initialize ServerSetup with logging configuration"""
+    def __init__(self,
+                 base_dir: Optional[Path] = None,
+                 env: Optional[Dict[str, str]] = None,
+                 max_workers: int = 1,
+                 settings: Optional[Settings] = None,
+                 clean_scripts: bool = False):
+        """
+        Initialize ServerSetup with logging configuration
+
+        Args:
+            base_dir: Directory holding scripts/ and logs/ (defaults to the package)
+            env: Environment overrides applied to every script
+            max_workers: Maximum number of independent steps run at once
+            settings: Host tunables (read from the environment by default)
+            clean_scripts: Remove scripts left by a previous setup (only a fresh
+                'stackops setup' should; a running agent relies on them)
+        """
         # Initialize paths
-        self.base_dir = Path(__file__).parent
+        self.base_dir = Path(base_dir) if base_dir else Path(__file__).parent
         self.scripts_dir = self.base_dir / "scripts"
         self.logs_dir = self.base_dir / "logs"
+        self.env = dict(env or {})
+        self.max_workers = max(1, max_workers)
+        # Filesystem the scripts provision (a staging dir when STACKOPS_ROOT is set)
+        self.root_dir = Path(self.env.get('STACKOPS_ROOT') or '/')
+        self.settings = settings or Settings(self.command_env())
+
+        self.run_id = new_run_id()
+
+        # Timings of the last run: step name -> (start, end) from time.perf_counter()
+        self.step_timings: Dict[str, Tuple[float, float]] = {}
+        # Outcomes of the last run: step name -> succeeded (finished steps only)
+        self.step_results: Dict[str, bool] = {}
+        self.run_started: Optional[float] = None
+        self.run_finished: Optional[float] = None
         
         # Clean up previous setup
-        self.cleanup_previous_setup()
+        if clean_scripts:
+            self.cleanup_previous_setup()
         
         # Setup logging first
         self.setup_logging()
@@ -31,12 +101,8 @@ class ServerSetup:
         self.logger.info("ServerSetup initialized")
     
     def cleanup_previous_setup(self):
-        """Clean up artifacts from previous setup"""
+        """Clean up artifacts from previous setup (logs are kept and rotated)"""
         try:
-            # Remove logs directory
-            if self.logs_dir.exists():
-                shutil.rmtree(self.logs_dir)
-            
             # Remove scripts directory
             if self.scripts_dir.exists():
                 shutil.rmtree(self.scripts_dir)
@@ -47,24 +113,25 @@ class ServerSetup:
     def setup_logging(self) -> None:
         """Configure logging for the application"""
         try:
-            # Create logs directory if it doesn't exist
-            self.logs_dir.mkdir(parents=True, exist_ok=True)
-            
-            # Configure logging
-            logging.basicConfig(
-                level=logging.INFO,
-                format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                handlers=[
-                    # File handler
-                    logging.FileHandler(self.logs_dir / 'setup.log'),
-                    # Console handler
-                    logging.StreamHandler(sys.stdout)
-                ]
-            )
+            # JSON lines to logs/setup.log (rotated) plus console, off the caller's thread
+            configure_logging(self.logs_dir, run_id=self.run_id)
         except Exception as e:
             print(f"Error setting up logging: {e}")
             sys.exit(1)
     
+    def command_env(self, env_vars: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+        """
+        Environment for scripts and commands run on behalf of this setup
+        
+        Args:
+            env_vars: Optional extra variables
+        """
+        env = os.environ.copy()
+        env.update(self.env)
+        if env_vars:
+            env.update(env_vars)
+        return env
+    
     def run_script(self, script_name: str, env_vars: Optional[Dict[str, str]] = None) -> bool:
         """
         Run a shell script with proper error handling
@@ -81,9 +148,7 @@ class ServerSetup:
             
         try:
             # Prepare environment variables
-            env = os.environ.copy()
-            if env_vars:
-                env.update(env_vars)
+            env = self.command_env(env_vars)
             
             # Run the script
             self.logger.info(f"Running script: {script_name}")
@@ -93,21 +158,31 @@ class ServerSetup:
                 self.logger.warning("Running on Windows - skipping script execution")
                 return True
             
-            result = subprocess.run(
-                ['sudo', 'bash', str(script_path)],
+            # -E keeps DOMAIN, EMAIL etc. across sudo's env_reset
+            process = subprocess.Popen(
+                ['sudo', '-E', 'bash', str(script_path)],
                 env=env,
-                check=True,
                 text=True,
+                errors='replace',
                 stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
+                stderr=subprocess.STDOUT
             )
             
-            self.logger.info(f"Script output: {result.stdout}")
+            # Stream output line by line so the pipe never backs up
+            tail = deque(maxlen=FAILURE_TAIL_LINES)
+            for line in process.stdout:
+                line = line.rstrip('\n')
+                tail.append(line)
+                self.logger.info(line)
+            process.stdout.close()
+            
+            returncode = process.wait()
+            if returncode != 0:
+                output = '\n'.join(tail)
+                self.logger.error(f"Script failed with exit code {returncode}: {output}")
+                return False
             return True
             
-        except subprocess.CalledProcessError as e:
-            self.logger.error(f"Script failed: {e.stderr}")
-            return False
         except Exception as e:
             self.logger.error(f"Error running script: {str(e)}")
             return False
@@ -138,10 +213,130 @@ class ServerSetup:
             self.logger.error(f"Environment verification failed: {str(e)}")
             return False
     
+    def preflight(self, domain: str, checks: Optional[List[PreflightCheck]] = None) -> PreflightReport:
+        """
+        Run fail-fast checks (DNS, ports, disk, memory, apt, clock) concurrently
+
+        Args:
+            domain: Domain name for the server
+            checks: Checks to run instead of the defaults
+        """
+        self.logger.info("Running preflight checks...")
+        return run_preflight(default_checks(domain) if checks is None else checks)
+
+    def build_steps(self,
+                    domain: str,
+                    email: str,
+                    github_token: Optional[str] = None) -> List[SetupStep]:
+        """
+        Build the provisioning step graph
+
+        Docker and Nginx/SSL both drive apt, so they stay serialized behind
+        the initial setup. The runner can download alongside them, but its
+        dependency install uses apt too: the scripts share an apt lock
+        (var/lib/stackops/apt.lock) so only one step drives dpkg at a time.
+
+        Args:
+            domain: Domain name for the server
+            email: Email for SSL certificate
+            github_token: Optional GitHub token for runner setup
+        """
+        steps = [
+            SetupStep('initial', 'initial_setup.sh', "Running initial server setup...",
+                      env_vars=fail2ban_env(self.settings)),
+            SetupStep('docker', 'docker_setup.sh', "Setting up Docker...",
+                      depends_on=('initial',)),
+            SetupStep('nginx_ssl', 'setup.sh', "Configuring Nginx and SSL...",
+                      env_vars={'DOMAIN': domain, 'EMAIL': email, **ratelimit_env(self.settings)},
+                      depends_on=('docker',)),
+        ]
+        if github_token:
+            steps.append(SetupStep('runner', 'runner-setup.sh', "Setting up GitHub Actions runner...",
+                                   env_vars={'GITHUB_TOKEN': github_token},
+                                   depends_on=('initial',)))
+        return steps
+
+    def _run_step(self, step: SetupStep) -> bool:
+        """Run one step and record its timing"""
+        with log_step(step.name):
+            self.logger.info(step.description)
+            started = time.perf_counter()
+            try:
+                return self.run_script(step.script, step.env_vars)
+            finally:
+                self.step_timings[step.name] = (started, time.perf_counter())
+
+    def run_steps(self, steps: List[SetupStep]) -> bool:
+        """
+        Run steps in dependency order, up to max_workers at a time
+
+        Dependencies on steps that are not in the list are treated as
+        already satisfied, so a subset can be re-applied. No new steps are
+        started once one has failed; steps already running are allowed to
+        finish.
+
+        Args:
+            steps: Steps to run
+        """
+        self.step_timings = {}
+        self.step_results = {}
+        self.run_started = time.perf_counter()
+        pending = {step.name: step for step in steps}
+        # Steps outside this run count as done
+        done = {dep for step in steps for dep in step.depends_on if dep not in pending}
+        failed = []
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                running = {}
+                while pending or running:
+                    if not failed:
+                        ready = [step for step in pending.values()
+                                 if all(dep in done for dep in step.depends_on)]
+                        for step in ready[:self.max_workers - len(running)]:
+                            del pending[step.name]
+                            running[executor.submit(self._run_step, step)] = step
+
+                    if not running:
+                        if pending and not failed:
+                            missing = sorted(pending)
+                            self.logger.error(f"Unsatisfiable step dependencies: {missing}")
+                            return False
+                        break
+
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        step = running.pop(future)
+                        self.step_results[step.name] = future.result()
+                        if self.step_results[step.name]:
+                            done.add(step.name)
+                        else:
+                            self.logger.error(f"Step '{step.name}' failed")
+                            failed.append(step.name)
+        finally:
+            self.run_finished = time.perf_counter()
+
+        return not failed
+
+    def record_state(self, domain: str, email: str, steps: List[str]) -> None:
+        """Record what was provisioned so drift can be detected and repaired later"""
+        save_baseline(self.root_dir, steps)
+        save_state(self.root_dir, {
+            'run_id': self.run_id,
+            'domain': domain,
+            'email': email,
+            'steps': steps,
+            # Re-applied steps must render with these, not the agent's environment
+            'settings': self.settings.to_env(),
+            'files': snapshot_files(self.root_dir, steps),
+            'completed_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        })
+
     def run_setup(self, 
                  domain: str,
                  email: str,
-                 github_token: Optional[str] = None) -> bool:
+                 github_token: Optional[str] = None,
+                 preflight_checks: Optional[List[PreflightCheck]] = None) -> bool:
         """
         Run the complete setup process
         
@@ -149,36 +344,22 @@ class ServerSetup:
             domain: Domain name for the server
             email: Email for SSL certificate
             github_token: Optional GitHub token for runner setup
+            preflight_checks: Checks to run first (defaults; [] skips preflight)
         """
         try:
             self.logger.info("Starting server setup process...")
-            
-            # 1. Run initial setup
-            self.logger.info("Running initial server setup...")
-            if not self.run_script('initial_setup.sh'):
-                return False
-                
-            # 2. Run Docker setup
-            self.logger.info("Setting up Docker...")
-            if not self.run_script('docker_setup.sh'):
-                return False
-                
-            # 3. Configure Nginx and SSL
-            self.logger.info("Configuring Nginx and SSL...")
-            if not self.run_script('setup.sh', {
-                'DOMAIN': domain,
-                'EMAIL': email
-            }):
-                return False
-                
-            # 4. Set up GitHub runner if token provided
-            if github_token:
-                self.logger.info("Setting up GitHub Actions runner...")
-                if not self.run_script('runner-setup.sh', {
-                    'GITHUB_TOKEN': github_token
-                }):
+
+            if preflight_checks is None or preflight_checks:
+                report = self.preflight(domain, preflight_checks)
+                if not report.ok:
+                    self.logger.error("Preflight checks failed - nothing was changed")
                     return False
-            
+
+            steps = self.build_steps(domain, email, github_token)
+            if not self.run_steps(steps):
+                return False
+
+            self.record_state(domain, email, [step.name for step in steps])
             self.logger.info("Setup completed successfully!")
             return True
             
@@ -0,0 +1,87 @@
+# src/stackops/state.py
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+# Where the result of the last successful provisioning is recorded
+STATE_PATH = "var/lib/stackops/state.json"
+
+# Copies of the managed files as provisioned, restored by the drift agent
+BASELINE_DIR = "var/lib/stackops/baseline"
+
+# Files the provisioning scripts render, keyed by path relative to the root,
+# with the step that owns (and can re-create) them
+MANAGED_FILES: Dict[str, str] = {
+    'etc/nginx/nginx.conf': 'initial',
+    'etc/fail2ban/jail.local': 'initial',
+    'etc/fail2ban/filter.d/stackops-nginx-4xx.conf': 'initial',
+    'etc/nginx/sites-available/nextjs-app': 'nginx_ssl',
+    'etc/nginx/conf.d/stackops-limits.conf': 'nginx_ssl',
+    'etc/nginx/snippets/stackops-limits-app.conf': 'nginx_ssl',
+    'etc/nginx/snippets/stackops-limits-api.conf': 'nginx_ssl',
+    'etc/nginx/snippets/stackops-security-headers.conf': 'nginx_ssl',
+    'etc/cron.d/certbot-renewal': 'nginx_ssl',
+    'etc/systemd/system/actions-runner.service': 'runner',
+}
+
+# Services the steps enable, with their owning step
+MANAGED_SERVICES: Dict[str, str] = {
+    'nginx': 'initial',
+    'fail2ban': 'initial',
+    'docker': 'docker',
+    'actions-runner': 'runner',
+}
+
+
+def file_digest(path: Path) -> Optional[str]:
+    """Return the sha256 of a file, or None if it does not exist"""
+    try:
+        return hashlib.sha256(path.read_bytes()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def snapshot_files(root: Path, steps: Iterable[str]) -> Dict[str, Optional[str]]:
+    """Digest every managed file owned by the given steps"""
+    steps = set(steps)
+    return {rel: file_digest(root / rel) for rel, step in MANAGED_FILES.items() if step in steps}
+
+
+def save_baseline(root: Path, steps: Iterable[str]) -> None:
+    """Keep a copy of every managed file owned by the given steps"""
+    steps = set(steps)
+    for rel, step in MANAGED_FILES.items():
+        if step not in steps:
+            continue
+        copy = root / BASELINE_DIR / rel
+        if (root / rel).is_file():
+            copy.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(root / rel, copy)
+        elif copy.exists():
+            copy.unlink()
+
+
+def baseline_copy(root: Path, rel: str) -> Optional[Path]:
+    """The provisioned copy of a managed file, if one was kept"""
+    copy = root / BASELINE_DIR / rel
+    return copy if copy.is_file() else None
+
+
+def load_state(root: Path, path: str = STATE_PATH) -> Optional[Dict]:
+    """Load the provisioning state, or None if this host was never provisioned"""
+    try:
+        return json.loads((root / path).read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def save_state(root: Path, state: Dict, path: str = STATE_PATH) -> None:
+    """Write the provisioning state atomically"""
+    path = root / path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + '.tmp')
+    tmp_path.write_text(json.dumps(state, indent=2, sort_keys=True))
+    os.replace(tmp_path, path)
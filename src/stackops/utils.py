@@ -3,6 +3,17 @@ import os
 from pathlib import Path
 from typing import Dict
 
+def ensure_directory_exists(directory: Path) -> Path:
+    """
+    Create a directory (and any parents) if it does not exist yet
+    
+    Args:
+        directory: Directory to create
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    return directory
+
 def install_scripts(scripts_dir: Path) -> bool:
     """
     Install required shell scripts to the scripts directory
@@ -11,7 +22,7 @@ def install_scripts(scripts_dir: Path) -> bool:
         scripts_dir: Directory to install scripts to
     """
     # Ensure directory exists
-    scripts_dir.mkdir(parents=True, exist_ok=True)
+    ensure_directory_exists(scripts_dir)
     
     # Define scripts content
     scripts: Dict[str, str] = {
@@ -20,6 +31,9 @@ def install_scripts(scripts_dir: Path) -> bool:
 # Exit on any error
 set -e
 
+# Target root filesystem (empty on a real host)
+ROOT="${STACKOPS_ROOT:-}"
+
 # Colors for output
 GREEN='\\033[0;32m'
 RED='\\033[0;31m'
@@ -35,7 +49,7 @@ error() {
 }
 
 # Check if running as root
-if [ "$EUID" -ne 0 ]; then 
+if [ "$EUID" -ne 0 ] && [ -z "$ROOT" ]; then
     error "Please run as root or with sudo"
     exit 1
 fi
@@ -49,7 +63,13 @@ apt upgrade -y --only-upgrade
 log "Installing essential packages..."
 apt install -y nginx \\
     ufw \\
-    fail2ban
+    fail2ban \\
+    nftables \\
+    python3-systemd
+
+# Brotli static module (not packaged on every release, so optional)
+apt install -y libnginx-mod-http-brotli-static 2>/dev/null || \\
+    log "Brotli static module not available - serving .gz assets only"
 
 # Remove unnecessary services and packages
 log "Removing unnecessary services..."
@@ -66,28 +86,28 @@ ufw allow ssh
 ufw allow 'Nginx HTTP'
 echo "y" | ufw enable
 
-# Basic fail2ban configuration (minimal)
+# fail2ban reads the journal and bans into nftables sets; the jails are
+# rendered by stackops from its settings and passed in the environment
 log "Configuring fail2ban..."
-cat > /etc/fail2ban/jail.local <<EOF
-[sshd]
-enabled = true
-port = ssh
-filter = sshd
-logpath = /var/log/auth.log
-maxretry = 3
-bantime = 3600
-findtime = 3600
-EOF
+if [ -z "$F2B_JAIL_LOCAL" ] || [ -z "$F2B_NGINX_FILTER" ]; then
+    error "fail2ban configuration missing - run this script through stackops"
+    exit 1
+fi
+mkdir -p $ROOT/etc/fail2ban/filter.d
+printf '%s' "$F2B_JAIL_LOCAL" > $ROOT/etc/fail2ban/jail.local
+printf '%s' "$F2B_NGINX_FILTER" > $ROOT/etc/fail2ban/filter.d/${F2B_NGINX_FILTER_NAME}.conf
+fail2ban-client -t
 
 systemctl enable fail2ban
 systemctl restart fail2ban
 
 # Optimize Nginx for t2.micro
 log "Configuring Nginx with minimal resource usage..."
-cat > /etc/nginx/nginx.conf <<EOF
+cat > $ROOT/etc/nginx/nginx.conf <<EOF
 user www-data;
 worker_processes 1;
 pid /run/nginx.pid;
+include /etc/nginx/modules-enabled/*.conf;
 
 events {
     worker_connections 512;
@@ -118,7 +138,16 @@ http {
     error_log /var/log/nginx/error.log crit;
 
     # Gzip Settings
-    gzip off;  # Disable gzip to save CPU
+    gzip off;  # Disable on-the-fly gzip to save CPU
+    gzip_static on;  # Serve .gz files built by 'stackops assets build'
+    gzip_vary on;
+
+    # Cache file descriptors and stat() results for static files
+    open_file_cache max=1000 inactive=60s;
+    open_file_cache_valid 60s;
+    open_file_cache_min_uses 2;
+    # Not caching lookup errors: .gz/.br siblings from a fresh assets build
+    # are served straight away rather than after open_file_cache_valid
 
     # Include virtual host configs
     include /etc/nginx/conf.d/*.conf;
@@ -126,8 +155,15 @@ http {
 }
 EOF
 
+# Serve precompressed .br files when the brotli module is loaded
+if ls $ROOT/etc/nginx/modules-enabled/ 2>/dev/null | grep -q brotli; then
+    echo "brotli_static on;" > $ROOT/etc/nginx/conf.d/brotli-static.conf
+else
+    rm -f $ROOT/etc/nginx/conf.d/brotli-static.conf
+fi
+
 # Create minimal server block
-cat > /etc/nginx/sites-available/default <<EOF
+cat > $ROOT/etc/nginx/sites-available/default <<EOF
 server {
     listen 80 default_server;
     listen [::]:80 default_server;
@@ -156,7 +192,7 @@ server {
 EOF
 
 # Create a simple index page
-cat > /var/www/html/index.html <<EOF
+cat > $ROOT/var/www/html/index.html <<EOF
 <!DOCTYPE html>
 <html>
 <head>
@@ -170,8 +206,8 @@ EOF
 
 # Set proper permissions
 log "Setting proper permissions..."
-chown -R www-data:www-data /var/www/html
-chmod -R 755 /var/www/html
+chown -R www-data:www-data $ROOT/var/www/html
+chmod -R 755 $ROOT/var/www/html
 
 # Enable and restart services
 log "Starting services..."
@@ -193,7 +229,7 @@ top -bn1 | head -n 5
 
 log "Important notes:"
 echo "1. Access logs are disabled to reduce disk I/O"
-echo "2. Gzip is disabled to save CPU"
+echo "2. On-the-fly gzip is disabled; precompress assets with: stackops assets build"
 echo "3. Worker processes set to 1 for t2.micro"
 echo "4. Monitor resource usage with: htop or top"
 echo "5. Check error logs at: /var/log/nginx/error.log"
@@ -203,6 +239,16 @@ echo "5. Check error logs at: /var/log/nginx/error.log"
 # setup.sh - Run this once when setting up the EC2 instance
 set -e
 
+# Target root filesystem (empty on a real host)
+ROOT="${STACKOPS_ROOT:-}"
+
+# Steps may run in parallel but dpkg takes one client at a time: hold the
+# shared apt lock for the whole install
+APT_LOCK="$ROOT/var/lib/stackops/apt.lock"
+sudo mkdir -p $ROOT/var/lib/stackops
+exec 9>"$APT_LOCK"
+flock 9
+
 # Update system
 sudo apt update && sudo apt upgrade -y
 
@@ -216,16 +262,16 @@ sudo apt install -y ca-certificates curl gnupg software-properties-common
 
 # Add Docker's official GPG key
 echo "Adding Docker's GPG key..."
-sudo install -m 0755 -d /etc/apt/keyrings
-curl -fsSL https://download.docker.com/linux/ubuntu/gpg | sudo gpg --dearmor -o /etc/apt/keyrings/docker.gpg
-sudo chmod a+r /etc/apt/keyrings/docker.gpg
+sudo install -m 0755 -d $ROOT/etc/apt/keyrings
+curl -fsSL https://download.docker.com/linux/ubuntu/gpg | sudo gpg --dearmor -o $ROOT/etc/apt/keyrings/docker.gpg
+sudo chmod a+r $ROOT/etc/apt/keyrings/docker.gpg
 
 # Add Docker repository
 echo "Adding Docker repository..."
 echo \\
   "deb [arch="$(dpkg --print-architecture)" signed-by=/etc/apt/keyrings/docker.gpg] https://download.docker.com/linux/ubuntu \\
-  "$(. /etc/os-release && echo "$VERSION_CODENAME")" stable" | \\
-  sudo tee /etc/apt/sources.list.d/docker.list > /dev/null
+  "$(. $ROOT/etc/os-release && echo "$VERSION_CODENAME")" stable" | \\
+  sudo tee $ROOT/etc/apt/sources.list.d/docker.list > /dev/null
 
 # Update apt after adding Docker repository
 sudo apt update
@@ -245,49 +291,95 @@ sudo usermod -a -G docker ubuntu
 ''',
         'setup.sh': '''#!/bin/bash
 
+# Exit on any error, so a failed nginx test or certbot run fails the step
+set -e
+
 # Variables from environment
 DOMAIN="${DOMAIN}"    # Will be set from Python
 EMAIL="${EMAIL}"      # Will be set from Python
+ROOT="${STACKOPS_ROOT:-}"  # Target root filesystem (empty on a real host)
+APT_LOCK="$ROOT/var/lib/stackops/apt.lock"  # Shared with other steps using apt
 
 echo "Starting setup..."
 
 # Install Certbot and Nginx plugin
 echo "Installing Certbot..."
-sudo apt install -y certbot python3-certbot-nginx
+sudo mkdir -p $ROOT/var/lib/stackops
+sudo flock "$APT_LOCK" apt install -y certbot python3-certbot-nginx
 
 # Create application directory structure
 echo "Creating application directories..."
 
-sudo mkdir -p /var/www/app/scripts
-sudo mkdir -p /var/www/app/logs
-sudo mkdir -p /tmp/ffmpeg
+sudo mkdir -p $ROOT/var/www/app/scripts
+sudo mkdir -p $ROOT/var/www/app/logs
+sudo mkdir -p $ROOT/var/www/app/static
+sudo mkdir -p $ROOT/tmp/ffmpeg
 
 # Set proper permissions
 echo "Setting up permissions..."
-sudo chmod 1777 /tmp/ffmpeg
-sudo chown -R ubuntu:ubuntu /var/www/app
-sudo chmod -R 755 /var/www/app
+sudo chmod 1777 $ROOT/tmp/ffmpeg
+sudo chown -R ubuntu:ubuntu $ROOT/var/www/app
+sudo chmod -R 755 $ROOT/var/www/app
+
+# App backends; 'stackops deploy' rewrites this file, so keep it if present
+if [ ! -f $ROOT/etc/nginx/conf.d/stackops-upstream.conf ]; then
+    sudo tee $ROOT/etc/nginx/conf.d/stackops-upstream.conf << EOL
+upstream stackops_app {
+    server 127.0.0.1:3002;
+}
+EOL
+fi
+
+# Rate and connection limits, rendered by stackops from its settings
+echo "Setting up request limits..."
+if [ -z "$NGINX_LIMITS_CONF" ] || [ -z "$NGINX_LIMITS_APP" ] || [ -z "$NGINX_LIMITS_API" ]; then
+    echo "Request limit profile missing - run this script through stackops"
+    exit 1
+fi
+sudo mkdir -p $ROOT/etc/nginx/snippets
+
+# Security headers, included wherever a location sets its own add_header
+# (add_header in a location drops those inherited from the server block)
+sudo tee $ROOT/etc/nginx/snippets/stackops-security-headers.conf > /dev/null << 'EOL'
+# Managed by stackops
+add_header X-Frame-Options "SAMEORIGIN";
+add_header X-Content-Type-Options "nosniff";
+add_header X-XSS-Protection "1; mode=block";
+add_header Strict-Transport-Security "max-age=31536000; includeSubDomains" always;
+EOL
+printf '%s' "$NGINX_LIMITS_CONF" | sudo tee $ROOT/etc/nginx/conf.d/stackops-limits.conf > /dev/null
+printf '%s' "$NGINX_LIMITS_APP" | sudo tee $ROOT/etc/nginx/snippets/stackops-limits-app.conf > /dev/null
+printf '%s' "$NGINX_LIMITS_API" | sudo tee $ROOT/etc/nginx/snippets/stackops-limits-api.conf > /dev/null
 
 # Create Nginx configuration for the application
 echo "Setting up Nginx configuration..."
-sudo tee /etc/nginx/sites-available/nextjs-app << EOL
+sudo tee $ROOT/etc/nginx/sites-available/nextjs-app << EOL
+# Client errors are also sent to the journal for fail2ban's nginx-4xx jail.
+# 429s from the rate limits are left out: going over a burst is already
+# answered by limit_req and must not escalate to a firewall ban.
+map \\$status \\$stackops_4xx {
+    ~^429   0;
+    ~^4     1;
+    default 0;
+}
+log_format stackops_4xx '\\$remote_addr \\$status \\$request_method "\\$uri"';
+
 server {
     listen 80;
     server_name ${DOMAIN};
 
     # Access and error logs
     access_log /var/log/nginx/nextjs-access.log;
+    access_log syslog:server=unix:/dev/log,tag=nginx_4xx,nohostname stackops_4xx if=\\$stackops_4xx;
     error_log /var/log/nginx/nextjs-error.log;
 
     # Security headers
-    add_header X-Frame-Options "SAMEORIGIN";
-    add_header X-Content-Type-Options "nosniff";
-    add_header X-XSS-Protection "1; mode=block";
-    add_header Strict-Transport-Security "max-age=31536000; includeSubDomains" always;
+    include /etc/nginx/snippets/stackops-security-headers.conf;
 
     # Proxy settings
     location / {
-        proxy_pass http://localhost:3002;
+        include /etc/nginx/snippets/stackops-limits-app.conf;
+        proxy_pass http://stackops_app;
         proxy_http_version 1.1;
         proxy_set_header Upgrade \\$http_upgrade;
         proxy_set_header Connection 'upgrade';
@@ -297,39 +389,69 @@ server {
         proxy_set_header X-Forwarded-Proto \\$scheme;
           proxy_buffering off;
         proxy_read_timeout 86400;
-        
-        # Large client_max_body_size for file uploads
-        client_max_body_size 50M;
+    }
+
+    # API routes: stricter rate, larger bodies for uploads
+    location /api/ {
+        include /etc/nginx/snippets/stackops-limits-api.conf;
+        proxy_pass http://stackops_app;
+        proxy_http_version 1.1;
+        proxy_set_header Upgrade \\$http_upgrade;
+        proxy_set_header Connection 'upgrade';
+        proxy_set_header Host \\$host;
+        proxy_set_header X-Real-IP \\$remote_addr;
+        proxy_set_header X-Forwarded-For \\$proxy_add_x_forwarded_for;
+        proxy_set_header X-Forwarded-Proto \\$scheme;
+        proxy_buffering off;
+        proxy_read_timeout 86400;
     }
 
     # Health check endpoint
     location /api/health {
-        proxy_pass http://localhost:3002;
+        include /etc/nginx/snippets/stackops-limits-app.conf;
+        proxy_pass http://stackops_app;
         proxy_http_version 1.1;
         proxy_set_header Host \\$host;
         proxy_cache_bypass \\$http_upgrade;
     }
 
-    # Static files caching
+    # Precompressed static assets (stackops assets build /var/www/app/static); not rate limited
+    location /static/ {
+        root /var/www/app;
+        gzip_static on;
+        expires 1y;
+        include /etc/nginx/snippets/stackops-security-headers.conf;
+        add_header Cache-Control "public, no-transform";
+        access_log off;
+
+        # Keep build state and other dotfiles private
+        location ~ /\\. {
+            deny all;
+        }
+    }
+
+    # Static files caching; not rate limited
     location /_next/static {
-        proxy_pass http://localhost:3002;
+        proxy_pass http://stackops_app;
         proxy_cache_bypass \\$http_upgrade;
         proxy_set_header Host \\$host;
         proxy_cache_use_stale error timeout http_500 http_502 http_503 http_504;
         proxy_cache_valid 200 60m;
         expires 1y;
+        include /etc/nginx/snippets/stackops-security-headers.conf;
         add_header Cache-Control "public, no-transform";
     }
 }
 EOL
 
 # Enable the site
-sudo ln -sf /etc/nginx/sites-available/nextjs-app /etc/nginx/sites-enabled/
-sudo rm -f /etc/nginx/sites-enabled/default
+sudo ln -sf /etc/nginx/sites-available/nextjs-app $ROOT/etc/nginx/sites-enabled/
+sudo rm -f $ROOT/etc/nginx/sites-enabled/default
 
 # Test Nginx configuration
 echo "Testing Nginx configuration..."
-sudo nginx -t && sudo systemctl restart nginx
+sudo nginx -t
+sudo systemctl restart nginx
 
 # Obtain SSL certificate
 echo "Obtaining SSL certificate..."
@@ -342,17 +464,17 @@ sudo certbot --nginx \\
 
 # Set up automatic renewal
 echo "Setting up automatic SSL renewal..."
-sudo tee /etc/cron.d/certbot-renewal << EOL
+sudo tee $ROOT/etc/cron.d/certbot-renewal << EOL
 0 */12 * * * root certbot renew --quiet --deploy-hook "systemctl reload nginx"
 EOL
 
 # Create SSL renewal test script
 echo "Creating SSL renewal test script..."
-sudo tee /var/www/app/scripts/test-ssl-renewal.sh << EOL
+sudo tee $ROOT/var/www/app/scripts/test-ssl-renewal.sh << EOL
 #!/bin/bash
 sudo certbot renew --dry-run
 EOL
-sudo chmod +x /var/www/app/scripts/test-ssl-renewal.sh
+sudo chmod +x $ROOT/var/www/app/scripts/test-ssl-renewal.sh
 
 echo "Setup completed successfully!"
 echo "SSL certificate has been installed for ${DOMAIN}"
@@ -361,45 +483,62 @@ echo ""
 echo "Next steps:"
 echo "1. Verify HTTPS is working: https://${DOMAIN}"
 echo "2. Test SSL renewal: ./test-ssl-renewal.sh"
-echo "3. Deploy your application using the deploy script"
+echo "3. Deploy your application: stackops deploy --image <image> (or --command <cmd>)"
 ''',
         'runner-setup.sh': '''#!/bin/bash
 
 # Variables will be set from Python
 GITHUB_TOKEN="${GITHUB_TOKEN}"
+ROOT="${STACKOPS_ROOT:-}"  # Target root filesystem (empty on a real host)
+RUNNER_VERSION="2.314.1"
+RUNNER_TARBALL="actions-runner-linux-x64-${RUNNER_VERSION}.tar.gz"
+RUNNER_CACHE="$ROOT/var/cache/stackops"
+APT_LOCK="$ROOT/var/lib/stackops/apt.lock"  # Shared with other steps using apt
 
 # Stop the service
 sudo systemctl stop actions-runner || true
 
 # Remove the service
 sudo systemctl disable actions-runner || true
-sudo rm -f /etc/systemd/system/actions-runner.service
+sudo rm -f $ROOT/etc/systemd/system/actions-runner.service
 
-# Clean up old runner
-cd /home/ubuntu/actions-runner || exit
-sudo ./svc.sh uninstall || true
-cd /home/ubuntu
+# Clean up old runner (if any)
+if [ -d $ROOT/home/ubuntu/actions-runner ]; then
+    cd $ROOT/home/ubuntu/actions-runner
+    sudo ./svc.sh uninstall || true
+fi
+cd $ROOT/home/ubuntu
 sudo rm -rf actions-runner
 
 # Create new runner directory
-mkdir -p /home/ubuntu/actions-runner
-cd /home/ubuntu/actions-runner
-
-# Download latest runner
-curl -o actions-runner-linux-x64.tar.gz -L \\
-    https://github.com/actions/runner/releases/download/v2.314.1/actions-runner-linux-x64-2.314.1.tar.gz
+mkdir -p $ROOT/home/ubuntu/actions-runner
+cd $ROOT/home/ubuntu/actions-runner
+
+# Download runner (reusing a cached copy, e.g. restored from a bundle)
+if [ -f $RUNNER_CACHE/$RUNNER_TARBALL ]; then
+    cp $RUNNER_CACHE/$RUNNER_TARBALL actions-runner-linux-x64.tar.gz
+else
+    curl -o actions-runner-linux-x64.tar.gz -L \\
+        https://github.com/actions/runner/releases/download/v${RUNNER_VERSION}/${RUNNER_TARBALL}
+    sudo mkdir -p $RUNNER_CACHE
+    sudo cp actions-runner-linux-x64.tar.gz $RUNNER_CACHE/$RUNNER_TARBALL
+fi
 
 # Extract runner
 tar xzf ./actions-runner-linux-x64.tar.gz
 
-# Install dependencies
-./bin/installdependencies.sh
+# Install dependencies (apt-get, so wait for other steps to finish with dpkg)
+sudo mkdir -p $ROOT/var/lib/stackops
+if ! sudo flock "$APT_LOCK" ./bin/installdependencies.sh; then
+    echo "Installing runner dependencies failed"
+    exit 1
+fi
 
 # Configure runner with token
 ./config.sh --url https://github.com/your-repo --token ${GITHUB_TOKEN} --unattended
 
 # Create service file
-sudo tee /etc/systemd/system/actions-runner.service << 'EOF'
+sudo tee $ROOT/etc/systemd/system/actions-runner.service << 'EOF'
 [Unit]
 Description=GitHub Actions Runner
 After=network.target
@@ -419,8 +558,8 @@ WantedBy=multi-user.target
 EOF
 
 # Set permissions
-sudo chown -R ubuntu:ubuntu /home/ubuntu/actions-runner
-sudo chmod +x /home/ubuntu/actions-runner/run.sh
+sudo chown -R ubuntu:ubuntu $ROOT/home/ubuntu/actions-runner
+sudo chmod +x $ROOT/home/ubuntu/actions-runner/run.sh
 
 # Configure systemd
 sudo systemctl daemon-reload
@@ -0,0 +1,44 @@
+# tests/dummy_app.py
+"""Stand-in for the Node app: serves / and /api/health on $PORT
+
+DUMMY_STARTUP_DELAY  seconds before the port opens (warm-up)
+DUMMY_UNHEALTHY      when set, /api/health answers 503
+DUMMY_REQUEST_DELAY  seconds each request takes
+"""
+import os
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        time.sleep(float(os.environ.get('DUMMY_REQUEST_DELAY', '0')))
+        if self.path == '/api/health' and os.environ.get('DUMMY_UNHEALTHY'):
+            status, body = 503, b'starting'
+        else:
+            status, body = 200, os.environ.get('STACKOPS_RELEASE', 'dev').encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    time.sleep(float(os.environ.get('DUMMY_STARTUP_DELAY', '0')))
+    server = ThreadingHTTPServer(('127.0.0.1', int(os.environ['PORT'])), Handler)
+    server.daemon_threads = True
+    # Finish in-flight requests on SIGTERM, like a well-behaved app
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    server.serve_forever()
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,308 @@
+# tests/harness.py
+"""Hermetic provisioning harness: a fake root filesystem plus stub binaries"""
+import io
+import os
+import shlex
+import tarfile
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from stackops.settings import Settings
+from stackops.setup_manager import ServerSetup
+from stackops.utils import install_scripts
+
+# Commands the provisioning scripts shell out to that must never hit the host
+STUB_COMMANDS = (
+    'apt', 'apt-get', 'apt-cache', 'systemctl', 'nginx', 'certbot', 'curl', 'docker',
+    'ufw', 'gpg', 'dpkg', 'dpkg-query', 'chown', 'usermod', 'free', 'df', 'top', 'fail2ban-client',
+)
+
+# Directories an Ubuntu image (plus the packages the scripts install) provides
+ROOT_SKELETON = (
+    'etc/nginx/sites-available', 'etc/nginx/sites-enabled', 'etc/nginx/conf.d',
+    'etc/nginx/modules-enabled', 'etc/fail2ban', 'etc/cron.d', 'etc/systemd/system',
+    'etc/apt/sources.list.d', 'var/www/html', 'var/log/nginx', 'home/ubuntu', 'tmp',
+)
+
+# Command-specific behaviour appended to the generic stub body
+STUB_BEHAVIOUR = {
+    'curl': '''out=""
+while [ $# -gt 0 ]; do
+    case "$1" in -o) out="$2"; shift ;; esac
+    shift
+done
+if [ -n "$out" ]; then
+    cp "$STUB_CURL_PAYLOAD" "$out" 2>/dev/null || : > "$out"
+else
+    echo "stub payload"
+fi
+''',
+    'gpg': '''cat > /dev/null
+while [ $# -gt 0 ]; do
+    case "$1" in -o) : > "$2"; shift ;; esac
+    shift
+done
+''',
+    'dpkg': 'echo amd64\n',
+    # Versions come from the harness package table (default 1.0-stub; '-' is not installed)
+    'dpkg-query': '''for arg in "$@"; do
+    case "$arg" in -*) continue ;; esac
+    entry=$(grep -m1 "^$arg " "$STUB_PACKAGES" 2>/dev/null)
+    version=$(echo "$entry" | cut -d' ' -f2)
+    priority=$(echo "$entry" | cut -d' ' -f3)
+    case "$version" in
+        -) printf "%s\\t\\tun \\tno\\toptional\\n" "$arg" ;;
+        *) printf "%s\\t%s\\tii \\tno\\t%s\\n" "$arg" "${version:-1.0-stub}" "${priority:-optional}" ;;
+    esac
+done
+''',
+    # Dependencies come from the package table's fourth column onwards
+    'apt-cache': '''[ "$1" = depends ] || exit 0
+seen=" "
+queue=()
+for arg in "$@"; do
+    case "$arg" in -*|depends) ;; *) queue+=("$arg") ;; esac
+done
+while [ ${#queue[@]} -gt 0 ]; do
+    name="${queue[0]}"
+    queue=("${queue[@]:1}")
+    [[ "$seen" == *" $name "* ]] && continue
+    seen="$seen$name "
+    echo "$name"
+    for dep in $(grep -m1 "^$name " "$STUB_PACKAGES" 2>/dev/null | cut -d' ' -f4-); do
+        echo "  Depends: $dep"
+        queue+=("$dep")
+    done
+done
+''',
+    # Deployed app instances (stackops-app@<name>) really run, supervised by the stub:
+    # started from their EnvironmentFile, stopped with SIGTERM then SIGKILL
+    'systemctl': '''unit=""
+for arg in "$@"; do
+    case "$arg" in stackops-app@*) unit="${arg%.service}" ;; esac
+done
+[ -n "$unit" ] || exit 0
+name="${unit#stackops-app@}"
+pidfile="$STACKOPS_ROOT/run/$unit.pid"
+pid=$(cat "$pidfile" 2>/dev/null)
+alive() { [ -n "$pid" ] && [ -e /proc/$pid ] && ! grep -q '^State:.*[ZX]' /proc/$pid/status 2>/dev/null; }
+case "$1 $2" in
+    "enable --now"*|start*)
+        mkdir -p "$STACKOPS_ROOT/run"
+        (set -a; . "$STACKOPS_ROOT/etc/stackops/app/$name.env"; set +a
+         exec setsid /bin/sh -c "$STACKOPS_APP_COMMAND") \\
+            >> "$STACKOPS_ROOT/var/www/app/logs/app-$name.log" 2>&1 < /dev/null &
+        echo $! > "$pidfile"
+        ;;
+    is-active*)
+        alive || exit 3
+        ;;
+    kill*)
+        alive && kill -KILL -- -$pid
+        ;;
+    "disable --now"*|stop*)
+        if alive; then
+            kill -TERM -- -$pid
+            for _ in $(seq 60); do alive || break; sleep 0.05; done
+            alive && kill -KILL -- -$pid
+        fi
+        rm -f "$pidfile"
+        ;;
+esac
+''',
+    'apt-get': '''if [ "$1" = download ]; then
+    shift
+    for spec in "$@"; do
+        version="${spec#*=}"
+        echo "deb $spec" > "${spec%%=*}_${version//:/%3a}_amd64.deb"
+    done
+fi
+''',
+}
+
+# The runner's dependency installer drives apt-get, like the real one
+RUNNER_FILES = {
+    'bin/installdependencies.sh': 'apt-get install -y libicu70 libkrb5-3 zlib1g || exit 1\n',
+    'config.sh': '',
+    'run.sh': '',
+    'svc.sh': '',
+}
+
+
+class StubSpec:
+    """Latency and failure injection for one stub binary"""
+
+    def __init__(self, latency: float = 0.0, fail_on: Optional[str] = None, exit_code: int = 1,
+                 output_lines: int = 0):
+        """
+        Args:
+            latency: Seconds each invocation sleeps
+            fail_on: Fail when the arguments contain this text ('' fails every call)
+            exit_code: Exit status used for injected failures
+            output_lines: Lines of output each invocation prints (e.g. apt progress)
+        """
+        self.latency = latency
+        self.fail_on = fail_on
+        self.exit_code = exit_code
+        self.output_lines = output_lines
+
+
+class RunReport:
+    """Timing breakdown of one provisioning run"""
+
+    def __init__(self, success: bool, setup: ServerSetup, steps: list):
+        self.success = success
+        # Steps never started (e.g. preflight failed): nothing to time
+        self.total = (setup.run_finished - setup.run_started) if setup.run_started else 0.0
+        self.step_timings = dict(setup.step_timings)
+        self.step_durations = {name: end - start for name, (start, end) in setup.step_timings.items()}
+        self.critical_path = self._critical_path(steps)
+
+    def _critical_path(self, steps: list) -> float:
+        """Longest chain of measured step durations through the dependency graph"""
+        finish: Dict[str, float] = {}
+        for step in steps:  # build_steps() lists dependencies first
+            if step.name not in self.step_durations:
+                continue
+            ready = max((finish.get(dep, 0.0) for dep in step.depends_on), default=0.0)
+            finish[step.name] = ready + self.step_durations[step.name]
+        return max(finish.values(), default=0.0)
+
+    @property
+    def busy_time(self) -> float:
+        """Wall time during which at least one step was running"""
+        busy, covered_until = 0.0, float('-inf')
+        for start, end in sorted(self.step_timings.values()):
+            if end > covered_until:
+                busy += end - max(start, covered_until)
+                covered_until = end
+        return busy
+
+    @property
+    def scheduling_overhead(self) -> float:
+        """Wall time spent in the orchestrator with no step running"""
+        return max(0.0, self.total - self.busy_time)
+
+
+class ProvisioningHarness:
+    """Run ServerSetup end to end against a fake root and stub binaries"""
+
+    def __init__(self, base_dir: Path, stubs: Optional[Dict[str, StubSpec]] = None):
+        """
+        Args:
+            base_dir: Empty directory the harness owns
+            stubs: Per-command StubSpec overrides
+        """
+        self.base_dir = Path(base_dir)
+        self.root = self.base_dir / "root"
+        self.bin_dir = self.base_dir / "bin"
+        self.app_dir = self.base_dir / "app"
+        self.call_log = self.base_dir / "calls.log"
+        self.runner_tarball = self.base_dir / "actions-runner.tar.gz"
+        self.package_table = self.base_dir / "packages"
+        self.stubs = {name: StubSpec() for name in STUB_COMMANDS}
+        self.stubs.update(stubs or {})
+        self.install()
+
+    def install(self) -> None:
+        """Create the fake root, the stub binaries and the runner tarball"""
+        for directory in ROOT_SKELETON:
+            (self.root / directory).mkdir(parents=True, exist_ok=True)
+        (self.root / "etc/os-release").write_text('VERSION_CODENAME=jammy\n')
+        self.bin_dir.mkdir(parents=True, exist_ok=True)
+        self.call_log.touch()
+        self.package_table.touch()
+        for name, spec in self.stubs.items():
+            self._write_stub(name, spec)
+        self._write_sudo()
+        self._write_runner_tarball()
+
+    def stub(self, name: str, latency: float = 0.0, fail_on: Optional[str] = None, exit_code: int = 1,
+             output_lines: int = 0) -> None:
+        """Reconfigure a stub binary"""
+        self.stubs[name] = StubSpec(latency, fail_on, exit_code, output_lines)
+        self._write_stub(name, self.stubs[name])
+
+    def package(self, name: str, version: Optional[str] = None, priority: str = 'optional',
+                depends: tuple = ()) -> None:
+        """Describe a package to the dpkg-query and apt-cache stubs (version None: not installed)"""
+        lines = [line for line in self.package_table.read_text().splitlines() if line.split(' ')[0] != name]
+        lines.append(' '.join([name, version or '-', priority, *depends]))
+        self.package_table.write_text('\n'.join(lines) + '\n')
+
+    def _write_stub(self, name: str, spec: StubSpec) -> None:
+        body = ['#!/bin/bash', f'printf "%s\\t%s\\n" {name} "$*" >> "$STUB_CALL_LOG"']
+        if spec.latency > 0:
+            body.append(f'sleep {spec.latency:.3f}')
+        if spec.output_lines > 0:
+            body.append(f'seq -f "Get:%g http://stub.invalid {name} output" {spec.output_lines}')
+        if spec.fail_on is not None:
+            pattern = shlex.quote(spec.fail_on)
+            body.append(f'if [[ "$*" == *{pattern}* ]]; then')
+            body.append(f'    echo "{name}: injected failure" >&2')
+            body.append(f'    exit {spec.exit_code}')
+            body.append('fi')
+        body.append(STUB_BEHAVIOUR.get(name, '').rstrip('\n'))
+        body.append('exit 0')
+        self._write_executable(self.bin_dir / name, '\n'.join(body) + '\n')
+
+    def _write_sudo(self) -> None:
+        # Drop sudo's own options and run the command unprivileged
+        self._write_executable(self.bin_dir / 'sudo', '''#!/bin/bash
+while [[ "$1" == -* ]]; do shift; done
+exec "$@"
+''')
+
+    def _write_runner_tarball(self) -> None:
+        with tarfile.open(self.runner_tarball, 'w:gz') as tar:
+            for name, body in RUNNER_FILES.items():
+                data = f"#!/bin/bash\n{body}exit 0\n".encode()
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mode = 0o755
+                tar.addfile(info, io.BytesIO(data))
+
+    @staticmethod
+    def _write_executable(path: Path, content: str) -> None:
+        path.write_text(content)
+        path.chmod(0o755)
+
+    @property
+    def env(self) -> Dict[str, str]:
+        """Environment that points the scripts at the stubs and fake root"""
+        return {
+            'PATH': f"{self.bin_dir}{os.pathsep}{os.environ.get('PATH', '')}",
+            'STACKOPS_ROOT': str(self.root),
+            'STUB_CALL_LOG': str(self.call_log),
+            'STUB_CURL_PAYLOAD': str(self.runner_tarball),
+            'STUB_PACKAGES': str(self.package_table),
+        }
+
+    def server_setup(self, max_workers: int = 1, settings: Optional[Settings] = None) -> ServerSetup:
+        """Create a ServerSetup wired to this harness with scripts installed"""
+        setup = ServerSetup(base_dir=self.app_dir, env=self.env, max_workers=max_workers, settings=settings)
+        install_scripts(setup.scripts_dir)
+        return setup
+
+    def run(self,
+            domain: str = "example.test",
+            email: str = "ops@example.test",
+            github_token: Optional[str] = None,
+            max_workers: int = 1,
+            preflight_checks: Optional[list] = None,
+            settings: Optional[Settings] = None) -> RunReport:
+        """Provision the fake root and return a timing report (no preflight by default)"""
+        self.call_log.write_text('')
+        setup = self.server_setup(max_workers, settings)
+        steps = setup.build_steps(domain, email, github_token)
+        success = setup.run_setup(domain, email, github_token, preflight_checks=preflight_checks or [])
+        return RunReport(success, setup, steps)
+
+    def calls(self, name: Optional[str] = None) -> List[List[str]]:
+        """Stub invocations as [command, arguments...] lists, in call order"""
+        result = []
+        for line in self.call_log.read_text().splitlines():
+            command, _, args = line.partition('\t')
+            if name is None or command == name:
+                result.append([command] + args.split())
+        return result
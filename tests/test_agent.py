@@ -0,0 +1,170 @@
+# tests/test_agent.py
+import shutil
+import threading
+import time
+import pytest
+from stackops.agent import DriftAgent, Inotify
+from stackops.settings import Settings
+from stackops.setup_manager import ServerSetup
+from stackops.state import BASELINE_DIR, load_state
+from tests.harness import ProvisioningHarness
+
+@pytest.fixture
+def provisioned(tmp_path):
+    """A harness whose fake root has been provisioned successfully"""
+    harness = ProvisioningHarness(tmp_path)
+    assert harness.run(domain="example.test").success
+    return harness
+
+@pytest.fixture
+def agent(provisioned):
+    """Drift agent bound to the provisioned fake root"""
+    provisioned.call_log.write_text('')
+    drift_agent = DriftAgent(provisioned.server_setup(), probe_interval=0.2, settle_delay=0.05)
+    yield drift_agent
+    if drift_agent.watcher is not None:
+        drift_agent.watcher.close()
+
+def test_setup_records_state(provisioned):
+    """A successful run records the steps and file digests"""
+    state = load_state(provisioned.root)
+    assert state['domain'] == "example.test"
+    assert state['steps'] == ['initial', 'docker', 'nginx_ssl']
+    assert state['files']['etc/cron.d/certbot-renewal']
+
+def test_no_drift_does_nothing(agent, provisioned):
+    """A clean host triggers no steps and no restarts"""
+    assert agent.run_once() is True
+    assert [call[1] for call in provisioned.calls('systemctl')] == ['is-active'] * 3
+    assert provisioned.calls('apt') == []
+
+def test_deleted_cron_is_restored_without_certbot(agent, provisioned):
+    """A missing cron file comes back from its copy; nginx and certbot are left alone"""
+    cron = provisioned.root / "etc/cron.d/certbot-renewal"
+    original = cron.read_text()
+    cron.unlink()
+    assert agent.detect_file_drift() == {'etc/cron.d/certbot-renewal': 'nginx_ssl'}
+    assert agent.run_once() is True
+    assert cron.read_text() == original
+    assert agent.setup.step_timings == {}
+    assert provisioned.calls('certbot') == []
+    assert provisioned.calls('nginx') == []
+
+def test_edited_nginx_conf_is_restored(agent, provisioned):
+    """A hand edit is reverted, checked with nginx -t and reloaded"""
+    conf = provisioned.root / "etc/nginx/nginx.conf"
+    original = conf.read_text()
+    conf.write_text(original.replace("worker_processes 1;", "worker_processes 8;"))
+    assert agent.run_once() is True
+    assert conf.read_text() == original
+    assert agent.setup.step_timings == {}
+    assert provisioned.calls('nginx') == [['nginx', '-t']]
+    assert ['systemctl', 'reload', 'nginx'] in provisioned.calls('systemctl')
+    assert provisioned.calls('apt') == []
+
+def test_edited_jail_reloads_fail2ban_only(agent, provisioned):
+    """A jail.local edit doesn't replay initial setup (apt upgrade, snapd purge)"""
+    jail = provisioned.root / "etc/fail2ban/jail.local"
+    original = jail.read_text()
+    jail.write_text(original.replace("bantime", "# bantime"))
+    assert agent.run_once() is True
+    assert jail.read_text() == original
+    assert provisioned.calls('fail2ban-client') == [['fail2ban-client', '-t']]
+    assert ['systemctl', 'reload', 'fail2ban'] in provisioned.calls('systemctl')
+    assert provisioned.calls('apt') == []
+    assert provisioned.calls('nginx') == []
+
+def test_failed_repair_keeps_drift_reported(agent, provisioned):
+    """A restored file that fails nginx -t is not loaded and the edit stays reported"""
+    conf = provisioned.root / "etc/nginx/nginx.conf"
+    original = conf.read_text()
+    edited = original.replace("worker_processes 1;", "worker_processes 8;")
+    conf.write_text(edited)
+    provisioned.stub('nginx', fail_on='-t')
+    assert agent.run_once() is False
+    assert conf.read_text() == edited
+    assert ['systemctl', 'reload', 'nginx'] not in provisioned.calls('systemctl')
+    provisioned.stub('nginx')
+    assert agent.detect_file_drift() == {'etc/nginx/nginx.conf': 'initial'}
+    assert agent.run_once() is True
+    assert agent.detect_file_drift() == {}
+
+def test_failed_certbot_is_not_rebaselined(agent, provisioned):
+    """Without a copy the step is re-run, and a certbot failure fails it"""
+    shutil.rmtree(provisioned.root / BASELINE_DIR)
+    cron = provisioned.root / "etc/cron.d/certbot-renewal"
+    cron.unlink()
+    provisioned.stub('certbot', fail_on='--nginx')
+    assert agent.run_once() is False
+    assert agent.setup.step_results == {'nginx_ssl': False}
+    assert agent.detect_file_drift() == {'etc/cron.d/certbot-renewal': 'nginx_ssl'}
+
+def test_repairs_render_provisioned_settings(tmp_path):
+    """Steps re-applied as a last resort use the settings recorded at provisioning"""
+    harness = ProvisioningHarness(tmp_path)
+    settings = Settings({'STACKOPS_F2B_NGINX_MAXRETRY': '5', 'STACKOPS_NGINX_API_RATE': '2'})
+    assert harness.run(settings=settings).success
+    jail = harness.root / "etc/fail2ban/jail.local"
+    limits = harness.root / "etc/nginx/conf.d/stackops-limits.conf"
+    expected = jail.read_text(), limits.read_text()
+    jail.unlink()
+    limits.unlink()
+    shutil.rmtree(harness.root / BASELINE_DIR)
+
+    drift_agent = DriftAgent(harness.server_setup(), use_inotify=False)
+    assert drift_agent.run_once() is True
+    assert (jail.read_text(), limits.read_text()) == expected
+    assert "maxretry = 5" in jail.read_text()
+    assert "rate=2r/s" in limits.read_text()
+
+def test_repairs_survive_other_commands(agent, provisioned):
+    """Other commands leave the scripts alone, and the agent reinstalls them anyway"""
+    # What 'stackops deploy' or 'bundle export' builds
+    ServerSetup(base_dir=provisioned.app_dir, env=provisioned.env)
+    assert (agent.setup.scripts_dir / "setup.sh").exists()
+
+    shutil.rmtree(agent.setup.scripts_dir)
+    cron = provisioned.root / "etc/cron.d/certbot-renewal"
+    cron.unlink()
+    assert agent.run_once() is True
+    assert cron.exists()
+
+def test_stopped_service_is_restarted_then_reapplied(agent, provisioned):
+    """A unit that won't come back after restart gets its step re-applied"""
+    provisioned.stub('systemctl', fail_on='is-active --quiet docker')
+    assert agent.detect_service_drift() == {'docker': 'docker'}
+    agent.run_once()
+    assert ['systemctl', 'restart', 'docker'] in provisioned.calls('systemctl')
+    assert set(agent.setup.step_timings) == {'docker'}
+
+def test_inotify_reports_file_events(tmp_path):
+    """The ctypes binding delivers events for files in watched directories"""
+    watcher = Inotify()
+    try:
+        watcher.add_watch(tmp_path)
+        (tmp_path / "nginx.conf").write_text("edited")
+        events = watcher.read(1.0)
+        assert any(name == "nginx.conf" for _, name, _ in events)
+        assert watcher.read(0) == []
+    finally:
+        watcher.close()
+
+def test_agent_loop_repairs_edits(agent, provisioned):
+    """The running agent notices an edit through inotify and repairs it"""
+    assert agent.watcher is not None
+    stop_event = threading.Event()
+    thread = threading.Thread(target=agent.run, args=(stop_event,))
+    thread.start()
+    try:
+        time.sleep(0.3)
+        vhost = provisioned.root / "etc/nginx/sites-available/nextjs-app"
+        original = vhost.read_text()
+        vhost.write_text("server { }\n")
+        deadline = time.monotonic() + 5
+        while vhost.read_text() != original and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert vhost.read_text() == original
+    finally:
+        stop_event.set()
+        thread.join(5)
+    assert not thread.is_alive()
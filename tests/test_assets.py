@@ -0,0 +1,101 @@
+# tests/test_assets.py
+import gzip
+import os
+import pytest
+from pathlib import Path
+from stackops import assets
+from stackops.assets import build_assets, load_manifest
+
+def _killed_worker(path, encodings, previous):
+    """Stands in for compress_file in a worker that gets OOM-killed"""
+    os._exit(137)
+
+@pytest.fixture
+def static_root(tmp_path):
+    """Static root with a compressible, a tiny and a binary file"""
+    root = tmp_path / "static"
+    (root / "css").mkdir(parents=True)
+    (root / "css" / "site.css").write_text("body { color: red; }\n" * 200)
+    (root / "app.js").write_text("console.log('hello');\n" * 100)
+    (root / "tiny.js").write_text("x")
+    (root / "logo.png").write_bytes(os.urandom(4096))
+    return root
+
+def test_build_creates_gzip_files(static_root):
+    """Compressible files get a .gz sibling that decompresses to the source"""
+    stats = build_assets(static_root, workers=1, use_brotli=False)
+    assert stats['compressed'] == 2
+    css = static_root / "css" / "site.css"
+    gz = Path(str(css) + ".gz")
+    assert gzip.decompress(gz.read_bytes()) == css.read_bytes()
+    assert gz.stat().st_mtime_ns == css.stat().st_mtime_ns
+    assert not (static_root / "tiny.js.gz").exists()
+    assert not (static_root / "logo.png.gz").exists()
+
+def test_rebuild_skips_up_to_date_files(static_root):
+    """A second build without changes does no work"""
+    build_assets(static_root, workers=1, use_brotli=False)
+    stats = build_assets(static_root, workers=1, use_brotli=False)
+    assert stats['compressed'] == 0
+    assert stats['skipped'] == 2
+
+def test_touched_file_with_same_content_is_unchanged(static_root):
+    """A newer mtime with identical content is detected by hash"""
+    build_assets(static_root, workers=1, use_brotli=False)
+    js = static_root / "app.js"
+    os.utime(js, ns=(js.stat().st_atime_ns, js.stat().st_mtime_ns + 10**9))
+    stats = build_assets(static_root, workers=1, use_brotli=False)
+    assert stats['unchanged'] == 1
+    assert stats['compressed'] == 0
+    assert Path(str(js) + ".gz").stat().st_mtime_ns == js.stat().st_mtime_ns
+
+def test_modified_file_is_recompressed(static_root):
+    """Changed content produces a fresh .gz"""
+    build_assets(static_root, workers=1, use_brotli=False)
+    js = static_root / "app.js"
+    js.write_text("console.log('changed');\n" * 100)
+    stats = build_assets(static_root, workers=1, use_brotli=False)
+    assert stats['compressed'] == 1
+    assert gzip.decompress(Path(str(js) + ".gz").read_bytes()) == js.read_bytes()
+
+def test_removed_source_drops_outputs(static_root):
+    """Outputs of deleted sources are cleaned up"""
+    build_assets(static_root, workers=1, use_brotli=False)
+    (static_root / "app.js").unlink()
+    stats = build_assets(static_root, workers=1, use_brotli=False)
+    assert stats['removed'] == 1
+    assert not (static_root / "app.js.gz").exists()
+    assert "app.js" not in load_manifest(static_root)
+
+@pytest.mark.skipif(assets.brotli is None, reason="brotli not installed")
+def test_build_creates_brotli_files(static_root):
+    """.br files are built when brotli is available"""
+    build_assets(static_root, workers=1)
+    br = static_root / "app.js.br"
+    assert assets.brotli.decompress(br.read_bytes()) == (static_root / "app.js").read_bytes()
+
+def test_dead_worker_is_reported_and_manifest_saved(static_root, monkeypatch):
+    """A broken process pool fails the pending files instead of aborting the build"""
+    build_assets(static_root, workers=1, use_brotli=False)
+    (static_root / "app.js").write_text("console.log('changed');\n" * 100)
+    monkeypatch.setattr(assets, 'compress_file', _killed_worker)
+    stats = build_assets(static_root, workers=1, use_brotli=False)
+    assert stats['failed'] == 1
+    manifest = load_manifest(static_root)
+    assert "app.js" not in manifest
+    assert "css/site.css" in manifest
+    assert not (static_root / "app.js.gz").exists()
+    assert (static_root / "css/site.css.gz").exists()
+
+def test_failed_compression_drops_stale_outputs(static_root, monkeypatch):
+    """A changed file that can't be compressed is served uncompressed, not from the old .gz"""
+    build_assets(static_root, workers=1, use_brotli=False)
+    (static_root / "app.js").write_text("console.log('changed');\n" * 100)
+
+    def fail(data, encoding):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(assets, '_compress', fail)
+    stats = build_assets(static_root, workers=1, use_brotli=False)
+    assert stats['failed'] == 1
+    assert not (static_root / "app.js.gz").exists()
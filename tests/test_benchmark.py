@@ -0,0 +1,139 @@
+# tests/test_benchmark.py
+"""
+Provisioning orchestration benchmarks
+
+Runs the full step pipeline against stub binaries with fixed latencies, so
+the numbers reflect the orchestrator rather than the network or apt. Budgets
+can be tuned for slower CI machines through environment variables.
+
+Run directly for a report:  PYTHONPATH=src python -m tests.test_benchmark
+"""
+import os
+import time
+import pytest
+from stackops.log_config import shutdown_logging
+from stackops.ratelimit import render_limits_conf, render_location_limits
+from stackops.settings import Settings
+from tests.harness import ProvisioningHarness, StubSpec
+from tests.traffic import LimitingProxy, measure, p99, parse_profile
+
+# Simulated command latencies (seconds)
+SCENARIO = {
+    'apt': StubSpec(latency=0.05),
+    'systemctl': StubSpec(latency=0.01),
+    'nginx': StubSpec(latency=0.01),
+    'certbot': StubSpec(latency=0.1),
+    'curl': StubSpec(latency=0.4),
+    'docker': StubSpec(latency=0.01),
+}
+
+MAX_OVERHEAD = float(os.getenv('STACKOPS_BENCH_MAX_OVERHEAD', '0.25'))
+MIN_SPEEDUP = float(os.getenv('STACKOPS_BENCH_MIN_SPEEDUP', '1.2'))
+MIN_LINES_PER_SECOND = float(os.getenv('STACKOPS_BENCH_MIN_LINES_PER_SECOND', '5000'))
+MAX_FLOOD_P99_RATIO = float(os.getenv('STACKOPS_BENCH_MAX_FLOOD_P99_RATIO', '3.0'))
+
+# Well-behaved clients stay under the /api/ rate; the flood is ~3x what the
+# backend can serve, from a handful of addresses
+FLOOD = {'path': '/api/items', 'good_clients': 10, 'good_rate': 4, 'duration': 2.0,
+         'flood_clients': 32, 'flood_rate': 40, 'flood_sources': 4}
+
+def run_benchmark(base_dir, max_workers):
+    """Provision a fresh fake root and return its RunReport"""
+    harness = ProvisioningHarness(base_dir, stubs=SCENARIO)
+    return harness.run(github_token="ghp_bench", max_workers=max_workers)
+
+def format_report(sequential, parallel):
+    """Human-readable benchmark summary"""
+    lines = [
+        f"{'':<22}{'sequential':>12}{'parallel':>12}",
+        f"{'total (s)':<22}{sequential.total:>12.3f}{parallel.total:>12.3f}",
+        f"{'critical path (s)':<22}{sequential.critical_path:>12.3f}{parallel.critical_path:>12.3f}",
+        f"{'sched. overhead (s)':<22}{sequential.scheduling_overhead:>12.3f}{parallel.scheduling_overhead:>12.3f}",
+    ]
+    for name in sequential.step_durations:
+        lines.append(f"{'  ' + name + ' (s)':<22}{sequential.step_durations[name]:>12.3f}"
+                     f"{parallel.step_durations.get(name, 0.0):>12.3f}")
+    lines.append(f"parallel speedup: {sequential.total / parallel.total:.2f}x")
+    return '\n'.join(lines)
+
+@pytest.fixture(scope='module')
+def reports(tmp_path_factory):
+    """Sequential and parallel runs of the same scenario"""
+    sequential = run_benchmark(tmp_path_factory.mktemp('sequential'), max_workers=1)
+    parallel = run_benchmark(tmp_path_factory.mktemp('parallel'), max_workers=4)
+    print('\n' + format_report(sequential, parallel))
+    return sequential, parallel
+
+@pytest.mark.benchmark
+def test_benchmark_runs_succeed(reports):
+    """Both scheduling modes provision successfully"""
+    sequential, parallel = reports
+    assert sequential.success and parallel.success
+
+@pytest.mark.benchmark
+def test_scheduling_overhead_within_budget(reports):
+    """The orchestrator adds little on top of the steps themselves"""
+    for report in reports:
+        assert report.scheduling_overhead < MAX_OVERHEAD
+
+@pytest.mark.benchmark
+def test_parallel_speedup(reports):
+    """The runner download overlaps the other steps (apt itself stays serialized)"""
+    sequential, parallel = reports
+    assert sequential.total / parallel.total >= MIN_SPEEDUP
+
+@pytest.mark.benchmark
+def test_streamed_output_throughput(tmp_path):
+    """Thousands of lines of apt output per second pass through logging"""
+    harness = ProvisioningHarness(tmp_path, stubs={'apt': StubSpec(output_lines=5000)})
+    setup = harness.server_setup()
+    initial = setup.build_steps("example.test", "ops@example.test")[0]
+    started = time.perf_counter()
+    assert setup.run_script(initial.script, initial.env_vars)
+    elapsed = time.perf_counter() - started
+    shutdown_logging()
+    lines = 5000 * len(harness.calls('apt'))
+    print(f"\nstreamed {lines} lines in {elapsed:.3f}s ({lines / elapsed:,.0f} lines/s)")
+    assert lines / elapsed >= MIN_LINES_PER_SECOND
+
+def run_flood(limited, flood):
+    """Good-client results through the simulated /api/ profile (or no limits)"""
+    settings = Settings({})
+    zone, conn_limit = None, 0
+    if limited:
+        zone, conn_limit = parse_profile(render_limits_conf(settings, 1024),
+                                         render_location_limits(settings, 'api'))
+    params = dict(FLOOD)
+    if not flood:
+        params['flood_clients'] = 0
+    with LimitingProxy(zone, conn_limit) as proxy:
+        return measure(proxy, **params)
+
+@pytest.mark.benchmark
+def test_rate_limits_hold_p99_under_flood():
+    """
+    Simulation: with the profile's rates, a flood doesn't move well-behaved clients' p99
+
+    tests/traffic.py models limit_req/limit_conn in Python with the rates and
+    bursts parsed from the rendered profile; nginx itself is not run, so this
+    checks the chosen numbers, not the vhost (see test_ratelimit for that).
+    """
+    baseline = run_flood(limited=True, flood=False)
+    unlimited = run_flood(limited=False, flood=True)
+    limited = run_flood(limited=True, flood=True)
+    print(f"\np99 latency: baseline {p99(baseline) * 1000:.1f}ms, flood without limits "
+          f"{p99(unlimited) * 1000:.1f}ms, flood with limits {p99(limited) * 1000:.1f}ms")
+
+    assert all(status == 200 for _latency, status in baseline + limited)
+    # Floor the baseline so a few ms of scheduler noise doesn't fail the ratio
+    assert p99(limited) <= max(p99(baseline), 0.005) * MAX_FLOOD_P99_RATIO
+    # ...and it's the limits doing it: the same flood hurts without them
+    assert p99(unlimited) > p99(limited) * 2
+
+if __name__ == '__main__':
+    import tempfile
+    # Keep script output out of the report
+    os.environ.setdefault('STACKOPS_LOG_LEVEL', 'WARNING')
+    with tempfile.TemporaryDirectory() as tmp:
+        print(format_report(run_benchmark(os.path.join(tmp, 'sequential'), 1),
+                            run_benchmark(os.path.join(tmp, 'parallel'), 4)))
@@ -0,0 +1,116 @@
+# tests/test_bundle.py
+import tarfile
+import pytest
+from stackops.bundle import (
+    BundleApplier, BundleBuilder, BundleError, parse_deb_name, render_template, template_out,
+)
+from stackops.settings import Settings
+from stackops.state import load_state
+from tests.harness import ProvisioningHarness
+
+DEBS = ('nginx_1.24.0-2_amd64.deb', 'docker-ce_5%3a27.0.3-1_amd64.deb', 'curl_1.0-stub_amd64.deb')
+
+def golden_host(base_dir):
+    """Provisioned (with runner) fake root whose nginx pulls in unmanaged dependencies"""
+    source = ProvisioningHarness(base_dir)
+    source.package('nginx', '1.24.0-2', depends=('nginx-common', 'libc6'))
+    source.package('nginx-common', '1.24.0-2')
+    source.package('libc6', '2.35-0ubuntu3', priority='required')
+    source.package('docker-ce', '5:27.0.3-1')
+    assert source.run(domain="golden.test", email="ops@golden.test", github_token="token",
+                      settings=Settings({'STACKOPS_NGINX_RATE': '7'})).success
+    return source
+
+@pytest.fixture
+def bundle(tmp_path):
+    """A bundle exported from the golden host, some packages coming from its apt cache"""
+    source = golden_host(tmp_path / "source")
+    archives = source.root / "var/cache/apt/archives"
+    archives.mkdir(parents=True)
+    for name in DEBS:
+        (archives / name).write_bytes(b"deb " + name.encode())
+    return BundleBuilder(source.server_setup()).export(tmp_path / "golden.tar.gz")
+
+def test_parse_deb_name():
+    """Epochs are percent-encoded in cached .deb names"""
+    assert parse_deb_name('docker-ce_5%3a27.0.3-1_amd64.deb') == ('docker-ce', '5:27.0.3-1')
+    assert parse_deb_name('README') is None
+
+def test_export_requires_state(tmp_path):
+    """Only a provisioned host can be exported"""
+    harness = ProvisioningHarness(tmp_path)
+    with pytest.raises(BundleError):
+        BundleBuilder(harness.server_setup()).export(tmp_path / "bundle.tar.gz")
+
+def test_template_round_trip():
+    """Per-host values become placeholders and are filled in for the new host"""
+    variables = {'DOMAIN': "golden.test", 'EMAIL': "ops@golden.test"}
+    templated = template_out(b"server_name golden.test; # ops@golden.test", variables)
+    assert templated == b"server_name {{DOMAIN}}; # {{EMAIL}}"
+    assert template_out(b"worker_processes 1;", variables) is None
+    rendered = render_template(templated, {'DOMAIN': "new.test", 'EMAIL': "me@new.test"})
+    assert rendered == b"server_name new.test; # me@new.test"
+
+def test_export_contents(bundle, tmp_path):
+    """Packages, rendered configs and download caches are captured"""
+    assert (tmp_path / "golden.tar.gz.sha256").exists()
+    with tarfile.open(bundle) as tar:
+        names = tar.getnames()
+    assert 'files/etc/fail2ban/jail.local' in names
+    assert 'files/etc/nginx/sites-available/nextjs-app' not in names
+    assert 'debs/nginx_1.24.0-2_amd64.deb' in names
+    assert 'debs/nginx-common_1.24.0-2_amd64.deb' in names  # dependency, downloaded
+    assert not any(name.startswith('debs/libc6_') for name in names)  # on every image
+    assert 'files/var/cache/stackops/actions-runner-linux-x64-2.314.1.tar.gz' in names
+
+def test_apply_installs_without_network(bundle, tmp_path):
+    """A fresh host is provisioned from the bundle using local packages only"""
+    target = ProvisioningHarness(tmp_path / "target")
+    target.package('nginx-common', None)
+    setup = target.server_setup()
+    assert BundleApplier(setup).apply(bundle, "new.test", "ops@new.test") is True
+
+    # One apt-get run orders the local .debs, dependencies included, and never downloads
+    installs = target.calls('apt-get')
+    assert len(installs) == 1
+    assert installs[0][:4] == ['apt-get', 'install', '-y', '--no-download']
+    installed = ' '.join(installs[0])
+    assert 'nginx_1.24.0-2_amd64.deb' in installed
+    assert 'nginx-common_1.24.0-2_amd64.deb' in installed
+    assert 'curl_1.0-stub_amd64.deb' not in installed  # already at that version
+    assert target.calls('dpkg') == [['dpkg', '--print-architecture']] * len(target.calls('dpkg'))
+    # The nginx/SSL step's apt install is a no-op for packages the bundle installed
+    assert target.calls('apt') == [['apt', 'install', '-y', 'certbot', 'python3-certbot-nginx']]
+    assert target.calls('curl') == []
+
+    assert ['systemctl', 'restart', 'nginx'] in target.calls('systemctl')
+    assert ['usermod', '-a', '-G', 'docker', 'ubuntu'] in target.calls('usermod')
+    assert set(setup.step_timings) == {'nginx_ssl'}
+    assert "new.test" in (target.root / "etc/nginx/sites-available/nextjs-app").read_text()
+    assert (target.root / "etc/fail2ban/jail.local").exists()
+    assert (target.root / "var/cache/stackops/actions-runner-linux-x64-2.314.1.tar.gz").exists()
+
+    # The vhost limits are rendered with the golden host's settings
+    assert "rate=7r/s" in (target.root / "etc/nginx/conf.d/stackops-limits.conf").read_text()
+
+    state = load_state(target.root)
+    assert state['domain'] == "new.test"
+    assert state['settings']['STACKOPS_NGINX_RATE'] == '7'
+    assert state['steps'] == ['initial', 'docker', 'nginx_ssl']
+
+def test_export_fails_without_dependency_debs(tmp_path):
+    """A bundle that could not be installed offline is never written"""
+    source = golden_host(tmp_path / "source")
+    source.stub('apt-get', fail_on='download')
+    with pytest.raises(BundleError, match='nginx-common=1.24.0-2'):
+        BundleBuilder(source.server_setup()).export(tmp_path / "golden.tar.gz")
+    assert not (tmp_path / "golden.tar.gz").exists()
+
+def test_apply_rejects_tampered_bundle(bundle, tmp_path):
+    """A bundle that doesn't match its checksum file is refused"""
+    with open(bundle, 'ab') as f:
+        f.write(b'\0')
+    target = ProvisioningHarness(tmp_path / "target")
+    with pytest.raises(BundleError):
+        BundleApplier(target.server_setup()).apply(bundle, "new.test", "ops@new.test")
+    assert target.calls() == []
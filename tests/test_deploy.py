@@ -0,0 +1,153 @@
+# tests/test_deploy.py
+import re
+import stat
+import sys
+import threading
+import time
+import urllib.request
+from pathlib import Path
+import pytest
+from stackops.deploy import APP_ENV_DIR, APP_UNIT_PATH, DEPLOY_STATE_PATH, UPSTREAM_PATH, Deployer
+from stackops.settings import Settings
+from stackops.state import load_state
+from tests.harness import ProvisioningHarness
+
+APP = f"{sys.executable} {Path(__file__).parent / 'dummy_app.py'}"
+
+direct = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+@pytest.fixture
+def deployer(tmp_path):
+    """Deployer on a fake root with fast drain/stop timings; stops whatever it left running"""
+    harness = ProvisioningHarness(tmp_path)
+    setup = harness.server_setup()
+    setup.settings = Settings({'STACKOPS_DEPLOY_HEALTH_TIMEOUT': '10', 'STACKOPS_DEPLOY_DRAIN_TIMEOUT': '3',
+                               'STACKOPS_DEPLOY_STOP_GRACE': '3'})
+    deployer = Deployer(setup)
+    deployer.harness = harness
+    yield deployer
+    for instance in deployer.current_instances():
+        deployer.stop(instance, 0)
+
+def upstream_ports(deployer):
+    text = (deployer.root / UPSTREAM_PATH).read_text()
+    return [int(port) for port in re.findall(r'server 127\.0\.0\.1:(\d+);', text)]
+
+def fetch(port, path='/'):
+    with direct.open(f"http://127.0.0.1:{port}{path}", timeout=5) as response:
+        return response.read().decode()
+
+def test_first_deploy_switches_upstream(deployer):
+    """Healthy instances are put behind nginx with a graceful reload"""
+    assert deployer.deploy(command=APP, instances=2, release="v1") is True
+    ports = upstream_ports(deployer)
+    assert len(ports) == 2
+    assert all(fetch(port) == "v1" for port in ports)
+    assert ['nginx', '-t'] in deployer.harness.calls('nginx')
+    assert ['systemctl', 'reload', 'nginx'] in deployer.harness.calls('systemctl')
+    state = load_state(deployer.root, DEPLOY_STATE_PATH)
+    assert state['release'] == "v1"
+    assert [instance['port'] for instance in state['instances']] == ports
+
+def test_process_instances_run_under_systemd(deployer):
+    """Instances are enabled units of a restarting template, so crashes and reboots bring them back"""
+    assert deployer.deploy(command=APP, release="v1")
+    instance = deployer.current_instances()[0]
+    assert instance.unit == f"stackops-app@v1-{instance.port}.service"
+    assert ['systemctl', 'enable', '--now', instance.unit] in deployer.harness.calls('systemctl')
+    unit = (deployer.root / APP_UNIT_PATH).read_text()
+    assert "Restart=always" in unit
+    assert "WantedBy=multi-user.target" in unit
+    assert "TimeoutStopSec=3" in unit
+    env_file = deployer.root / APP_ENV_DIR / f"v1-{instance.port}.env"
+    assert f'PORT="{instance.port}"' in env_file.read_text()
+    assert stat.S_IMODE(env_file.stat().st_mode) == 0o600
+
+    deployer.stop(instance, 3)
+    assert ['systemctl', 'disable', '--now', instance.unit] in deployer.harness.calls('systemctl')
+    assert not deployer.is_running(instance)
+    assert not env_file.exists()
+
+def test_crashing_process_fails_fast(deployer):
+    """An instance that exits during startup aborts without waiting out the health timeout"""
+    started = time.monotonic()
+    assert deployer.deploy(command="exit 1", release="v1", health_timeout=30) is False
+    assert time.monotonic() - started < 10
+    assert not list((deployer.root / APP_ENV_DIR).glob("*.env"))
+
+def test_invalid_release_name(deployer):
+    with pytest.raises(ValueError):
+        deployer.deploy(command=APP, release="v1/../x")
+
+def test_rolling_deploy_drops_no_requests(deployer):
+    """Clients following the upstream see no errors while the release changes"""
+    assert deployer.deploy(command=APP, release="v1")
+    old = deployer.current_instances()
+
+    stop, seen, errors = threading.Event(), set(), []
+
+    def client():
+        while not stop.is_set():
+            for port in upstream_ports(deployer):
+                try:
+                    seen.add(fetch(port))
+                except OSError as e:
+                    errors.append(e)
+
+    thread = threading.Thread(target=client)
+    thread.start()
+    try:
+        assert deployer.deploy(command=f"DUMMY_STARTUP_DELAY=0.5 {APP}", release="v2")
+    finally:
+        stop.set()
+        thread.join(10)
+
+    assert errors == []
+    assert seen == {"v1", "v2"}
+    assert upstream_ports(deployer) != [old[0].port]
+    assert not deployer.is_running(old[0])
+
+def test_unhealthy_release_is_rolled_back(deployer):
+    """A release failing its health check never receives traffic"""
+    assert deployer.deploy(command=APP, release="v1")
+    before = (deployer.root / UPSTREAM_PATH).read_text()
+    live = deployer.current_instances()[0]
+
+    assert deployer.deploy(command=f"DUMMY_UNHEALTHY=1 {APP}", release="v2", health_timeout=1) is False
+    assert (deployer.root / UPSTREAM_PATH).read_text() == before
+    assert load_state(deployer.root, DEPLOY_STATE_PATH)['release'] == "v1"
+    assert fetch(live.port) == "v1"
+    assert len(list((deployer.root / "var/www/app/logs").glob("app-v2-*.log"))) == 1
+
+def test_rejected_nginx_config_restores_upstream(deployer):
+    """If nginx -t fails the previous upstream file is put back"""
+    assert deployer.deploy(command=APP, release="v1")
+    before = (deployer.root / UPSTREAM_PATH).read_text()
+    deployer.harness.stub('nginx', fail_on='-t')
+    assert deployer.deploy(command=APP, release="v2") is False
+    assert (deployer.root / UPSTREAM_PATH).read_text() == before
+
+def test_docker_release_cleaned_up_when_not_healthy(deployer):
+    """Containers are published on loopback and removed as soon as they are seen to have exited"""
+    started = time.monotonic()
+    assert deployer.deploy(image="registry.test/app:2", container_port=3000, release="v2", health_timeout=30) is False
+    assert time.monotonic() - started < 10
+    run = deployer.harness.calls('docker')[0]
+    assert run[:2] == ['docker', 'run']
+    port = int(run[run.index('-p') + 1].split(':')[1])
+    assert f"127.0.0.1:{port}:3000" in run
+    assert ['docker', 'inspect', '-f', '{{.State.Running}}', f"stackops-app-v2-{port}"] in deployer.harness.calls('docker')
+    assert ['docker', 'rm', '-f', f"stackops-app-v2-{port}"] in deployer.harness.calls('docker')
+    assert not (deployer.root / UPSTREAM_PATH).exists()
+
+def test_setup_keeps_deployed_upstream(tmp_path):
+    """Provisioning creates the upstream once and never reverts a deploy"""
+    harness = ProvisioningHarness(tmp_path)
+    assert harness.run().success
+    upstream = harness.root / UPSTREAM_PATH
+    assert "server 127.0.0.1:3002;" in upstream.read_text()
+    assert "proxy_pass http://stackops_app;" in (harness.root / "etc/nginx/sites-available/nextjs-app").read_text()
+
+    upstream.write_text("upstream stackops_app {\n    server 127.0.0.1:3100;\n}\n")
+    assert harness.run().success
+    assert "127.0.0.1:3100" in upstream.read_text()
@@ -0,0 +1,82 @@
+# tests/test_fail2ban.py
+import configparser
+import re
+import pytest
+from stackops.fail2ban import NGINX_4XX_TAG, render_jail_local, render_nginx_filter
+from stackops.settings import Settings
+from tests.harness import ProvisioningHarness
+
+# common.conf's __prefix_line, reduced to the hostname and identifier[pid]:
+# parts fail2ban's journal backend puts in front of each message
+PREFIX_LINE = r'\s*(?:\S+\s+)?(?:[\[\(]?\S*(?:\(\S+\))?[\]\)]?(?:\[\d+\])?:?\s+)?'
+
+def parse(text):
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.read_string(text)
+    return parser
+
+def test_jails_use_journal_and_nftables():
+    """No log polling and no per-IP iptables rules"""
+    jail = parse(render_jail_local(Settings({})))
+    assert jail['DEFAULT']['backend'] == 'systemd'
+    assert jail['DEFAULT']['banaction'].startswith('nftables')
+    assert 'logpath' not in jail['sshd']
+    assert jail['nginx-4xx']['enabled'] == 'true'
+    assert jail['nginx-4xx']['port'] == 'http,https'
+
+def test_ban_parameters_come_from_settings():
+    """STACKOPS_F2B_* variables drive the rendered jails"""
+    settings = Settings({
+        'STACKOPS_F2B_NGINX_MAXRETRY': '20',
+        'STACKOPS_F2B_NGINX_BANTIME': '900',
+        'STACKOPS_F2B_SSH_MAXRETRY': '5',
+        'STACKOPS_F2B_IGNORE_IP': '127.0.0.1/8, 10.0.0.0/8',
+    })
+    jail = parse(render_jail_local(settings))
+    assert jail['nginx-4xx']['maxretry'] == '20'
+    assert jail['nginx-4xx']['bantime'] == '900'
+    assert jail['sshd']['maxretry'] == '5'
+    assert jail['DEFAULT']['ignoreip'] == '127.0.0.1/8 10.0.0.0/8'
+
+def test_invalid_settings_rejected():
+    with pytest.raises(ValueError):
+        Settings({'STACKOPS_F2B_SSH_BANTIME': 'forever'})
+    with pytest.raises(ValueError):
+        Settings({'STACKOPS_F2B_NGINX_MAXRETRY': '0'})
+
+def test_settings_round_trip_through_env():
+    """to_env() reproduces the settings it was taken from"""
+    settings = Settings({'STACKOPS_F2B_IGNORE_IP': '127.0.0.1/8 10.0.0.0/8', 'STACKOPS_NGINX_MAX_BODY': '2M'})
+    assert vars(Settings(settings.to_env())) == vars(settings)
+
+def test_nginx_filter_matches_4xx_lines():
+    """The filter matches 4xx lines as the journal backend presents them"""
+    conf = parse(render_nginx_filter())
+    assert conf['INCLUDES']['before'] == 'common.conf'
+    definition = conf['Definition']
+    assert definition['journalmatch'] == f"SYSLOG_IDENTIFIER={NGINX_4XX_TAG}"
+    failregex = re.compile(definition['failregex'].replace('%(__prefix_line)s', PREFIX_LINE)
+                           .replace('<HOST>', r'(?P<host>\S+)'))
+    match = failregex.search(f'myhost {NGINX_4XX_TAG}[123]: 203.0.113.7 404 GET "/x"')
+    assert match and match.group('host') == '203.0.113.7'
+    match = failregex.search(f'myhost {NGINX_4XX_TAG}[123]: 2001:db8::1 403 POST "/api/login"')
+    assert match and match.group('host') == '2001:db8::1'
+    assert not failregex.search(f'myhost {NGINX_4XX_TAG}[123]: 203.0.113.7 200 GET "/"')
+    assert not failregex.search(f'myhost {NGINX_4XX_TAG}[123]: 203.0.113.7 502 GET "/"')
+
+def test_provisioning_installs_rendered_config(tmp_path):
+    """The initial step writes the rendered jails and validates them"""
+    harness = ProvisioningHarness(tmp_path)
+    setup = harness.server_setup()
+    setup.settings = Settings({'STACKOPS_F2B_NGINX_MAXRETRY': '25'})
+    assert setup.run_setup("example.test", "ops@example.test", preflight_checks=[])
+
+    jail = harness.root / "etc/fail2ban/jail.local"
+    assert jail.read_text() == render_jail_local(setup.settings)
+    assert parse(jail.read_text())['nginx-4xx']['maxretry'] == '25'
+    assert (harness.root / "etc/fail2ban/filter.d/stackops-nginx-4xx.conf").read_text() == render_nginx_filter()
+    assert ['fail2ban-client', '-t'] in harness.calls('fail2ban-client')
+
+    vhost = (harness.root / "etc/nginx/sites-available/nextjs-app").read_text()
+    assert f"tag={NGINX_4XX_TAG}" in vhost
+    assert "if=$stackops_4xx" in vhost
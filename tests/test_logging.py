@@ -0,0 +1,76 @@
+# tests/test_logging.py
+import json
+import logging
+import os
+import time
+import pytest
+from stackops.log_config import LOG_FILE_NAME, configure_logging, log_step, shutdown_logging
+from stackops.setup_manager import ServerSetup
+
+# Budget for one logged line as seen by the caller (seconds); loosen on slow CI machines
+MAX_LOG_LINE_COST = float(os.getenv('STACKOPS_BENCH_MAX_LOG_LINE_COST', '150e-6'))
+
+@pytest.fixture
+def logger():
+    """A stackops logger; handlers are detached afterwards"""
+    yield logging.getLogger("stackops.tests")
+    shutdown_logging()
+
+def read_entries(logs_dir):
+    """Parse the JSON lines written to the current log file"""
+    return [json.loads(line) for line in (logs_dir / LOG_FILE_NAME).read_text().splitlines()]
+
+def test_records_are_json_with_context(tmp_path, logger):
+    """Each line carries run_id, host and the current step"""
+    configure_logging(tmp_path, run_id="run123", console=False)
+    logger.info("outside")
+    with log_step("docker"):
+        logger.warning("inside %s", "step")
+    shutdown_logging()
+
+    outside, inside = read_entries(tmp_path)
+    assert outside['run_id'] == inside['run_id'] == "run123"
+    assert outside['host'] and outside['step'] is None
+    assert inside['step'] == "docker"
+    assert inside['level'] == "WARNING"
+    assert inside['msg'] == "inside step"
+
+def test_reconfigure_does_not_duplicate(tmp_path, logger):
+    """Configuring twice replaces the previous handlers"""
+    configure_logging(tmp_path, console=False)
+    configure_logging(tmp_path, console=False)
+    logger.info("once")
+    shutdown_logging()
+    assert [entry['msg'] for entry in read_entries(tmp_path)] == ["once"]
+
+def test_log_file_rotates(tmp_path, logger):
+    """History is kept in size-limited rotated files"""
+    configure_logging(tmp_path, console=False, max_bytes=2048, backup_count=2)
+    for i in range(200):
+        logger.info(f"line {i}")
+    shutdown_logging()
+    assert (tmp_path / (LOG_FILE_NAME + ".1")).exists()
+    assert (tmp_path / (LOG_FILE_NAME + ".2")).exists()
+    assert not (tmp_path / (LOG_FILE_NAME + ".3")).exists()
+
+def test_previous_run_logs_are_kept(tmp_path, logger):
+    """A new ServerSetup appends instead of deleting the old log"""
+    first = ServerSetup(base_dir=tmp_path)
+    second = ServerSetup(base_dir=tmp_path)
+    shutdown_logging()
+    run_ids = {entry['run_id'] for entry in read_entries(second.logs_dir)}
+    assert {first.run_id, second.run_id} <= run_ids
+
+@pytest.mark.benchmark
+def test_per_line_overhead(tmp_path, logger):
+    """Logging a line costs the caller only a queue put"""
+    configure_logging(tmp_path, console=False)
+    lines = 20000
+    started = time.perf_counter()
+    for i in range(lines):
+        logger.info(f"Get:{i} http://archive.ubuntu.com jammy/main amd64 pkg")
+    per_line = (time.perf_counter() - started) / lines
+    shutdown_logging()
+    assert len(read_entries(tmp_path)) == lines
+    print(f"\nper-line logging cost: {per_line * 1e6:.1f}us")
+    assert per_line < MAX_LOG_LINE_COST
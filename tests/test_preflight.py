@@ -0,0 +1,205 @@
+# tests/test_preflight.py
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import pytest
+from stackops.preflight import (
+    AptLockCheck, AptMirrorCheck, CheckResult, ClockSkewCheck, DiskCheck, DnsCheck,
+    MemoryCheck, PortCheck, PreflightCheck, default_checks, run_preflight,
+)
+
+@pytest.fixture
+def listening_port():
+    """A local TCP port with something listening on it"""
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen()
+    yield server.getsockname()[1]
+    server.close()
+
+@pytest.fixture
+def date_server():
+    """Local HTTP server whose Date header is offset by server.skew seconds"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_HEAD(self):
+            self.send_response(200)
+            self.end_headers()
+
+        def date_time_string(self, timestamp=None):
+            return formatdate(time.time() + self.server.skew, usegmt=True)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    server.skew = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def test_dns_matches_host():
+    """Resolving to one of this host's addresses passes"""
+    check = DnsCheck("example.test", host_ips={"203.0.113.7"}, resolver=lambda d: {"203.0.113.7"})
+    assert check.run().status == CheckResult.PASS
+
+def test_dns_points_elsewhere():
+    """Resolving to another host fails before certbot would"""
+    check = DnsCheck("example.test", host_ips={"203.0.113.7"}, resolver=lambda d: {"198.51.100.1"})
+    result = check.run()
+    assert result.failed
+    assert "198.51.100.1" in result.message
+
+def test_dns_not_resolving():
+    """Lookup errors are reported as failures"""
+    def resolver(domain):
+        raise socket.gaierror(-2, "Name or service not known")
+    assert DnsCheck("example.test", host_ips=set(), resolver=resolver).run().failed
+
+def test_port_in_use(listening_port, tmp_path):
+    """A port held by something other than nginx fails"""
+    check = PortCheck(ports=(listening_port,), host='127.0.0.1', nginx_pid_file=str(tmp_path / "nginx.pid"))
+    assert check.run().failed
+
+def test_port_in_use_by_nginx(listening_port, tmp_path):
+    """A port already served by nginx (re-run) only warns"""
+    pid_file = tmp_path / "nginx.pid"
+    pid_file.write_text("1")
+    check = PortCheck(ports=(listening_port,), host='127.0.0.1', nginx_pid_file=str(pid_file))
+    assert check.run().status == CheckResult.WARN
+
+def test_port_free(tmp_path):
+    """An unused port passes"""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    assert PortCheck(ports=(port,), host='127.0.0.1').run().status == CheckResult.PASS
+
+def test_disk_threshold(tmp_path):
+    """Free space is compared against the threshold"""
+    assert DiskCheck(str(tmp_path), min_free_mb=1).run().status == CheckResult.PASS
+    assert DiskCheck(str(tmp_path), min_free_mb=10**12).run().failed
+
+def test_memory_threshold(tmp_path):
+    """Available memory plus free swap is compared against the threshold"""
+    meminfo = tmp_path / "meminfo"
+    meminfo.write_text("MemTotal: 1000000 kB\nMemAvailable: 102400 kB\nSwapFree: 0 kB\n")
+    assert MemoryCheck(min_available_mb=256, meminfo_path=str(meminfo)).run().failed
+    assert MemoryCheck(min_available_mb=64, meminfo_path=str(meminfo)).run().status == CheckResult.PASS
+
+def test_apt_lock_held(tmp_path):
+    """A lock held by another process fails"""
+    lock = tmp_path / "lock-frontend"
+    lock.touch()
+    holder = subprocess.Popen(
+        [sys.executable, '-c',
+         'import fcntl, os, sys, time\n'
+         f'fd = os.open({str(lock)!r}, os.O_RDWR)\n'
+         'fcntl.lockf(fd, fcntl.LOCK_EX)\n'
+         'print("locked", flush=True)\n'
+         'time.sleep(30)\n'],
+        stdout=subprocess.PIPE, text=True
+    )
+    try:
+        assert holder.stdout.readline().strip() == "locked"
+        assert AptLockCheck(lock_paths=(str(lock),)).run().failed
+    finally:
+        holder.kill()
+        holder.wait()
+    assert AptLockCheck(lock_paths=(str(lock),)).run().status == CheckResult.PASS
+
+def test_apt_mirror_reachability(tmp_path, listening_port):
+    """Mirrors from .list and deb822 .sources files are probed"""
+    sources_d = tmp_path / "sources.list.d"
+    sources_d.mkdir()
+    (tmp_path / "sources.list").write_text(
+        f"# comment\ndeb [arch=amd64] http://127.0.0.1:{listening_port}/ubuntu jammy main\n"
+    )
+    (sources_d / "extra.sources").write_text(f"Types: deb\nURIs: http://127.0.0.1:{listening_port}/extra\n")
+    check = AptMirrorCheck(sources=(str(tmp_path / "sources.list"), str(sources_d)), timeout=1)
+    assert check.mirrors() == [('127.0.0.1', listening_port)]
+    assert check.run().status == CheckResult.PASS
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        closed_port = s.getsockname()[1]
+    (sources_d / "dead.list").write_text(f"deb http://127.0.0.1:{closed_port}/dead jammy main\n")
+    assert check.run().failed
+
+def test_clock_skew(date_server):
+    """The local clock is compared with a server's Date header"""
+    url = f"http://127.0.0.1:{date_server.server_port}/"
+    assert ClockSkewCheck(url, max_skew=60, timeout=2).run().status == CheckResult.PASS
+    date_server.skew = 600
+    result = ClockSkewCheck(url, max_skew=60, timeout=2).run()
+    assert result.failed
+    assert "off by" in result.message
+
+class SleepCheck(PreflightCheck):
+    name = 'sleepy'
+
+    def run(self):
+        time.sleep(2)
+        return self.ok("woke up")
+
+class CrashCheck(PreflightCheck):
+    name = 'crashy'
+
+    def run(self):
+        raise RuntimeError("boom")
+
+def test_engine_runs_checks_concurrently_with_timeouts():
+    """Slow checks time out; total time is bounded by the slowest budget"""
+    checks = [SleepCheck(timeout=0.2), CrashCheck(timeout=1), DiskCheck('/', min_free_mb=0)]
+    started = time.monotonic()
+    report = run_preflight(checks)
+    assert time.monotonic() - started < 1.0
+    assert [r.name for r in report.results] == ['sleepy', 'crashy', 'disk']
+    assert "timed out" in report.results[0].message
+    assert "boom" in report.results[1].message
+    assert not report.ok
+    assert len(report.failures) == 2
+    assert "Preflight failed" in report.format()
+
+def test_hung_check_does_not_block_exit():
+    """A check stuck past its budget is abandoned rather than joined at exit"""
+    script = (
+        "import threading\n"
+        "from stackops.preflight import PreflightCheck, run_preflight\n"
+        "class HungCheck(PreflightCheck):\n"
+        "    name = 'hung'\n"
+        "    def run(self):\n"
+        "        threading.Event().wait()\n"
+        "report = run_preflight([HungCheck(timeout=0.2)])\n"
+        "print(report.results[0].message)\n"
+    )
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    started = time.monotonic()
+    result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True,
+                            env=env, timeout=30)
+    assert result.returncode == 0, result.stderr
+    assert "timed out" in result.stdout
+    assert time.monotonic() - started < 10
+
+def test_offline_checks_skip_apt_mirrors():
+    """Bundle installs don't need the mirrors, so they aren't checked"""
+    assert any(isinstance(check, AptMirrorCheck) for check in default_checks("example.test"))
+    offline = default_checks("example.test", offline=True)
+    assert not any(isinstance(check, AptMirrorCheck) for check in offline)
+    assert len(offline) == len(default_checks("example.test")) - 1
+
+def test_failed_preflight_stops_setup(tmp_path):
+    """Provisioning aborts before running any step"""
+    from tests.harness import ProvisioningHarness
+    harness = ProvisioningHarness(tmp_path)
+    check = DnsCheck("example.test", host_ips={"203.0.113.7"}, resolver=lambda d: {"198.51.100.1"})
+    report = harness.run(preflight_checks=[check])
+    assert report.success is False
+    assert report.step_durations == {}
+    assert harness.calls() == []
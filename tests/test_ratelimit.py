@@ -0,0 +1,82 @@
+# tests/test_ratelimit.py
+import re
+import pytest
+from stackops.ratelimit import (
+    APP_SNIPPET, API_SNIPPET, LIMITS_CONF, host_memory_mb, render_limits_conf, render_location_limits, zone_sizes,
+)
+from stackops.settings import Settings
+from tests.harness import ProvisioningHarness
+
+def test_zone_sizes_follow_memory():
+    """Zones grow with RAM within fixed bounds"""
+    assert zone_sizes(512) == (2, 1, 1)
+    assert zone_sizes(4096) == (16, 8, 8)
+    assert zone_sizes(128) == (1, 1, 1)
+    assert zone_sizes(1024 * 1024) == (64, 32, 32)
+
+def test_host_memory(tmp_path):
+    meminfo = tmp_path / "meminfo"
+    meminfo.write_text("MemTotal:        2048000 kB\nMemFree: 1000 kB\n")
+    assert host_memory_mb(str(meminfo)) == 2000
+    assert host_memory_mb(str(tmp_path / "missing")) == 1024
+
+def test_limits_conf():
+    """Zones, 429 responses and the allowlist are rendered at http level"""
+    settings = Settings({'STACKOPS_NGINX_LIMIT_ALLOWLIST': '10.0.0.0/8 203.0.113.7'})
+    conf = render_limits_conf(settings, 2048)
+    assert "zone=stackops_app:8m rate=20r/s;" in conf
+    assert "zone=stackops_api:4m rate=5r/s;" in conf
+    assert "limit_conn_zone $stackops_limit_key zone=stackops_conn:4m;" in conf
+    assert "limit_req_status 429;" in conf
+    assert "limit_conn_status 429;" in conf
+    geo = re.search(r'geo \$stackops_limit_exempt \{(.*?)\}', conf, re.S).group(1)
+    for network in ('127.0.0.1/32', '::1/128', '10.0.0.0/8', '203.0.113.7'):
+        assert f"{network} 1;" in geo
+
+def test_api_is_stricter_than_pages():
+    """/api/ gets its own lower rate and burst but the larger body size"""
+    settings = Settings({'STACKOPS_NGINX_API_MAX_BODY': '20M'})
+    app = render_location_limits(settings, 'app')
+    api = render_location_limits(settings, 'api')
+    assert "limit_req zone=stackops_app burst=40 nodelay;" in app
+    assert "limit_req zone=stackops_api burst=10 nodelay;" in api
+    assert "client_max_body_size 1m;" in app
+    assert "client_max_body_size 20m;" in api
+    with pytest.raises(ValueError):
+        render_location_limits(settings, 'static')
+    with pytest.raises(ValueError):
+        Settings({'STACKOPS_NGINX_MAX_BODY': 'lots'})
+
+def test_vhost_uses_profile(tmp_path):
+    """Provisioning writes the profile and wires it into the right locations only"""
+    harness = ProvisioningHarness(tmp_path)
+    assert harness.run().success
+    for rel in (LIMITS_CONF, APP_SNIPPET, API_SNIPPET):
+        assert (harness.root / rel).exists()
+
+    vhost = (harness.root / "etc/nginx/sites-available/nextjs-app").read_text()
+    locations = dict(re.findall(r'location (\S+) \{(.*?)\n    \}', vhost, re.S))
+    assert "stackops-limits-app.conf" in locations['/']
+    assert "stackops-limits-api.conf" in locations['/api/']
+    assert "limit" not in locations['/_next/static']
+    assert "limit" not in locations['/static/']
+    assert "50M" not in vhost
+
+def test_rate_limited_requests_are_not_jailed(tmp_path):
+    """429s from the limits stay out of the journal feeding fail2ban's nginx-4xx jail"""
+    harness = ProvisioningHarness(tmp_path)
+    assert harness.run().success
+    vhost = (harness.root / "etc/nginx/sites-available/nextjs-app").read_text()
+    block = re.search(r'map \$status \$stackops_4xx \{(.*?)\}', vhost, re.S).group(1)
+    entries = [line.split() for line in block.strip().splitlines()]
+
+    def logged(status):
+        # nginx checks regexes in order; default when none match
+        for pattern, value in entries:
+            if pattern.startswith('~') and re.search(pattern[1:].rstrip(';'), status):
+                return value.rstrip(';') == '1'
+        return dict(entries)['default'].rstrip(';') == '1'
+
+    assert logged('404') and logged('403')
+    assert not logged('429')
+    assert not logged('200') and not logged('502')
@@ -1,14 +1,21 @@
 # tests/test_setup.py
 import pytest
 from pathlib import Path
-from src.stackops.setup_manager import ServerSetup
-from src.stackops.utils import ensure_directory_exists
+from stackops.setup_manager import ServerSetup
+from stackops.utils import ensure_directory_exists
+from tests.harness import ProvisioningHarness
 
-def test_server_setup_creation():
+@pytest.fixture
+def harness(tmp_path):
+    """Fake root and stub binaries for hermetic runs"""
+    return ProvisioningHarness(tmp_path)
+
+def test_server_setup_creation(tmp_path):
     """Test basic ServerSetup instance creation"""
-    setup = ServerSetup()
+    setup = ServerSetup(base_dir=tmp_path)
     assert setup is not None
     assert setup.logger is not None
+    assert setup.scripts_dir == tmp_path / "scripts"
 
 def test_ensure_directory_exists(tmp_path):
     """Test directory creation utility"""
@@ -17,20 +24,67 @@ def test_ensure_directory_exists(tmp_path):
     assert test_dir.exists()
     assert test_dir.is_dir()
 
-def test_run_setup():
-    """Test run_setup method"""
-    setup = ServerSetup()
-    result = setup.run_setup()
-    assert result is True  # assuming success for now
+def test_run_setup(harness):
+    """Test run_setup method against the fake root"""
+    report = harness.run(domain="example.test", email="ops@example.test")
+    assert report.success is True
+    vhost = harness.root / "etc/nginx/sites-available/nextjs-app"
+    assert "server_name example.test;" in vhost.read_text()
+    assert (harness.root / "etc/cron.d/certbot-renewal").exists()
+    assert (harness.root / "etc/nginx/sites-enabled/nextjs-app").is_symlink()
+    certbot = harness.calls('certbot')
+    assert certbot and "example.test" in certbot[0]
 
-@pytest.fixture
-def setup_instance():
-    """Fixture for ServerSetup instance"""
-    return ServerSetup()
-
-def test_setup_with_config(tmp_path):
-    """Test ServerSetup with config file"""
-    config_path = tmp_path / "config.json"
-    config_path.write_text("{}")
-    setup = ServerSetup(config_path=config_path)
-    assert setup.config_path == config_path
\ No newline at end of file
+def test_static_locations_keep_security_headers(harness):
+    """Locations setting Cache-Control re-include the server's security headers"""
+    assert harness.run().success
+    snippet = harness.root / "etc/nginx/snippets/stackops-security-headers.conf"
+    assert "Strict-Transport-Security" in snippet.read_text()
+    vhost = (harness.root / "etc/nginx/sites-available/nextjs-app").read_text()
+    for location in ("location /static/ {", "location /_next/static {"):
+        block = vhost.split(location, 1)[1].split("\n    }", 1)[0]
+        assert "include /etc/nginx/snippets/stackops-security-headers.conf;" in block
+    assert "open_file_cache_errors" not in (harness.root / "etc/nginx/nginx.conf").read_text()
+
+def test_run_setup_with_runner(harness):
+    """The runner step downloads, configures and installs the service"""
+    report = harness.run(github_token="ghp_test")
+    assert report.success is True
+    assert set(report.step_durations) == {'initial', 'docker', 'nginx_ssl', 'runner'}
+    assert (harness.root / "etc/systemd/system/actions-runner.service").exists()
+    assert ['systemctl', 'start', 'actions-runner'] in harness.calls('systemctl')
+
+def test_runner_waits_for_apt_lock(harness):
+    """The runner's dependency install never overlaps the Docker install"""
+    harness.stub('apt', latency=0.2)
+    assert harness.run(github_token="ghp_test", max_workers=4).success
+    calls = harness.calls()
+    runner_install = calls.index(['apt-get', 'install', '-y', 'libicu70', 'libkrb5-3', 'zlib1g'])
+    docker_install = next(i for i, call in enumerate(calls) if 'docker-ce' in call)
+    assert runner_install > docker_install
+
+def test_runner_dependency_failure_fails_step(harness):
+    """A failed runner dependency install is not ignored"""
+    harness.stub('apt-get', fail_on='libicu70')
+    report = harness.run(github_token="ghp_test")
+    assert report.success is False
+    assert ['systemctl', 'start', 'actions-runner'] not in harness.calls('systemctl')
+
+def test_failure_stops_dependent_steps(harness):
+    """An injected docker failure stops provisioning before nginx/SSL"""
+    harness.stub('docker', fail_on='')
+    harness.stub('apt', fail_on='docker-ce')
+    report = harness.run()
+    assert report.success is False
+    assert 'nginx_ssl' not in report.step_durations
+    assert harness.calls('certbot') == []
+
+def test_steps_follow_dependencies(harness):
+    """Independent steps overlap, dependent ones never start early"""
+    harness.stub('curl', latency=0.3)
+    report = harness.run(github_token="ghp_test", max_workers=4)
+    assert report.success is True
+    timings = report.step_timings
+    assert timings['docker'][0] >= timings['initial'][1]
+    assert timings['nginx_ssl'][0] >= timings['docker'][1]
+    assert timings['runner'][0] < timings['nginx_ssl'][1]
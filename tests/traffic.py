@@ -0,0 +1,188 @@
+# tests/traffic.py
+"""Flood simulation: nginx's limit_req/limit_conn in front of a single slow backend
+
+nginx isn't available in the test environment, so LimitingProxy applies the
+same leaky-bucket accounting nginx uses (limit_req ... nodelay) with the
+rates and bursts parsed from the rendered profile. Like nginx it is a single
+event loop in its own process; the backend is one worker with a fixed
+service time, like the single Node process. Clients are identified by an
+X-Client header standing in for $binary_remote_addr.
+"""
+import asyncio
+import http.client
+import multiprocessing
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+class LimitZone:
+    """limit_req zone with nodelay: requests beyond the burst are rejected"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.state: Dict[str, Tuple[float, float]] = {}
+
+    def allow(self, key: str) -> bool:
+        if not key:
+            return True  # allowlisted clients have an empty key
+        now = time.monotonic()
+        if key not in self.state:
+            self.state[key] = (0.0, now)
+            return True
+        excess, last = self.state[key]
+        excess = max(excess - (now - last) * self.rate, 0.0) + 1
+        if excess > self.burst:
+            return False
+        self.state[key] = (excess, now)
+        return True
+
+
+def parse_profile(limits_conf: str, snippet: str) -> Tuple[LimitZone, int]:
+    """Build the zone and per-client connection limit a location uses"""
+    zone, burst = re.search(r'limit_req zone=(\w+) burst=(\d+)', snippet).groups()
+    rate = re.search(rf'zone={zone}:\d+m rate=(\d+)r/s', limits_conf).group(1)
+    conn_limit = re.search(r'limit_conn \w+ (\d+);', snippet).group(1)
+    return LimitZone(float(rate), int(burst)), int(conn_limit)
+
+
+class LimitingProxy:
+    """Rate-limiting front end plus single-worker backend, run in a child process"""
+
+    def __init__(self, zone: Optional[LimitZone], conn_limit: int = 0, service_time: float = 0.002):
+        """
+        Args:
+            zone: Request limit (None disables limiting)
+            conn_limit: Concurrent requests per client (0 disables)
+            service_time: Seconds the backend spends per request
+        """
+        self.zone = zone
+        self.conn_limit = conn_limit
+        self.service_time = service_time
+        self.port: Optional[int] = None
+        self.rejected = 0
+        self._process: Optional[multiprocessing.Process] = None
+        self._pipe = None
+
+    def __enter__(self) -> 'LimitingProxy':
+        self._pipe, child = multiprocessing.Pipe()
+        self._process = multiprocessing.get_context('fork').Process(target=self._main, args=(child,))
+        self._process.start()
+        self.port = self._pipe.recv()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._pipe.send('stop')
+        self.rejected = self._pipe.recv()
+        self._process.join(5)
+
+    def _main(self, pipe) -> None:
+        asyncio.run(self._serve(pipe))
+
+    async def _serve(self, pipe) -> None:
+        backend = asyncio.Lock()
+        active: Dict[str, int] = {}
+        rejected = 0
+
+        async def handle(reader, writer):
+            nonlocal rejected
+            try:
+                while True:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                    match = re.search(rb'\r\nX-Client: ([^\r]*)', head, re.IGNORECASE)
+                    key = match.group(1).decode() if match else ''
+                    if (self.conn_limit and key and active.get(key, 0) >= self.conn_limit) or \
+                            (self.zone is not None and not self.zone.allow(key)):
+                        rejected += 1
+                        status, body = b'429 Too Many Requests', b'slow down'
+                    else:
+                        active[key] = active.get(key, 0) + 1
+                        try:
+                            async with backend:
+                                await asyncio.sleep(self.service_time)
+                        finally:
+                            active[key] -= 1
+                        status, body = b'200 OK', b'ok'
+                    writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Length: %d\r\n\r\n' % len(body) + body)
+                    await writer.drain()
+            except (asyncio.IncompleteReadError, ConnectionError):
+                pass
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(handle, '127.0.0.1', 0, backlog=1024)
+        pipe.send(server.sockets[0].getsockname()[1])
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, pipe.recv)
+        server.close()
+        pipe.send(rejected)
+
+
+def _client(port: int, key: str, path: str, interval: float, duration: float, offset: float,
+            results: Optional[List[Tuple[float, int]]] = None) -> None:
+    """Send paced requests over one keep-alive connection"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    deadline = time.monotonic() + duration
+    time.sleep(offset)
+    next_send = time.monotonic()
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        conn.request('GET', path, headers={'X-Client': key})
+        response = conn.getresponse()
+        response.read()
+        if results is not None:
+            results.append((time.perf_counter() - started, response.status))
+        next_send += interval
+        time.sleep(max(0.0, next_send - time.monotonic()))
+    conn.close()
+
+
+def _run_clients(port: int, keys: List[str], path: str, interval: float, duration: float,
+                 results: Optional[List[Tuple[float, int]]] = None) -> None:
+    # Spread the clients over the interval so they don't all arrive in lockstep
+    threads = [threading.Thread(target=_client,
+                                args=(port, key, path, interval, duration, interval * i / len(keys), results))
+               for i, key in enumerate(keys)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def p99(results: List[Tuple[float, int]]) -> float:
+    ordered = sorted(latency for latency, _status in results)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+
+
+def measure(proxy: LimitingProxy,
+            path: str,
+            good_clients: int,
+            good_rate: float,
+            duration: float,
+            flood_clients: int = 0,
+            flood_rate: float = 0,
+            flood_sources: int = 1) -> List[Tuple[float, int]]:
+    """
+    (latency, status) of each well-behaved client request, optionally during a flood
+
+    The flood opens flood_clients connections from flood_sources addresses
+    and runs in its own process, so it competes for the proxy rather than
+    for the measuring clients' interpreter.
+    """
+    flood = None
+    if flood_clients:
+        keys = [f"198.51.100.{i % flood_sources}" for i in range(flood_clients)]
+        flood = multiprocessing.get_context('fork').Process(
+            target=_run_clients, args=(proxy.port, keys, path, 1 / flood_rate, duration + 0.5))
+        flood.start()
+        time.sleep(0.25)  # let the flood build up first
+
+    results: List[Tuple[float, int]] = []
+    keys = [f"203.0.113.{i}" for i in range(good_clients)]
+    _run_clients(proxy.port, keys, path, 1 / good_rate, duration, results)
+
+    if flood is not None:
+        flood.join(10)
+    return results